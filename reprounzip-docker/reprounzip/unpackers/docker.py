@@ -159,7 +159,8 @@ def docker_setup_create(args):
         logger.info("Using base image %s", base_image)
         logger.debug("Distribution: %s", target_distribution or "unknown")
 
-        rpz_pack.copy_data_tar(target / 'data.tgz')
+        data_compression = rpz_pack.copy_data_tar(target / 'data.tgz')
+        rpz_pack.copy_data_index(target)
 
         arch = runs[0]['architecture']
 
@@ -239,6 +240,12 @@ def docker_setup_create(args):
                         pathlist.append(path)
                     else:
                         logger.info("Missing file %s", path)
+            # Hardlinks can only be restored if their target is extracted too
+            hardlinks = rpz_pack.data_hardlinks()
+            for path in list(pathlist):
+                if path in hardlinks and hardlinks[path] not in paths:
+                    paths.add(hardlinks[path])
+                    pathlist.append(hardlinks[path])
             rpz_pack.close()
             # FIXME : for some reason we need reversed() here, I'm not sure why
             # Need to read more of tar's docs.
@@ -248,10 +255,11 @@ def docker_setup_create(args):
                     lfp.write(join_root(rpz_pack.data_prefix, p).path)
                     lfp.write(b'\0')
             fp.write('    cd / && '
-                     '(tar zpxf /reprozip_data.tgz -U --recursive-unlink '
+                     '(tar %spxf /reprozip_data.tgz -U --recursive-unlink '
                      '--numeric-owner --strip=1 --null -T /rpz-files.list || '
                      '/busybox echo "TAR reports errors, this might or might '
-                     'not prevent the execution to run")\n')
+                     'not prevent the execution to run")\n' %
+                     ('z' if data_compression == 'gzip' else ''))
 
         # Meta-data for reprounzip
         write_dict(target, metadata_initial_iofiles(config))
@@ -9,11 +9,12 @@ import logging
 import os
 import pickle
 import platform
+from rpaths import Path
 import subprocess
 import sys
 import time
-import yaml
 
+from reprounzip.common import load_config_document
 from reprounzip_qt.qt_terminal import run_in_builtin_terminal
 
 
@@ -78,9 +79,14 @@ def check_directory(directory):
     return None
 
 
+def read_config(directory):
+    """Reads the configuration file of an unpacked directory, as a dict.
+    """
+    return load_config_document(Path(directory) / 'config.yml')
+
+
 def is_jupyter(directory):
-    with open(os.path.join(directory, 'config.yml')) as fp:
-        config = yaml.safe_load(fp)
+    config = read_config(directory)
     iofiles = config.get('inputs_outputs', None)
     detected = iofiles and any(iofile['name'] == 'jupyter_connection_file'
                                for iofile in config.get('inputs_outputs'))
@@ -101,8 +107,7 @@ class FileStatus(object):
 class FilesStatus(object):
     def __init__(self, directory):
         self.directory = directory
-        with open(os.path.join(directory, 'config.yml')) as fp:
-            config = yaml.safe_load(fp)
+        config = read_config(directory)
 
         self.files = [FileStatus(f['name'], f['path'],
                                  f.get('read_by_runs'),
@@ -279,6 +279,12 @@ def vagrant_setup_create(args):
     target.mkdir(parents=True)
 
     try:
+        # Copies pack
+        logger.info("Copying pack file...")
+        data_compression = rpz_pack.copy_data_tar(target / 'data.tgz')
+        rpz_pack.copy_data_index(target)
+        tar_options = 'z' if data_compression == 'gzip' else ''
+
         # Writes setup script
         logger.info("Writing setup script %s...", target / 'setup.sh')
         with (target / 'setup.sh').open('w', encoding='utf-8',
@@ -299,8 +305,9 @@ def vagrant_setup_create(args):
             if use_chroot:
                 fp.write('\n'
                          'mkdir /experimentroot; cd /experimentroot\n')
-                fp.write('tar zpxf /vagrant/data.tgz --numeric-owner '
-                         '--strip=1 %s\n' % rpz_pack.data_prefix)
+                fp.write('tar %spxf /vagrant/data.tgz --numeric-owner '
+                         '--strip=1 %s\n' % (
+                             tar_options, rpz_pack.data_prefix))
                 if mount_bind:
                     fp.write('\n'
                              'mkdir -p /experimentroot/dev\n'
@@ -343,6 +350,13 @@ def vagrant_setup_create(args):
                             pathlist.append(path)
                         else:
                             logger.info("Missing file %s", path)
+                # Hardlinks can only be restored if their target is extracted
+                # too
+                hardlinks = rpz_pack.data_hardlinks()
+                for path in list(pathlist):
+                    if path in hardlinks and hardlinks[path] not in paths:
+                        paths.add(hardlinks[path])
+                        pathlist.append(hardlinks[path])
                 # FIXME : for some reason we need reversed() here, I'm not sure
                 # why. Need to read more of tar's docs.
                 # TAR bug: --no-overwrite-dir removes --keep-old-files
@@ -354,9 +368,10 @@ def vagrant_setup_create(args):
                     for p in reversed(pathlist):
                         lfp.write(join_root(rpz_pack.data_prefix, p).path)
                         lfp.write(b'\0')
-                fp.write('tar zpxf /vagrant/data.tgz --keep-old-files '
+                fp.write('tar %spxf /vagrant/data.tgz --keep-old-files '
                          '--numeric-owner --strip=1 '
-                         '--null -T /vagrant/rpz-files.list || /bin/true\n')
+                         '--null -T /vagrant/rpz-files.list || /bin/true\n' %
+                         tar_options)
 
             # Copies busybox
             if use_chroot:
@@ -372,10 +387,6 @@ mkdir -p /experimentroot/bin
     ln -s /busybox /experimentroot/bin/sh
 ''')
 
-        # Copies pack
-        logger.info("Copying pack file...")
-        rpz_pack.copy_data_tar(target / 'data.tgz')
-
         rpz_pack.close()
 
         # Meta-data for reprounzip
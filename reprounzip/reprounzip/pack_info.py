@@ -20,7 +20,8 @@ import platform
 from rpaths import Path
 import sys
 
-from reprounzip.common import RPZPack, load_config as load_config_file
+from reprounzip.common import RPZPack, load_config as load_config_file, \
+    open_config
 from reprounzip.main import unpackers
 from reprounzip.unpackers.common import load_config, COMPAT_OK, COMPAT_MAYBE, \
     COMPAT_NO, UsageError, shell_escape, metadata_read
@@ -33,7 +34,17 @@ logger = logging.getLogger('reprounzip')
 def get_package_info(pack, read_data=False):
     """Get information about a package.
     """
-    runs, packages, other_files = config = load_config(pack)
+    rpz_pack = RPZPack(pack)
+    with rpz_pack.with_config() as configfile:
+        # Only counts the files, without loading all of them
+        config = open_config(configfile, canonical=True)
+        information = _get_package_info(pack, rpz_pack, config, read_data)
+    rpz_pack.close()
+    return information
+
+
+def _get_package_info(pack, rpz_pack, config, read_data):
+    runs, packages, other_files = config
     inputs_outputs = config.inputs_outputs
 
     information = {}
@@ -47,7 +58,6 @@ def get_package_info(pack, read_data=False):
         hardlinks = 0
         others = 0
 
-        rpz_pack = RPZPack(pack)
         for m in rpz_pack.list_data():
             total_size += m.size
             total_paths += 1
@@ -61,7 +71,6 @@ def get_package_info(pack, read_data=False):
                 hardlinks += 1
             else:
                 others += 1
-        rpz_pack.close()
 
         information['pack'] = {
             'total_size': total_size,
@@ -77,22 +86,24 @@ def get_package_info(pack, read_data=False):
     packed_packages_files = 0
     unpacked_packages_files = 0
     packed_packages = 0
+    nb_packages = 0
     for package in packages:
         nb = len(package.files)
         total_paths += nb
+        nb_packages += 1
         if package.packfiles:
             packed_packages_files += nb
             packed_packages += 1
         else:
             unpacked_packages_files += nb
-    nb = len(other_files)
+    nb = sum(1 for f in other_files)
     total_paths += nb
 
     information['meta'] = {
         'total_paths': total_paths,
         'packed_packages_files': packed_packages_files,
         'unpacked_packages_files': unpacked_packages_files,
-        'packages': len(packages),
+        'packages': nb_packages,
         'packed_packages': packed_packages,
         'packed_paths': packed_packages_files + nb,
     }
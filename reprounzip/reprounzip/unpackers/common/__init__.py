@@ -21,6 +21,7 @@ from reprounzip.unpackers.common.misc import UsageError, \
     metadata_update_run, parse_ports
 from reprounzip.unpackers.common.packages import THIS_DISTRIBUTION, \
     PKG_NOT_INSTALLED, CantFindInstaller, select_installer
+from reprounzip.unpackers.common.store import ObjectStore
 
 
 __all__ = ['THIS_DISTRIBUTION', 'PKG_NOT_INSTALLED', 'select_installer',
@@ -33,4 +34,4 @@ __all__ = ['THIS_DISTRIBUTION', 'PKG_NOT_INSTALLED', 'select_installer',
            'add_environment_options', 'fixup_environment',
            'interruptible_call', 'metadata_read', 'metadata_write',
            'metadata_initial_iofiles', 'metadata_update_run',
-           'parse_ports']
+           'parse_ports', 'ObjectStore']
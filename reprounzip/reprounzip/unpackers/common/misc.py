@@ -9,8 +9,10 @@ from __future__ import division, print_function, unicode_literals
 
 import copy
 import functools
+import gzip
 import logging
 import itertools
+import json
 import os
 import pickle
 import random
@@ -226,16 +228,45 @@ class FileUploader(object):
         pass
 
     def extract_original_input(self, input_name, input_path, temp):
-        tar = tarfile.open(str(self.target / self.data_tgz), 'r:*')
-        try:
-            member = tar.getmember(str(join_root(PosixPath('DATA'),
-                                                 input_path)))
-        except KeyError:
-            return None
+        name = str(join_root(PosixPath('DATA'), input_path))
+        index = self.target / 'data-index.jsonl.gz'
+        if index.exists():
+            # Finds the member in the index, then seeks directly to it
+            with gzip.GzipFile(str(index), 'rb') as fp:
+                members = dict((m.name, m)
+                               for m in reprounzip.common.read_data_index(fp))
+            try:
+                member = members[name]
+            except KeyError:
+                return None
+            if member.islnk():
+                member = members[member.linkname]
+            blocks = None
+            if (self.target / 'data-blocks.json').exists():
+                with (self.target / 'data-blocks.json').open('rb') as fp:
+                    blocks = json.loads(fp.read().decode('ascii'))
+            fileobj = (self.target / self.data_tgz).open('rb')
+            compression = 'gzip' if fileobj.read(2) == b'\x1f\x8b' else 'none'
+            fileobj.seek(0)
+            tar = tarfile.open(
+                fileobj=reprounzip.common.decompress_data(fileobj, compression,
+                                                          blocks),
+                mode='r:')
+        else:
+            fileobj = None
+            tar = tarfile.open(str(self.target / self.data_tgz), 'r:*')
+            try:
+                member = tar.getmember(name)
+            except KeyError:
+                return None
+            if member.islnk():
+                member = tar.getmember(member.linkname)
         member = copy.copy(member)
         member.name = str(temp.components[-1])
         tar.extract(member, str(temp.parent))
         tar.close()
+        if fileobj is not None:
+            fileobj.close()
         return temp
 
     def upload_file(self, local_path, input_path):
@@ -559,9 +590,10 @@ def metadata_write(path, dct, type_):
 def metadata_initial_iofiles(config, dct=None):
     """Add the initial state of the {in/out}put files to the unpacker metadata.
 
-    :param config: The configuration as returned by `load_config()`, which will
-    be used to list the input and output files and to determine which ones have
-    been packed (and therefore exist initially).
+    :param config: The configuration as returned by `load_config()` or
+    `open_config()`, which will be used to list the input and output files and
+    to determine which ones have been packed (and therefore exist initially).
+    The packed files are only iterated on once.
 
     The `input_files` key contains a dict mapping the name to either:
       * None (or inexistent): original file and exists
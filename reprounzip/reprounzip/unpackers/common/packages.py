@@ -12,7 +12,8 @@ import platform
 import subprocess
 
 from reprounzip.unpackers.common.misc import UsageError
-from reprounzip.utils import itervalues
+from reprounzip.utils import iteritems, itervalues, dpkg_query, \
+    rpm_query
 
 
 logger = logging.getLogger('reprounzip')
@@ -60,24 +61,13 @@ class AptInstaller(object):
         if not packages:
             return {}
 
-        p = subprocess.Popen(['dpkg-query',
-                              '--showformat=${Package;-50}\t${Version}\n',
-                              '-W'] +
-                             [pkg.name for pkg in packages],
-                             stdout=subprocess.PIPE)
         # name -> (pkg, installed_version)
         pkgs_dict = dict((pkg.name, (pkg, PKG_NOT_INSTALLED))
                          for pkg in packages)
-        try:
-            for l in p.stdout:
-                fields = l.split()
-                if len(fields) == 2:
-                    name = fields[0].decode('ascii')
-                    status = fields[1].decode('ascii')
-                    pkg, _ = pkgs_dict[name]
-                    pkgs_dict[name] = pkg, status
-        finally:
-            p.wait()
+        infos = dpkg_query(pkgs_dict, ['Version'])
+        for name, (version,) in iteritems(infos):
+            pkg, _ = pkgs_dict[name]
+            pkgs_dict[name] = pkg, version
 
         return pkgs_dict
 
@@ -116,24 +106,13 @@ class YumInstaller(object):
         if not packages:
             return {}
 
-        p = subprocess.Popen(['rpm', '-q'] +
-                             [pkg.name for pkg in packages] +
-                             ['--qf', '+%{NAME} %{VERSION}-%{RELEASE}\\n'],
-                             stdout=subprocess.PIPE)
         # name -> {pkg, installed_version}
         pkgs_dict = dict((pkg.name, (pkg, PKG_NOT_INSTALLED))
                          for pkg in packages)
-        try:
-            for l in p.stdout:
-                if l[0] == b'+':
-                    fields = l[1:].split()
-                    if len(fields) == 2:
-                        name = fields[0].decode('ascii')
-                        status = fields[1].decode('ascii')
-                        pkg, _ = pkgs_dict[name]
-                        pkgs_dict[name] = pkg, status
-        finally:
-            p.wait()
+        infos = rpm_query(pkgs_dict, ['%{VERSION}-%{RELEASE}'])
+        for name, (version,) in iteritems(infos):
+            pkg, _ = pkgs_dict[name]
+            pkgs_dict[name] = pkg, version
 
         return pkgs_dict
 
@@ -0,0 +1,135 @@
+# Copyright (C) 2014-2017 New York University
+# This file is part of ReproZip which is released under the Revised BSD License
+# See file LICENSE for full license details.
+
+"""Content-addressed store of extracted files.
+
+Unpackers can put the files they extract in this store, shared between
+experiments, and only create links to them in the experiment directory.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+
+from reprounzip.common import DATA_DIGEST_HEADER
+from reprounzip.utils import cache_directory, copyfile
+
+
+logger = logging.getLogger('reprounzip')
+
+
+# ioctl that makes a file share the extents of another (Linux, on btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    """Makes a copy of a file, sharing its blocks if the filesystem allows it.
+    """
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            try:
+                import fcntl
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (ImportError, IOError, OSError):
+                copyfile(src, dst, 1 << 20)
+
+
+class ObjectStore(object):
+    """A content-addressed store of files, shared between experiments.
+
+    Files are stored under their SHA-256 and their attributes (mode, owner,
+    modification time), so that a hardlink to an object is a correct copy of
+    the file. Files whose name is in `writable` are cloned instead, so that
+    the experiment writing to them doesn't change the store.
+
+    The store is in ``~/.cache/reprozip/objects/`` by default. Hardlinks can
+    only be made if it is on the same filesystem as the experiment; otherwise
+    the files are cloned or copied.
+    """
+    def __init__(self, directory=None, writable=()):
+        if directory is None:
+            directory = cache_directory() / 'objects'
+        self.directory = str(directory)
+        self.writable = set(writable)
+        self.can_link = True
+        self.linked = set()
+
+    def object_path(self, member):
+        """Gets the path of a member of the data tarball in the store.
+
+        Returns None if the digest of that file is not known.
+        """
+        digest = member.pax_headers.get(DATA_DIGEST_HEADER)
+        if digest is None:
+            return None
+        return os.path.join(
+            self.directory, digest[:2],
+            '%s-%o-%d-%d-%d' % (digest, member.mode, member.uid, member.gid,
+                                member.mtime))
+
+    def add(self, member, source, set_attrs):
+        """Adds a file to the store.
+
+        `source` is a file object with the contents of `member`.
+        `set_attrs(member, path)` is called to set the attributes of the new
+        object. Returns False if the file can't be stored.
+        """
+        obj = self.object_path(member)
+        if obj is None:
+            return False
+        parent = os.path.dirname(obj)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Write to a temporary name, then rename, so that other processes
+        # never see an incomplete object
+        temp = '%s.%d.%d.tmp' % (obj, os.getpid(), id(member))
+        h = hashlib.sha256()
+        with open(temp, 'wb') as fp:
+            chunk = source.read(1 << 20)
+            while chunk:
+                h.update(chunk)
+                fp.write(chunk)
+                chunk = source.read(1 << 20)
+        if h.hexdigest() != member.pax_headers[DATA_DIGEST_HEADER]:
+            logger.warning("Contents of %s don't match its digest, not "
+                           "storing it", member.name)
+            os.remove(temp)
+            return False
+        set_attrs(member, temp)
+        os.rename(temp, obj)
+        return True
+
+    def materialize(self, member, path):
+        """Creates the file at `path` from the store, if it is there.
+
+        Returns False if the store doesn't have that file. If a hardlink is
+        made, the path is added to `linked`, and its attributes are already
+        right.
+        """
+        obj = self.object_path(member)
+        if obj is None or not os.path.exists(obj):
+            return False
+        if os.path.lexists(path):
+            os.remove(path)
+        if self.can_link and member.name not in self.writable:
+            try:
+                os.link(obj, path)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    logger.warning("Store %s is on a different filesystem, "
+                                   "files will be copied instead of linked",
+                                   self.directory)
+                    self.can_link = False
+            else:
+                self.linked.add(path)
+                return True
+        clone_file(obj, path)
+        return True
@@ -19,6 +19,7 @@ from __future__ import division, print_function, unicode_literals
 import argparse
 import copy
 import logging
+import multiprocessing
 import os
 import platform
 from rpaths import PosixPath, DefaultAbstractPath, Path
@@ -35,9 +36,9 @@ from reprounzip.unpackers.common import THIS_DISTRIBUTION, PKG_NOT_INSTALLED, \
     load_config, select_installer, busybox_url, join_root, FileUploader, \
     FileDownloader, get_runs, add_environment_options, fixup_environment, \
     interruptible_call, metadata_read, metadata_write, \
-    metadata_initial_iofiles, metadata_update_run
+    metadata_initial_iofiles, metadata_update_run, ObjectStore
 from reprounzip.unpackers.common.x11 import X11Handler, LocalForwarder
-from reprounzip.utils import unicode_, irange, iteritems, itervalues, \
+from reprounzip.utils import PY3, unicode_, irange, iteritems, itervalues, \
     stdout_bytes, stderr, make_dir_writable, rmtree_fixed, copyfile, \
     download_file
 
@@ -120,6 +121,12 @@ def directory_create(args):
 
     signals.pre_setup(target=target, pack=pack)
 
+    jobs = extraction_jobs(args.jobs)
+    use_store = args.shared_store
+    if use_store and not PY3:
+        logger.critical("--shared-store requires Python 3")
+        sys.exit(1)
+
     # Unpacks configuration file
     rpz_pack = RPZPack(pack)
     rpz_pack.extract_config(target / 'config.yml')
@@ -155,13 +162,17 @@ def directory_create(args):
         for m in members:
             # Remove 'DATA/' prefix
             m.name = str(rpz_pack.remove_data_prefix(m.name))
+            # Hardlinks point to another member
+            if m.islnk():
+                m.linkname = str(rpz_pack.remove_data_prefix(m.linkname))
             # Makes symlink targets relative
-            if m.issym():
+            elif m.issym():
                 linkname = PosixPath(m.linkname)
                 if linkname.is_absolute:
                     m.linkname = join_root(root, PosixPath(m.linkname)).path
         logger.info("Extracting files...")
-        rpz_pack.extract_data(root, members)
+        store = shared_store(config) if use_store else None
+        rpz_pack.extract_data(root, members, jobs, store)
         rpz_pack.close()
 
         # Original input files, so upload can restore them
@@ -177,7 +188,14 @@ def directory_create(args):
             inputtar.close()
 
         # Meta-data for reprounzip
-        metadata_write(target, metadata_initial_iofiles(config), 'directory')
+        logger.info("Finding library directories...")
+        unpacked_info = {'library_dirs': {
+            'ldconfig': ldconfig_dirs(),
+            'ld_so_conf': ld_so_conf_stamp(),
+            'shared_objects': shared_object_dirs(root)}}
+        metadata_write(target,
+                       metadata_initial_iofiles(config, unpacked_info),
+                       'directory')
 
         signals.post_setup(target=target, pack=pack)
     except Exception:
@@ -185,6 +203,112 @@ def directory_create(args):
         raise
 
 
+def ldconfig_dirs():
+    """Gets the directories where this machine looks for libraries.
+    """
+    lib_dirs = []
+    p = subprocess.Popen(['/sbin/ldconfig', '-v', '-N'],
+                         stdout=subprocess.PIPE)
+    try:
+        for l in p.stdout:
+            if len(l) < 3 or l[0:1] in (b' ', b'\t'):
+                continue
+            # Either "/lib:" or "/lib: (from /etc/ld.so.conf.d/libc.conf:2)"
+            if l.endswith(b':\n'):
+                lib_dirs.append(unicode_(Path(l[:-2])))
+            elif b': (from ' in l:
+                lib_dirs.append(unicode_(Path(l.split(b': (from ', 1)[0])))
+    finally:
+        p.wait()
+    return lib_dirs
+
+
+def ld_so_conf_stamp():
+    """Identifies the current state of this machine's ld.so.conf.
+
+    This changes when these files are changed, added or removed, meaning that
+    `ldconfig_dirs()` should be called again.
+    """
+    filenames = ['/etc/ld.so.conf']
+    try:
+        filenames.extend(sorted(os.path.join('/etc/ld.so.conf.d', f)
+                                for f in os.listdir('/etc/ld.so.conf.d')))
+    except OSError:
+        pass
+    stamp = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        stamp.append((filename, st.st_mtime, st.st_size))
+    return stamp
+
+
+def shared_object_dirs(root):
+    """Finds the directories of the unpacked tree that have shared libraries.
+
+    Only files named ``lib*.so*`` are considered, so that directories of
+    plugins and extension modules (such as Python's), which are loaded by
+    path, don't end up in the search path of every program. Directories
+    ``*.libs`` of libraries bundled with a Python wheel are left out too,
+    since these are found through the RUNPATH of the modules using them.
+
+    Returns their paths in the experiment (relative to `root`), sorted.
+    """
+    root = str(root)
+    lib_dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath.endswith('.libs'):
+            continue
+        for filename in filenames:
+            if not (filename.startswith('lib') and
+                    (filename.endswith('.so') or '.so.' in filename)):
+                continue
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path):
+                continue
+            try:
+                with open(path, 'rb') as fp:
+                    header = fp.read(18)
+            except IOError:
+                continue
+            # ELF file of type ET_DYN, in either byte order
+            if (header[:4] == b'\x7FELF' and
+                    header[16:18] in (b'\x03\x00', b'\x00\x03')):
+                if dirpath == root:
+                    lib_dirs.append('/')
+                else:
+                    lib_dirs.append('/' + os.path.relpath(dirpath, root))
+                break
+    return sorted(lib_dirs)
+
+
+def library_dirs(unpacked_info, root):
+    """Gets the library directories for an experiment.
+
+    These are computed by `directory setup` and stored in the metadata. The
+    directories from ldconfig are computed again if ld.so.conf changed since;
+    `unpacked_info` is updated, so it should be written back.
+    """
+    info = unpacked_info.get('library_dirs')
+    if info is None:
+        # Unpacked by an older version
+        info = unpacked_info['library_dirs'] = {
+            'ldconfig': None,
+            'ld_so_conf': None,
+            'shared_objects': shared_object_dirs(root)}
+    stamp = ld_so_conf_stamp()
+    if info['ld_so_conf'] != stamp:
+        logger.info("ld.so.conf changed, running ldconfig")
+        info['ldconfig'] = ldconfig_dirs()
+        info['ld_so_conf'] = stamp
+    lib_dirs = list(info['ldconfig'])
+    lib_dirs.extend(d for d in info['shared_objects']
+                    if d not in lib_dirs)
+    return lib_dirs
+
+
 @target_must_exist
 def directory_run(args):
     """Runs the command in the directory.
@@ -202,20 +326,9 @@ def directory_run(args):
     root = (target / 'root').absolute()
 
     # Gets library paths
-    lib_dirs = []
-    p = subprocess.Popen(['/sbin/ldconfig', '-v', '-N'],
-                         stdout=subprocess.PIPE)
-    try:
-        for l in p.stdout:
-            if len(l) < 3 or l[0] in (b' ', b'\t'):
-                continue
-            if l.endswith(b':\n'):
-                lib_dirs.append(Path(l[:-2]))
-    finally:
-        p.wait()
     lib_dirs = ('export LD_LIBRARY_PATH=%s' % ':'.join(
-                shell_escape(unicode_(join_root(root, d)))
-                for d in lib_dirs))
+                shell_escape(unicode_(join_root(root, PosixPath(d))))
+                for d in library_dirs(unpacked_info, root)))
 
     cmds = [lib_dirs]
     for run_number in selected_runs:
@@ -329,6 +442,30 @@ def should_restore_owner(param):
     return ret
 
 
+def extraction_jobs(param):
+    """Computes the number of threads to use to extract files.
+    """
+    if param is None:
+        return multiprocessing.cpu_count()
+    elif param < 1:
+        logger.critical("--jobs should be at least 1")
+        sys.exit(2)
+    return param
+
+
+def shared_store(config):
+    """Opens the store of extracted files shared between experiments.
+
+    The output files of the experiment are copied rather than linked from the
+    store, since the experiment will write to them.
+    """
+    writable = set()
+    for f in itervalues(config.inputs_outputs):
+        if f.write_runs:
+            writable.add(str(PosixPath(f.path).split_root()[1]))
+    return ObjectStore(writable=writable)
+
+
 def should_mount_magic_dirs(param):
     """Computes whether to mount directories inside the chroot.
     """
@@ -387,6 +524,12 @@ def chroot_create(args):
     # We can only restore owner/group of files if running as root
     restore_owner = should_restore_owner(args.restore_owner)
 
+    jobs = extraction_jobs(args.jobs)
+    use_store = args.shared_store
+    if use_store and not PY3:
+        logger.critical("--shared-store requires Python 3")
+        sys.exit(1)
+
     # Unpacks configuration file
     rpz_pack = RPZPack(pack)
     rpz_pack.extract_config(target / 'config.yml')
@@ -437,6 +580,9 @@ def chroot_create(args):
         for m in members:
             # Remove 'DATA/' prefix
             m.name = str(rpz_pack.remove_data_prefix(m.name))
+            # Hardlinks point to another member
+            if m.islnk():
+                m.linkname = str(rpz_pack.remove_data_prefix(m.linkname))
         if not restore_owner:
             uid = os.getuid()
             gid = os.getgid()
@@ -444,7 +590,8 @@ def chroot_create(args):
                 m.uid = uid
                 m.gid = gid
         logger.info("Extracting files...")
-        rpz_pack.extract_data(root, members)
+        store = shared_store(config) if use_store else None
+        rpz_pack.extract_data(root, members, jobs, store)
         rpz_pack.close()
 
         resolvconf_src = Path('/etc/resolv.conf')
@@ -681,6 +828,9 @@ class LocalUploader(FileUploader):
         # Copy
         orig_stat = remote_path.stat()
         with make_dir_writable(remote_path.parent):
+            # Don't overwrite the other names of a deduplicated file
+            if orig_stat.st_nlink > 1:
+                remote_path.remove()
             local_path.copyfile(remote_path)
             remote_path.chmod(orig_stat.st_mode & 0o7777)
             if self.restore_owner:
@@ -829,6 +979,14 @@ def setup_directory(parser, **kwargs):
     parser_setup.add_argument('pack', nargs=1, help="Pack to extract")
     # Note: add_opt_general is called later so that 'pack' is before 'target'
     add_opt_general(parser_setup)
+    parser_setup.add_argument(
+        '-j', '--jobs', type=int,
+        help="number of threads used to extract the files (default: number "
+             "of CPUs)")
+    parser_setup.add_argument(
+        '--shared-store', action='store_true', default=False,
+        help="link the files from a store shared between experiments "
+             "instead of writing new copies")
     parser_setup.set_defaults(func=directory_create)
 
     # upload
@@ -910,6 +1068,13 @@ def setup_chroot(parser, **kwargs):
     # setup/create
     def add_opt_setup(opts):
         opts.add_argument('pack', nargs=1, help="Pack to extract")
+        opts.add_argument('-j', '--jobs', type=int,
+                          help="number of threads used to extract the files "
+                               "(default: number of CPUs)")
+        opts.add_argument('--shared-store', action='store_true',
+                          default=False,
+                          help="link the files from a store shared between "
+                               "experiments instead of writing new copies")
 
     def add_opt_owner(opts):
         opts.add_argument('--preserve-owner', action='store_true',
@@ -27,7 +27,7 @@ import sqlite3
 import sys
 
 from reprounzip.common import FILE_READ, FILE_WRITE, FILE_WDIR, RPZPack, \
-    load_config
+    load_config, create_trace_views
 from reprounzip.orderedset import OrderedSet
 from reprounzip.unpackers.common import COMPAT_OK, COMPAT_NO
 from reprounzip.utils import PY3, izip, iteritems, itervalues, stderr, \
@@ -303,6 +303,7 @@ def read_events(database, all_forks, has_thread_flag):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
 
     # This is a bit weird. We need to iterate on all types of events at the
     # same time, ordering by timestamp, so we decorate-sort-undecorate
@@ -332,7 +333,7 @@ def read_events(database, all_forks, has_thread_flag):
     file_rows = file_cursor.execute(
         '''
         SELECT name, timestamp, mode, process, is_directory
-        FROM opened_files
+        FROM opened_paths
         ORDER BY id
         ''')
     binaries = set()
@@ -344,7 +345,7 @@ def read_events(database, all_forks, has_thread_flag):
     exec_rows = exec_cursor.execute(
         '''
         SELECT name, timestamp, process, argv
-        FROM executed_files
+        FROM executed_paths
         ORDER BY id
         ''')
 
@@ -19,7 +19,8 @@ from rpaths import Path
 import sqlite3
 import sys
 
-from reprounzip.common import FILE_WRITE, RPZPack, load_config
+from reprounzip.common import FILE_WRITE, RPZPack, load_config, \
+    create_trace_views
 from reprounzip.unpackers.common import COMPAT_OK, COMPAT_NO, shell_escape
 from reprounzip.utils import PY3, iteritems, stderr
 
@@ -55,6 +56,7 @@ def generate(target, configfile, database):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
 
     vertices = []
     edges = []
@@ -148,7 +150,7 @@ def generate(target, configfile, database):
     rows = cur.execute(
         '''
         SELECT name, is_directory
-        FROM opened_files
+        FROM opened_paths
         GROUP BY name;
         ''')
     for r_name, r_directory in rows:
@@ -173,7 +175,7 @@ def generate(target, configfile, database):
     rows = cur.execute(
         '''
         SELECT id, name, timestamp, mode, process
-        FROM opened_files;
+        FROM opened_paths;
         ''')
     for r_id, r_name, r_timestamp, r_mode, r_process in rows:
         # Create file access activity
@@ -204,7 +206,7 @@ def generate(target, configfile, database):
     rows = cur.execute(
         '''
         SELECT id, name, timestamp, process, argv
-        FROM executed_files;
+        FROM executed_paths;
         ''')
     for r_id, r_name, r_timestamp, r_process, r_argv in rows:
         argv = r_argv.split('\0')
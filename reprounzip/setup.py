@@ -34,7 +34,9 @@ setup(name='reprounzip',
       install_requires=req,
       extras_require={
           'all': ['reprounzip-vagrant>=1.0', 'reprounzip-docker>=1.0',
-                  'reprounzip-vistrails>=1.0']},
+                  'reprounzip-vistrails>=1.0'],
+          'zstd': ['zstandard>=0.15'],
+          'lz4': ['lz4']},
       description="Linux tool enabling reproducible experiments (unpacker)",
       author="Remi Rampin, Fernando Chirigati, Dennis Shasha, Juliana Freire",
       author_email='reprozip-users@vgc.poly.edu',
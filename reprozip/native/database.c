@@ -1,8 +1,10 @@
 #include <errno.h>
+#include <pthread.h>
 #include <signal.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/stat.h>
 #include <time.h>
 
 #include <sqlite3.h>
@@ -31,22 +33,686 @@ static sqlite3_uint64 gettime(void)
     return timestamp;
 }
 
+
+/* ********************
+ * Event queue
+ *
+ * The tracer doesn't write to SQLite itself: it pushes events into a ring
+ * buffer, which a writer thread drains into the database. This way the traced
+ * processes are not kept stopped while SQLite does its work.
+ *
+ * There is a single producer (the tracer) and a single consumer (the writer),
+ * so the ring only needs atomic head and tail counters. The mutex and
+ * condition variables are only used to sleep when the queue is empty (writer)
+ * or full (tracer).
+ *
+ * The writer thread must not call the log functions, which go through Python;
+ * errors are stored and reported by the tracer thread.
+ */
+
+#define EVENT_PROCESS   1
+#define EVENT_EXIT      2
+#define EVENT_FILE      3
+#define EVENT_EXEC      4
+#define EVENT_PATH      5
+#define EVENT_BLOB      6
+#define EVENT_PATH_STAT 7
+
+#define DB_NO_PARENT ((unsigned int)-2)
+
+struct DbEvent {
+    int type;
+    unsigned int process;   /* process (new process for EVENT_PROCESS) */
+    unsigned int parent;    /* EVENT_PROCESS */
+    int value;              /* is_thread, exit code, or file mode */
+    int is_dir;             /* EVENT_FILE */
+    sqlite3_uint64 timestamp;
+    unsigned int path;      /* file, binary for EVENT_EXEC, id for
+                             * EVENT_PATH and EVENT_BLOB */
+    unsigned int workingdir;    /* EVENT_EXEC */
+    unsigned int argv;          /* EVENT_EXEC, blob id */
+    unsigned int envp;          /* EVENT_EXEC, blob id */
+    const char *name;       /* EVENT_PATH and EVENT_BLOB, owned by the table */
+    size_t name_len;
+    /* lstat() of the path, for EVENT_PATH and EVENT_PATH_STAT */
+    int has_stat;
+    sqlite3_int64 dev, ino, size, mtime;
+    int mode;
+};
+
+/* Number of events in the ring, must be a power of 2 */
+#define QUEUE_SIZE      4096
+/* Maximum number of rows inserted by one statement */
+#define BATCH_ROWS      32
+
+static struct DbEvent queue[QUEUE_SIZE];
+static unsigned long queue_head = 0;    /* next event to write */
+static unsigned long queue_tail = 0;    /* next free slot */
+
+static pthread_t writer_thread;
+static pthread_mutex_t queue_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t queue_data = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t queue_space = PTHREAD_COND_INITIALIZER;
+static int writer_sleeping = 0;
+static int producer_sleeping = 0;
+static int writer_stop = 0;
+static int writer_failed = 0;
+static char writer_error[512];
+
+#define atomic_load(p) __atomic_load_n((p), __ATOMIC_SEQ_CST)
+#define atomic_store(p, v) __atomic_store_n((p), (v), __ATOMIC_SEQ_CST)
+
+
 static sqlite3 *db;
-static sqlite3_stmt *stmt_last_rowid;
 static sqlite3_stmt *stmt_insert_process;
+static sqlite3_stmt *stmt_insert_process_batch;
 static sqlite3_stmt *stmt_set_exitcode;
 static sqlite3_stmt *stmt_insert_file;
+static sqlite3_stmt *stmt_insert_file_batch;
 static sqlite3_stmt *stmt_insert_exec;
+static sqlite3_stmt *stmt_insert_exec_batch;
+static sqlite3_stmt *stmt_insert_path;
+static sqlite3_stmt *stmt_insert_path_batch;
+static sqlite3_stmt *stmt_update_path_stat;
+static sqlite3_stmt *stmt_insert_blob;
+static sqlite3_stmt *stmt_insert_blob_batch;
 
 static int run_id = -1;
+static unsigned int next_process_id;
+
+/* Binds the 5 parameters dev, ino, size, mode, mtime after position i */
+static int bind_stat(sqlite3_stmt *stmt, int i, const struct DbEvent *event)
+{
+    if(event->has_stat)
+    {
+        check(sqlite3_bind_int64(stmt, i + 1, event->dev));
+        check(sqlite3_bind_int64(stmt, i + 2, event->ino));
+        check(sqlite3_bind_int64(stmt, i + 3, event->size));
+        check(sqlite3_bind_int(stmt, i + 4, event->mode));
+        check(sqlite3_bind_int64(stmt, i + 5, event->mtime));
+    }
+    else
+    {
+        int j;
+        for(j = 1; j <= 5; ++j)
+            check(sqlite3_bind_null(stmt, i + j));
+    }
+    return 0;
+
+sqlerror:
+    return -1;
+}
+
+static int bind_event(sqlite3_stmt *stmt, int i, const struct DbEvent *event)
+{
+    switch(event->type)
+    {
+    case EVENT_PROCESS:
+        check(sqlite3_bind_int(stmt, i + 1, event->process));
+        check(sqlite3_bind_int(stmt, i + 2, run_id));
+        if(event->parent == DB_NO_PARENT)
+        {
+            check(sqlite3_bind_null(stmt, i + 3));
+        }
+        else
+        {
+            check(sqlite3_bind_int(stmt, i + 3, event->parent));
+        }
+        /* This assumes that we won't go over 2^32 seconds (~135 years) */
+        check(sqlite3_bind_int64(stmt, i + 4, event->timestamp));
+        check(sqlite3_bind_int(stmt, i + 5, event->value?1:0));
+        return 5;
+    case EVENT_FILE:
+        check(sqlite3_bind_int(stmt, i + 1, run_id));
+        check(sqlite3_bind_int(stmt, i + 2, event->path));
+        check(sqlite3_bind_int64(stmt, i + 3, event->timestamp));
+        check(sqlite3_bind_int(stmt, i + 4, event->value));
+        check(sqlite3_bind_int(stmt, i + 5, event->is_dir));
+        check(sqlite3_bind_int(stmt, i + 6, event->process));
+        return 6;
+    case EVENT_EXEC:
+        check(sqlite3_bind_int(stmt, i + 1, run_id));
+        check(sqlite3_bind_int(stmt, i + 2, event->path));
+        check(sqlite3_bind_int64(stmt, i + 3, event->timestamp));
+        check(sqlite3_bind_int(stmt, i + 4, event->process));
+        check(sqlite3_bind_int(stmt, i + 5, event->argv));
+        check(sqlite3_bind_int(stmt, i + 6, event->envp));
+        check(sqlite3_bind_int(stmt, i + 7, event->workingdir));
+        return 7;
+    case EVENT_PATH:
+        check(sqlite3_bind_int(stmt, i + 1, event->path));
+        check(sqlite3_bind_text(stmt, i + 2, event->name, event->name_len,
+                                SQLITE_STATIC));
+        if(bind_stat(stmt, i + 2, event) < 0)
+            goto sqlerror;
+        return 7;
+    case EVENT_PATH_STAT:
+        if(bind_stat(stmt, i, event) < 0)
+            goto sqlerror;
+        check(sqlite3_bind_int(stmt, i + 6, event->path));
+        return 6;
+    case EVENT_BLOB:
+        check(sqlite3_bind_int(stmt, i + 1, event->path));
+        check(sqlite3_bind_text(stmt, i + 2, event->name, event->name_len,
+                                SQLITE_STATIC));
+        return 2;
+    case EVENT_EXIT:
+        check(sqlite3_bind_int(stmt, i + 1, event->value));
+        check(sqlite3_bind_int(stmt, i + 2, event->process));
+        return 2;
+    }
+
+sqlerror:
+    return -1;
+}
+
+static int step_statement(sqlite3_stmt *stmt)
+{
+    int ret = sqlite3_step(stmt);
+    sqlite3_reset(stmt);
+    return (ret == SQLITE_DONE)?0:-1;
+}
+
+/* Writes events from the queue, starting at position head, all of the same
+ * type. Returns the number of events written, or -1 */
+static int writer_write_run(unsigned long head, unsigned long tail)
+{
+    const struct DbEvent *first = &queue[head & (QUEUE_SIZE - 1)];
+    sqlite3_stmt *single, *batch;
+    unsigned int nb = 1;
+
+    switch(first->type)
+    {
+    case EVENT_PROCESS:
+        single = stmt_insert_process;
+        batch = stmt_insert_process_batch;
+        break;
+    case EVENT_FILE:
+        single = stmt_insert_file;
+        batch = stmt_insert_file_batch;
+        break;
+    case EVENT_EXEC:
+        single = stmt_insert_exec;
+        batch = stmt_insert_exec_batch;
+        break;
+    case EVENT_PATH:
+        single = stmt_insert_path;
+        batch = stmt_insert_path_batch;
+        break;
+    case EVENT_BLOB:
+        single = stmt_insert_blob;
+        batch = stmt_insert_blob_batch;
+        break;
+    case EVENT_PATH_STAT:
+        if(bind_event(stmt_update_path_stat, 0, first) < 0
+         || step_statement(stmt_update_path_stat) != 0)
+            return -1;
+        return 1;
+    default: /* EVENT_EXIT */
+        if(bind_event(stmt_set_exitcode, 0, first) < 0
+         || step_statement(stmt_set_exitcode) != 0)
+            return -1;
+        return 1;
+    }
+
+    while(nb < BATCH_ROWS && head + nb != tail
+     && queue[(head + nb) & (QUEUE_SIZE - 1)].type == first->type)
+        ++nb;
+
+    if(nb == BATCH_ROWS)
+    {
+        /* Multi-row insert */
+        unsigned int i;
+        int param = 0;
+        for(i = 0; i < nb; ++i)
+        {
+            int n = bind_event(batch, param,
+                               &queue[(head + i) & (QUEUE_SIZE - 1)]);
+            if(n < 0)
+                return -1;
+            param += n;
+        }
+        if(step_statement(batch) != 0)
+            return -1;
+    }
+    else
+    {
+        unsigned int i;
+        for(i = 0; i < nb; ++i)
+        {
+            if(bind_event(single, 0,
+                          &queue[(head + i) & (QUEUE_SIZE - 1)]) < 0
+             || step_statement(single) != 0)
+                return -1;
+        }
+    }
+    return nb;
+}
+
+static void writer_wait(unsigned long head)
+{
+    pthread_mutex_lock(&queue_lock);
+    atomic_store(&writer_sleeping, 1);
+    if(atomic_load(&queue_tail) == head && !atomic_load(&writer_stop))
+        pthread_cond_wait(&queue_data, &queue_lock);
+    atomic_store(&writer_sleeping, 0);
+    pthread_mutex_unlock(&queue_lock);
+}
+
+static void *writer_main(void *arg)
+{
+    unsigned long head = queue_head;
+    (void)arg;
+    for(;;)
+    {
+        unsigned long tail = atomic_load(&queue_tail);
+        if(head == tail)
+        {
+            /* The tracer sets writer_stop after queueing its last event */
+            if(atomic_load(&writer_stop))
+            {
+                if(atomic_load(&queue_tail) == head)
+                    break;
+                continue;
+            }
+            writer_wait(head);
+            continue;
+        }
+        while(head != tail)
+        {
+            int nb = 1;
+            if(!atomic_load(&writer_failed))
+            {
+                nb = writer_write_run(head, tail);
+                if(nb < 0)
+                {
+                    /* Keep consuming events so the tracer doesn't block; it
+                     * will see the error on its next write */
+                    snprintf(writer_error, sizeof(writer_error), "%s",
+                             sqlite3_errmsg(db));
+                    atomic_store(&writer_failed, 1);
+                    nb = 1;
+                }
+            }
+            head += nb;
+            atomic_store(&queue_head, head);
+            if(atomic_load(&producer_sleeping))
+            {
+                pthread_mutex_lock(&queue_lock);
+                pthread_cond_signal(&queue_space);
+                pthread_mutex_unlock(&queue_lock);
+            }
+        }
+    }
+    return NULL;
+}
+
+static int queue_check_writer(void)
+{
+    static int reported = 0;
+    if(atomic_load(&writer_failed))
+    {
+        if(!reported)
+        {
+            log_critical(0, "sqlite3 error writing trace: %s", writer_error);
+            reported = 1;
+        }
+        return -1;
+    }
+    return 0;
+}
+
+static int queue_is_full(unsigned long tail)
+{
+    return tail - atomic_load(&queue_head) >= QUEUE_SIZE;
+}
+
+/* Queues an event for the writer thread */
+static int queue_push(const struct DbEvent *event)
+{
+    unsigned long tail = queue_tail;
+    if(queue_check_writer() != 0)
+        return -1;
+    if(queue_is_full(tail))
+    {
+        log_debug(0, "waiting for the database writer to catch up");
+        do
+        {
+            pthread_mutex_lock(&queue_lock);
+            atomic_store(&producer_sleeping, 1);
+            if(queue_is_full(tail))
+                pthread_cond_wait(&queue_space, &queue_lock);
+            atomic_store(&producer_sleeping, 0);
+            pthread_mutex_unlock(&queue_lock);
+        } while(queue_is_full(tail));
+        if(queue_check_writer() != 0)
+            return -1;
+    }
+    queue[tail & (QUEUE_SIZE - 1)] = *event;
+    atomic_store(&queue_tail, tail + 1);
+    if(atomic_load(&writer_sleeping))
+    {
+        pthread_mutex_lock(&queue_lock);
+        pthread_cond_signal(&queue_data);
+        pthread_mutex_unlock(&queue_lock);
+    }
+    return 0;
+}
+
+/* Stops the writer thread once it has written all the queued events */
+static void writer_finish(void)
+{
+    pthread_mutex_lock(&queue_lock);
+    atomic_store(&writer_stop, 1);
+    pthread_cond_signal(&queue_data);
+    pthread_mutex_unlock(&queue_lock);
+    pthread_join(writer_thread, NULL);
+    atomic_store(&writer_stop, 0);
+}
+
+
+
+/* ********************
+ * Interning
+ *
+ * Paths are stored once in the paths table, and argv and environment arrays
+ * once in the blobs table; rows reference them by id. The ids are assigned
+ * here, using an open-addressing hash table of the values seen so far, so that
+ * duplicates never reach SQLite.
+ *
+ * The tables own the values, and are only freed once the writer thread is
+ * done; EVENT_PATH and EVENT_BLOB events point into them.
+ *
+ * The metadata of a path (lstat()) is recorded by the tracer when the path is
+ * first used in the run, with the path. Paths from previous runs (--continue)
+ * get their metadata updated the first time they are used in this run.
+ */
+
+struct InternEntry {
+    char *data;
+    size_t len;
+    unsigned int hash;
+    unsigned int id;        /* 0 for empty slots */
+    int seen;               /* paths: metadata recorded during this run */
+};
+
+struct InternTable {
+    struct InternEntry *entries;
+    size_t size;            /* power of 2 */
+    size_t count;
+    unsigned int next_id;
+    int event_type;
+};
+
+static struct InternTable path_table = {NULL, 0, 0, 1, EVENT_PATH};
+static struct InternTable blob_table = {NULL, 0, 0, 1, EVENT_BLOB};
+
+static unsigned int hash_bytes(const char *data, size_t len)
+{
+    /* FNV-1a */
+    unsigned int hash = 2166136261U;
+    const unsigned char *p = (const unsigned char*)data;
+    const unsigned char *end = p + len;
+    for(; p != end; ++p)
+    {
+        hash ^= *p;
+        hash *= 16777619U;
+    }
+    return hash;
+}
+
+static struct InternEntry *intern_table_insert(
+        struct InternTable *table, const struct InternEntry *entry)
+{
+    size_t i = entry->hash & (table->size - 1);
+    while(table->entries[i].id != 0)
+        i = (i + 1) & (table->size - 1);
+    table->entries[i] = *entry;
+    return &table->entries[i];
+}
+
+/* Adds a value to the table, which takes ownership of it, keeping the load
+ * factor under 1/2. Returns the new entry. */
+static struct InternEntry *intern_table_add(struct InternTable *table,
+                                            char *data, size_t len,
+                                            unsigned int hash, unsigned int id)
+{
+    struct InternEntry entry;
+    if((table->count + 1) * 2 > table->size)
+    {
+        struct InternEntry *old_entries = table->entries;
+        size_t old_size = table->size;
+        size_t i;
+        table->size = (old_size == 0)?1024:old_size * 2;
+        table->entries = calloc(table->size, sizeof(*table->entries));
+        for(i = 0; i < old_size; ++i)
+            if(old_entries[i].id != 0)
+                intern_table_insert(table, &old_entries[i]);
+        free(old_entries);
+    }
+    entry.data = data;
+    entry.len = len;
+    entry.hash = hash;
+    entry.id = id;
+    entry.seen = 0;
+    ++table->count;
+    if(id >= table->next_id)
+        table->next_id = id + 1;
+    return intern_table_insert(table, &entry);
+}
+
+static void intern_table_free(struct InternTable *table)
+{
+    size_t i;
+    for(i = 0; i < table->size; ++i)
+        free(table->entries[i].data);
+    free(table->entries);
+    table->entries = NULL;
+    table->size = 0;
+    table->count = 0;
+    table->next_id = 1;
+}
+
+/* Fills in the metadata of a path in an event */
+static void event_stat(struct DbEvent *event, const char *path)
+{
+    struct stat st;
+    if(lstat(path, &st) == 0)
+    {
+        event->has_stat = 1;
+        event->dev = st.st_dev;
+        event->ino = st.st_ino;
+        event->size = st.st_size;
+        event->mode = st.st_mode;
+        event->mtime = st.st_mtim.tv_sec;
+        event->mtime = event->mtime * 1000000000 + st.st_mtim.tv_nsec;
+    }
+    else
+        event->has_stat = 0;
+}
+
+/* Gets the id of a value, queuing its insertion if it is new.
+ * Takes ownership of data, which must be malloc'd. */
+static int db_intern(struct InternTable *table, char *data, size_t len,
+                     unsigned int *id)
+{
+    unsigned int hash = hash_bytes(data, len);
+    struct DbEvent event;
+    if(table->size > 0)
+    {
+        size_t i = hash & (table->size - 1);
+        while(table->entries[i].id != 0)
+        {
+            struct InternEntry *entry = &table->entries[i];
+            if(entry->hash == hash && entry->len == len
+             && memcmp(entry->data, data, len) == 0)
+            {
+                free(data);
+                *id = entry->id;
+                if(table->event_type != EVENT_PATH || entry->seen)
+                    return 0;
+                /* From a previous run: record its current metadata */
+                entry->seen = 1;
+                memset(&event, 0, sizeof(event));
+                event.type = EVENT_PATH_STAT;
+                event.path = entry->id;
+                event_stat(&event, entry->data);
+                return queue_push(&event);
+            }
+            i = (i + 1) & (table->size - 1);
+        }
+    }
+    memset(&event, 0, sizeof(event));
+    event.type = table->event_type;
+    event.path = *id = table->next_id;
+    event.name = data;
+    event.name_len = len;
+    if(table->event_type == EVENT_PATH)
+        event_stat(&event, data);
+    intern_table_add(table, data, len, hash, *id)->seen = 1;
+    return queue_push(&event);
+}
+
+/* Reads the existing values from the database into the table */
+static int intern_table_load(struct InternTable *table, const char *sql)
+{
+    int ret;
+    sqlite3_stmt *stmt;
+    if((ret = sqlite3_prepare_v2(db, sql, -1, &stmt, NULL)) != SQLITE_OK)
+        return ret;
+    while((ret = sqlite3_step(stmt)) == SQLITE_ROW)
+    {
+        unsigned int id = sqlite3_column_int(stmt, 0);
+        const char *value = (const char*)sqlite3_column_text(stmt, 1);
+        size_t len = sqlite3_column_bytes(stmt, 1);
+        char *copy = malloc(len + 1);
+        memcpy(copy, value, len + 1);
+        intern_table_add(table, copy, len, hash_bytes(copy, len), id);
+    }
+    sqlite3_finalize(stmt);
+    return (ret == SQLITE_DONE)?SQLITE_OK:ret;
+}
+
+static int db_intern_path(const char *name, unsigned int *id)
+{
+    size_t len = strlen(name);
+    char *copy = malloc(len + 1);
+    memcpy(copy, name, len + 1);
+    return db_intern(&path_table, copy, len, id);
+}
+
+
+/* ********************
+ * Duplicate file accesses
+ *
+ * When deduplication is on, a file access is only recorded the first time its
+ * path is accessed with the same mode during the run, which is all that
+ * get_files() uses. The other accesses are counted, and the count is written
+ * to the counters table.
+ */
+
+static int dedup_files = 0;
+static sqlite3_uint64 *access_set = NULL;  /* path << 32 | mode, 0 if empty */
+static size_t access_set_size = 0;  /* power of 2 */
+static size_t access_count = 0;
+static sqlite3_uint64 suppressed_accesses = 0;
+
+static size_t access_set_slot(sqlite3_uint64 key)
+{
+    size_t i = (size_t)((key * 0x9E3779B97F4A7C15ULL) >> 32)
+        & (access_set_size - 1);
+    while(access_set[i] != 0 && access_set[i] != key)
+        i = (i + 1) & (access_set_size - 1);
+    return i;
+}
+
+/* Adds an access to the set, returns 0 if it was already there */
+static int access_set_add(unsigned int path, unsigned int mode)
+{
+    /* Path ids start at 1, so a key is never 0 */
+    sqlite3_uint64 key = ((sqlite3_uint64)path << 32) | mode;
+    size_t i;
+    if((access_count + 1) * 2 > access_set_size)
+    {
+        sqlite3_uint64 *old_set = access_set;
+        size_t old_size = access_set_size;
+        access_set_size = (old_size == 0)?1024:old_size * 2;
+        access_set = calloc(access_set_size, sizeof(*access_set));
+        for(i = 0; i < old_size; ++i)
+            if(old_set[i] != 0)
+                access_set[access_set_slot(old_set[i])] = old_set[i];
+        free(old_set);
+    }
+    i = access_set_slot(key);
+    if(access_set[i] == key)
+        return 0;
+    access_set[i] = key;
+    ++access_count;
+    return 1;
+}
+
+static void access_set_free(void)
+{
+    free(access_set);
+    access_set = NULL;
+    access_set_size = 0;
+    access_count = 0;
+    suppressed_accesses = 0;
+}
+
+
+/* ********************
+ * Database
+ */
+
+static int prepare_insert(sqlite3_stmt **stmt, const char *insert,
+                          const char *row, unsigned int rows)
+{
+    size_t insert_len = strlen(insert), row_len = strlen(row);
+    char *sql = malloc(insert_len + rows * (row_len + 2) + 1);
+    char *p = sql;
+    unsigned int i;
+    int ret;
+    memcpy(p, insert, insert_len);
+    p += insert_len;
+    for(i = 0; i < rows; ++i)
+    {
+        if(i > 0)
+        {
+            *p++ = ',';
+            *p++ = ' ';
+        }
+        memcpy(p, row, row_len);
+        p += row_len;
+    }
+    *p = '\0';
+    ret = sqlite3_prepare_v2(db, sql, -1, stmt, NULL);
+    free(sql);
+    return ret;
+}
 
-int db_init(const char *filename)
+int db_init(const char *filename, int dedup)
 {
     int tables_exist;
 
+    dedup_files = dedup;
+
     check(sqlite3_open(filename, &db));
     log_debug(0, "database file opened: %s", filename);
 
+    /* The connection only lives while tracing, and the whole trace is a
+     * single transaction: don't wait for the disk when spilling the cache */
+    {
+        const char *sql[] = {
+            "PRAGMA page_size=4096;",
+            "PRAGMA cache_size=-16384;",
+            "PRAGMA synchronous=OFF;",
+        };
+        size_t i;
+        for(i = 0; i < count(sql); ++i)
+            check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
+    }
+
     check(sqlite3_exec(db, "BEGIN IMMEDIATE;", NULL, NULL, NULL))
 
     {
@@ -67,16 +733,30 @@ int db_init(const char *filename)
                 found |= 0x02;
             else if(strcmp("executed_files", colname) == 0)
                 found |= 0x04;
+            else if(strcmp("paths", colname) == 0)
+                found |= 0x08;
+            else if(strcmp("blobs", colname) == 0)
+                found |= 0x10;
+            else if(strcmp("counters", colname) == 0)
+                found |= 0x20;
             else
                 goto wrongschema;
         }
         if(found == 0x00)
             tables_exist = 0;
-        else if(found == 0x07)
+        else if(found == 0x3F)
             tables_exist = 1;
+        else if(found == 0x07 || found == 0x0F || found == 0x1F)
+        {
+            sqlite3_finalize(stmt_get_tables);
+            log_critical(0, "database was created by an older version of "
+                         "reprozip and can't be appended to");
+            return -1;
+        }
         else
         {
         wrongschema:
+            sqlite3_finalize(stmt_get_tables);
             log_critical(0, "database schema is wrong");
             return -1;
         }
@@ -97,10 +777,23 @@ int db_init(const char *filename)
             "    exitcode INTEGER"
             "    );",
             "CREATE INDEX proc_parent_idx ON processes(parent);",
+            "CREATE TABLE paths("
+            "    id INTEGER NOT NULL PRIMARY KEY,"
+            "    name TEXT NOT NULL,"
+            "    dev INTEGER,"
+            "    ino INTEGER,"
+            "    size INTEGER,"
+            "    mode INTEGER,"
+            "    mtime INTEGER"
+            "    );",
+            "CREATE TABLE blobs("
+            "    id INTEGER NOT NULL PRIMARY KEY,"
+            "    data TEXT NOT NULL"
+            "    );",
             "CREATE TABLE opened_files("
             "    id INTEGER NOT NULL PRIMARY KEY,"
             "    run_id INTEGER NOT NULL,"
-            "    name TEXT NOT NULL,"
+            "    path INTEGER NOT NULL,"
             "    timestamp INTEGER NOT NULL,"
             "    mode INTEGER NOT NULL,"
             "    is_directory BOOLEAN NOT NULL,"
@@ -109,25 +802,33 @@ int db_init(const char *filename)
             "CREATE INDEX open_proc_idx ON opened_files(process);",
             "CREATE TABLE executed_files("
             "    id INTEGER NOT NULL PRIMARY KEY,"
-            "    name TEXT NOT NULL,"
+            "    path INTEGER NOT NULL,"
             "    run_id INTEGER NOT NULL,"
             "    timestamp INTEGER NOT NULL,"
             "    process INTEGER NOT NULL,"
-            "    argv TEXT NOT NULL,"
-            "    envp TEXT NOT NULL,"
-            "    workingdir TEXT NOT NULL"
+            "    argv INTEGER NOT NULL,"
+            "    envp INTEGER NOT NULL,"
+            "    workingdir INTEGER NOT NULL"
             "    );",
             "CREATE INDEX exec_proc_idx ON executed_files(process);",
+            "CREATE TABLE counters("
+            "    run_id INTEGER NOT NULL,"
+            "    name TEXT NOT NULL,"
+            "    value INTEGER NOT NULL"
+            "    );",
         };
         size_t i;
         for(i = 0; i < count(sql); ++i)
             check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
     }
 
-    /* Get the first unused run_id */
+    /* Get the first unused run_id, and process id: process ids are assigned
+     * here since the rows are inserted later by the writer thread */
     {
         sqlite3_stmt *stmt_get_run_id;
-        const char *sql = "SELECT max(run_id) + 1 FROM processes;";
+        const char *sql = ""
+                "SELECT max(run_id) + 1, coalesce(max(id), 0) + 1 "
+                "FROM processes;";
         check(sqlite3_prepare_v2(db, sql, -1, &stmt_get_run_id, NULL));
         if(sqlite3_step(stmt_get_run_id) != SQLITE_ROW)
         {
@@ -135,6 +836,7 @@ int db_init(const char *filename)
             goto sqlerror;
         }
         run_id = sqlite3_column_int(stmt_get_run_id, 0);
+        next_process_id = sqlite3_column_int(stmt_get_run_id, 1);
         if(sqlite3_step(stmt_get_run_id) != SQLITE_DONE)
         {
             sqlite3_finalize(stmt_get_run_id);
@@ -144,17 +846,19 @@ int db_init(const char *filename)
     }
     log_debug(0, "This is run %d", run_id);
 
-    {
-        const char *sql = ""
-                "SELECT last_insert_rowid()";
-        check(sqlite3_prepare_v2(db, sql, -1, &stmt_last_rowid, NULL));
-    }
+    /* Load the paths and blobs from previous runs */
+    check(intern_table_load(&path_table, "SELECT id, name FROM paths;"));
+    check(intern_table_load(&blob_table, "SELECT id, data FROM blobs;"));
 
     {
-        const char *sql = ""
-                "INSERT INTO processes(run_id, parent, timestamp, is_thread)"
-                "VALUES(?, ?, ?, ?)";
-        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_process, NULL));
+        const char *insert = ""
+                "INSERT INTO processes(id, run_id, parent, timestamp, "
+                "        is_thread)"
+                "VALUES";
+        const char *row = "(?, ?, ?, ?, ?)";
+        check(prepare_insert(&stmt_insert_process, insert, row, 1));
+        check(prepare_insert(&stmt_insert_process_batch, insert, row,
+                             BATCH_ROWS));
     }
 
     {
@@ -165,19 +869,59 @@ int db_init(const char *filename)
     }
 
     {
-        const char *sql = ""
-                "INSERT INTO opened_files(run_id, name, timestamp, "
+        const char *insert = ""
+                "INSERT INTO opened_files(run_id, path, timestamp, "
                 "        mode, is_directory, process)"
-                "VALUES(?, ?, ?, ?, ?, ?)";
-        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_file, NULL));
+                "VALUES";
+        const char *row = "(?, ?, ?, ?, ?, ?)";
+        check(prepare_insert(&stmt_insert_file, insert, row, 1));
+        check(prepare_insert(&stmt_insert_file_batch, insert, row,
+                             BATCH_ROWS));
+    }
+
+    {
+        const char *insert = ""
+                "INSERT INTO executed_files(run_id, path, timestamp, "
+                "        process, argv, envp, workingdir)"
+                "VALUES";
+        const char *row = "(?, ?, ?, ?, ?, ?, ?)";
+        check(prepare_insert(&stmt_insert_exec, insert, row, 1));
+        check(prepare_insert(&stmt_insert_exec_batch, insert, row,
+                             BATCH_ROWS));
+    }
+
+    {
+        const char *insert = ""
+                "INSERT INTO paths(id, name, dev, ino, size, mode, mtime)"
+                "VALUES";
+        const char *row = "(?, ?, ?, ?, ?, ?, ?)";
+        check(prepare_insert(&stmt_insert_path, insert, row, 1));
+        check(prepare_insert(&stmt_insert_path_batch, insert, row,
+                             BATCH_ROWS));
     }
 
     {
         const char *sql = ""
-                "INSERT INTO executed_files(run_id, name, timestamp, process, "
-                "        argv, envp, workingdir)"
-                "VALUES(?, ?, ?, ?, ?, ?, ?)";
-        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_exec, NULL));
+                "UPDATE paths SET dev=?, ino=?, size=?, mode=?, mtime=? "
+                "WHERE id=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_update_path_stat, NULL));
+    }
+
+    {
+        const char *insert = "INSERT INTO blobs(id, data) VALUES";
+        const char *row = "(?, ?)";
+        check(prepare_insert(&stmt_insert_blob, insert, row, 1));
+        check(prepare_insert(&stmt_insert_blob_batch, insert, row,
+                             BATCH_ROWS));
+    }
+
+    atomic_store(&writer_failed, 0);
+    if(pthread_create(&writer_thread, NULL, writer_main, NULL) != 0)
+    {
+        /* LCOV_EXCL_START : Creating a thread shouldn't fail */
+        log_critical(0, "couldn't start database writer thread");
+        return -1;
+        /* LCOV_EXCL_END */
     }
 
     return 0;
@@ -189,66 +933,88 @@ sqlerror:
 
 int db_close(int rollback)
 {
+    writer_finish();
+    if(queue_check_writer() != 0)
+        rollback = 1;
     if(rollback)
     {
         check(sqlite3_exec(db, "ROLLBACK;", NULL, NULL, NULL));
     }
     else
     {
+        if(dedup_files)
+        {
+            sqlite3_stmt *stmt_counter;
+            const char *sql = ""
+                    "INSERT INTO counters(run_id, name, value) "
+                    "VALUES(?, 'suppressed_file_accesses', ?);";
+            check(sqlite3_prepare_v2(db, sql, -1, &stmt_counter, NULL));
+            if(sqlite3_bind_int(stmt_counter, 1, run_id) != SQLITE_OK
+             || sqlite3_bind_int64(stmt_counter, 2,
+                                   suppressed_accesses) != SQLITE_OK
+             || sqlite3_step(stmt_counter) != SQLITE_DONE)
+            {
+                sqlite3_finalize(stmt_counter);
+                goto sqlerror;
+            }
+            sqlite3_finalize(stmt_counter);
+            log_info(0, "%llu duplicate file accesses were not recorded",
+                     (unsigned long long)suppressed_accesses);
+        }
+        /* Indexes used to build the file list; building them once is
+         * cheaper than updating them on every insert */
+        {
+            const char *sql[] = {
+                "CREATE INDEX IF NOT EXISTS open_run_path_idx "
+                "ON opened_files(run_id, path, mode, timestamp);",
+                "CREATE INDEX IF NOT EXISTS exec_run_path_idx "
+                "ON executed_files(run_id, path, timestamp);",
+            };
+            size_t i;
+            for(i = 0; i < count(sql); ++i)
+                check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
+        }
         check(sqlite3_exec(db, "COMMIT;", NULL, NULL, NULL));
     }
     log_debug(0, "database file closed%s", rollback?" (rolled back)":"");
-    check(sqlite3_finalize(stmt_last_rowid));
     check(sqlite3_finalize(stmt_insert_process));
+    check(sqlite3_finalize(stmt_insert_process_batch));
     check(sqlite3_finalize(stmt_set_exitcode));
     check(sqlite3_finalize(stmt_insert_file));
+    check(sqlite3_finalize(stmt_insert_file_batch));
     check(sqlite3_finalize(stmt_insert_exec));
+    check(sqlite3_finalize(stmt_insert_exec_batch));
+    check(sqlite3_finalize(stmt_insert_path));
+    check(sqlite3_finalize(stmt_insert_path_batch));
+    check(sqlite3_finalize(stmt_update_path_stat));
+    check(sqlite3_finalize(stmt_insert_blob));
+    check(sqlite3_finalize(stmt_insert_blob_batch));
+    intern_table_free(&path_table);
+    intern_table_free(&blob_table);
+    access_set_free();
     check(sqlite3_close(db));
     run_id = -1;
-    return 0;
+    return atomic_load(&writer_failed)?-1:0;
 
 sqlerror:
     log_critical(0, "sqlite3 error on exit: %s", sqlite3_errmsg(db));
     return -1;
 }
 
-#define DB_NO_PARENT ((unsigned int)-2)
-
 int db_add_process(unsigned int *id, unsigned int parent_id,
                    const char *working_dir, int is_thread)
 {
-    check(sqlite3_bind_int(stmt_insert_process, 1, run_id));
-    if(parent_id == DB_NO_PARENT)
-    {
-        check(sqlite3_bind_null(stmt_insert_process, 2));
-    }
-    else
-    {
-        check(sqlite3_bind_int(stmt_insert_process, 2, parent_id));
-    }
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_process, 3, gettime()));
-    check(sqlite3_bind_int(stmt_insert_process, 4, is_thread?1:0));
-
-    if(sqlite3_step(stmt_insert_process) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_process);
-
-    /* Get id */
-    if(sqlite3_step(stmt_last_rowid) != SQLITE_ROW)
-        goto sqlerror;
-    *id = sqlite3_column_int(stmt_last_rowid, 0);
-    if(sqlite3_step(stmt_last_rowid) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_last_rowid);
+    struct DbEvent event;
+    memset(&event, 0, sizeof(event));
+    event.type = EVENT_PROCESS;
+    event.process = *id = next_process_id++;
+    event.parent = parent_id;
+    event.value = is_thread;
+    event.timestamp = gettime();
+    if(queue_push(&event) != 0)
+        return -1;
 
     return db_add_file_open(*id, working_dir, FILE_WDIR, 1);
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting process: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
 }
 
 int db_add_first_process(unsigned int *id, const char *working_dir)
@@ -258,43 +1024,32 @@ int db_add_first_process(unsigned int *id, const char *working_dir)
 
 int db_add_exit(unsigned int id, int exitcode)
 {
-    check(sqlite3_bind_int(stmt_set_exitcode, 1, exitcode));
-    check(sqlite3_bind_int(stmt_set_exitcode, 2, id));
-
-    if(sqlite3_step(stmt_set_exitcode) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_set_exitcode);
-
-    return 0;
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error setting exitcode: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+    struct DbEvent event;
+    memset(&event, 0, sizeof(event));
+    event.type = EVENT_EXIT;
+    event.process = id;
+    event.value = exitcode;
+    return queue_push(&event);
 }
 
 int db_add_file_open(unsigned int process, const char *name,
                      unsigned int mode, int is_dir)
 {
-    check(sqlite3_bind_int(stmt_insert_file, 1, run_id));
-    check(sqlite3_bind_text(stmt_insert_file, 2, name, -1, SQLITE_TRANSIENT));
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_file, 3, gettime()));
-    check(sqlite3_bind_int(stmt_insert_file, 4, mode));
-    check(sqlite3_bind_int(stmt_insert_file, 5, is_dir));
-    check(sqlite3_bind_int(stmt_insert_file, 6, process));
-
-    if(sqlite3_step(stmt_insert_file) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_file);
-    return 0;
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting file: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+    struct DbEvent event;
+    memset(&event, 0, sizeof(event));
+    event.type = EVENT_FILE;
+    event.process = process;
+    if(db_intern_path(name, &event.path) != 0)
+        return -1;
+    if(dedup_files && !access_set_add(event.path, mode))
+    {
+        ++suppressed_accesses;
+        return 0;
+    }
+    event.timestamp = gettime();
+    event.value = mode;
+    event.is_dir = is_dir;
+    return queue_push(&event);
 }
 
 static char *strarray2nulsep(const char *const *array, size_t *plen)
@@ -312,7 +1067,7 @@ static char *strarray2nulsep(const char *const *array, size_t *plen)
     {
         const char *const *a = array;
         char *p;
-        p = list = malloc(len);
+        p = list = malloc(len + 1);  /* not NULL if empty */
         while(*a)
         {
             const char *s = *a;
@@ -330,37 +1085,22 @@ int db_add_exec(unsigned int process, const char *binary,
                 const char *const *argv, const char *const *envp,
                 const char *workingdir)
 {
-    check(sqlite3_bind_int(stmt_insert_exec, 1, run_id));
-    check(sqlite3_bind_text(stmt_insert_exec, 2, binary,
-                            -1, SQLITE_TRANSIENT));
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_exec, 3, gettime()));
-    check(sqlite3_bind_int(stmt_insert_exec, 4, process));
-    {
-        size_t len;
-        char *arglist = strarray2nulsep(argv, &len);
-        check(sqlite3_bind_text(stmt_insert_exec, 5, arglist, len,
-                                SQLITE_TRANSIENT));
-        free(arglist);
-    }
+    struct DbEvent event;
+    memset(&event, 0, sizeof(event));
+    event.type = EVENT_EXEC;
+    event.process = process;
+    if(db_intern_path(binary, &event.path) != 0
+     || db_intern_path(workingdir, &event.workingdir) != 0)
+        return -1;
+    event.timestamp = gettime();
     {
         size_t len;
-        char *envlist = strarray2nulsep(envp, &len);
-        check(sqlite3_bind_text(stmt_insert_exec, 6, envlist, len,
-                                SQLITE_TRANSIENT));
-        free(envlist);
+        char *list = strarray2nulsep(argv, &len);
+        if(db_intern(&blob_table, list, len, &event.argv) != 0)
+            return -1;
+        list = strarray2nulsep(envp, &len);
+        if(db_intern(&blob_table, list, len, &event.envp) != 0)
+            return -1;
     }
-    check(sqlite3_bind_text(stmt_insert_exec, 7, workingdir,
-                            -1, SQLITE_TRANSIENT));
-
-    if(sqlite3_step(stmt_insert_exec) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_exec);
-    return 0;
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting exec: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+    return queue_push(&event);
 }
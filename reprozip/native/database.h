@@ -7,7 +7,7 @@
 #define FILE_STAT   0x08  /* File is stat()d (only metadata is read) */
 #define FILE_LINK   0x10  /* The link itself is accessed, no dereference */
 
-int db_init(const char *filename);
+int db_init(const char *filename, int dedup);
 int db_close(int rollback);
 int db_add_process(unsigned int *id, unsigned int parent_id,
                    const char *working_dir, int is_thread);
@@ -3,7 +3,9 @@
 #include <stdlib.h>
 #include <string.h>
 #include <sys/ptrace.h>
+#include <sys/syscall.h>
 #include <sys/types.h>
+#include <sys/uio.h>
 #include <unistd.h>
 
 #include "config.h"
@@ -29,6 +31,97 @@ static long tracee_getword(pid_t tid, const void *addr)
     return res;
 }
 
+/* Whether process_vm_readv() can be used; cleared if the kernel doesn't
+ * support it, then every read goes through PTRACE_PEEKDATA */
+static int vm_readv_works = 1;
+
+static size_t page_size = 0;
+
+/* Number of bytes from addr to the end of its page */
+static size_t page_remaining(uintptr_t addr)
+{
+    if(page_size == 0)
+    {
+        long res = sysconf(_SC_PAGESIZE);
+        page_size = (res > 0)?(size_t)res:4096;
+    }
+    return page_size - addr % page_size;
+}
+
+/* Reads a block of memory with a single process_vm_readv() call. Returns the
+ * number of bytes read, which might be less than size (or 0) if part of the
+ * range is not mapped, or if the call is not available */
+static size_t tracee_bulkread(pid_t tid, char *dst, const char *src,
+                              size_t size)
+{
+#ifdef SYS_process_vm_readv
+    struct iovec local, remote;
+    long res;
+    if(!vm_readv_works || size == 0)
+        return 0;
+    local.iov_base = dst;
+    local.iov_len = size;
+    remote.iov_base = (void*)src;
+    remote.iov_len = size;
+    res = syscall(SYS_process_vm_readv, tid, &local, 1, &remote, 1, 0);
+    if(res < 0)
+    {
+        if(errno == ENOSYS)
+        {
+            /* LCOV_EXCL_START : process_vm_readv() was added in Linux 3.2 */
+            log_info(tid, "process_vm_readv() is not available, reading "
+                     "tracee memory with PTRACE_PEEKDATA");
+            vm_readv_works = 0;
+            /* LCOV_EXCL_END */
+        }
+        return 0;
+    }
+    return (size_t)res;
+#else
+    return 0;
+#endif
+}
+
+/* Fallback, reading the memory of the tracee one word at a time */
+static size_t tracee_peekstrlen(pid_t tid, const char *str)
+{
+    uintptr_t ptr = (uintptr_t)str;
+    size_t j = ptr % WORD_SIZE;
+    uintptr_t i = ptr - j;
+    size_t size = 0;
+    int done = 0;
+    for(; !done; i += WORD_SIZE)
+    {
+        unsigned long data = tracee_getword(tid, (const void*)i);
+        for(; !done && j < WORD_SIZE; ++j)
+        {
+            unsigned char byte = data >> (8 * j);
+            if(byte == 0)
+                done = 1;
+            else
+                ++size;
+        }
+        j = 0;
+    }
+    return size;
+}
+
+static void tracee_peekread(pid_t tid, char *dst, const char *src,
+                            size_t size)
+{
+    uintptr_t ptr = (uintptr_t)src;
+    size_t j = ptr % WORD_SIZE;
+    uintptr_t i = ptr - j;
+    uintptr_t end = ptr + size;
+    for(; i < end; i += WORD_SIZE)
+    {
+        unsigned long data = tracee_getword(tid, (const void*)i);
+        for(; j < WORD_SIZE && i + j < end; ++j)
+            *dst++ = data >> (8 * j);
+        j = 0;
+    }
+}
+
 void *tracee_getptr(int mode, pid_t tid, const void *addr)
 {
     if(mode == MODE_I386)
@@ -77,83 +170,154 @@ size_t tracee_getwordsize(int mode)
 
 size_t tracee_strlen(pid_t tid, const char *str)
 {
+    /* Reads up to the end of each page, so we don't fail on the next one if
+     * it is not mapped */
+    char buffer[4096];
     uintptr_t ptr = (uintptr_t)str;
-    size_t j = ptr % WORD_SIZE;
-    uintptr_t i = ptr - j;
     size_t size = 0;
-    int done = 0;
-    for(; !done; i += WORD_SIZE)
+    for(;;)
     {
-        unsigned long data = tracee_getword(tid, (const void*)i);
-        for(; !done && j < WORD_SIZE; ++j)
-        {
-            unsigned char byte = data >> (8 * j);
-            if(byte == 0)
-                done = 1;
-            else
-                ++size;
-        }
-        j = 0;
+        size_t chunk = page_remaining(ptr + size);
+        size_t got;
+        const char *nul;
+        if(chunk > sizeof(buffer))
+            chunk = sizeof(buffer);
+        got = tracee_bulkread(tid, buffer, (const char*)(ptr + size), chunk);
+        if(got == 0)
+            return size + tracee_peekstrlen(tid, (const char*)(ptr + size));
+        nul = memchr(buffer, '\0', got);
+        if(nul != NULL)
+            return size + (nul - buffer);
+        size += got;
     }
-    return size;
 }
 
 void tracee_read(pid_t tid, char *dst, const char *src, size_t size)
 {
-    uintptr_t ptr = (uintptr_t)src;
-    size_t j = ptr % WORD_SIZE;
-    uintptr_t i = ptr - j;
-    uintptr_t end = ptr + size;
-    for(; i < end; i += WORD_SIZE)
-    {
-        unsigned long data = tracee_getword(tid, (const void*)i);
-        for(; j < WORD_SIZE && i + j < end; ++j)
-            *dst++ = data >> (8 * j);
-        j = 0;
-    }
+    size_t got = tracee_bulkread(tid, dst, src, size);
+    if(got < size)
+        tracee_peekread(tid, dst + got, src + got, size - got);
 }
 
 char *tracee_strdup(pid_t tid, const char *str)
 {
-    size_t length = tracee_strlen(tid, str);
-    char *res = malloc(length + 1);
-    tracee_read(tid, res, str, length);
-    res[length] = '\0';
+    /* Reads directly into the result, one page at a time, instead of going
+     * over the string twice */
+    uintptr_t ptr = (uintptr_t)str;
+    size_t size = 0;
+    size_t capacity = 0;
+    char *res = NULL;
+    for(;;)
+    {
+        size_t chunk = page_remaining(ptr + size);
+        size_t got;
+        const char *nul;
+        if(size + chunk + 1 > capacity)
+        {
+            capacity = size + chunk + 1;
+            res = realloc(res, capacity);
+        }
+        got = tracee_bulkread(tid, res + size, (const char*)(ptr + size),
+                              chunk);
+        if(got == 0)
+        {
+            size_t rest = tracee_peekstrlen(tid, (const char*)(ptr + size));
+            if(size + rest + 1 > capacity)
+            {
+                capacity = size + rest + 1;
+                res = realloc(res, capacity);
+            }
+            tracee_peekread(tid, res + size, (const char*)(ptr + size), rest);
+            size += rest;
+            break;
+        }
+        nul = memchr(res + size, '\0', got);
+        if(nul != NULL)
+        {
+            size = nul - res;
+            break;
+        }
+        size += got;
+    }
+    res[size] = '\0';
     return res;
 }
 
 char **tracee_strarraydup(int mode, pid_t tid, const char *const *argv)
 {
     /* FIXME : This is probably broken on x32 */
-    char **array;
-    /* Reads number of pointers in pointer array */
+    char **array = NULL;
+    size_t wordsize = tracee_getwordsize(mode);
+    uintptr_t ptr = (uintptr_t)argv;
     size_t nb_args = 0;
+    size_t capacity = 0;
+    int done = 0;
+    /* Reads the pointer array, a page at a time, storing the pointers into
+     * the result array temporarily */
+    while(!done)
     {
-        const char *const *a = argv;
-        /* xargv = *a */
-        const char *xargv = tracee_getptr(mode, tid, a);
-        while(xargv != NULL)
+        unsigned char buffer[512];
+        size_t chunk = page_remaining(ptr);
+        size_t got = 0, i;
+        if(chunk > sizeof(buffer))
+            chunk = sizeof(buffer);
+        chunk -= chunk % wordsize;
+        if(chunk > 0)
+            got = tracee_bulkread(tid, (char*)buffer, (const char*)ptr,
+                                  chunk);
+        got -= got % wordsize;
+        if(got == 0)
+        {
+            /* Read a single pointer the slow way */
+            got = wordsize;
+            if(mode == MODE_I386)
+            {
+                uint32_t val = (uint32_t)(uintptr_t)tracee_getptr(
+                        mode, tid, (const void*)ptr);
+                memcpy(buffer, &val, sizeof(val));
+            }
+            else /* mode == MODE_X86_64 */
+            {
+                uint64_t val = (uint64_t)(uintptr_t)tracee_getptr(
+                        mode, tid, (const void*)ptr);
+                memcpy(buffer, &val, sizeof(val));
+            }
+        }
+        if(nb_args + got / wordsize + 1 > capacity)
+        {
+            capacity = (nb_args + got / wordsize + 1) * 2;
+            array = realloc(array, capacity * sizeof(char*));
+        }
+        for(i = 0; i < got; i += wordsize)
         {
-            ++nb_args;
-            ++a;
-            xargv = tracee_getptr(mode, tid, a);
+            uintptr_t xargv;
+            if(mode == MODE_I386)
+            {
+                uint32_t val;
+                memcpy(&val, buffer + i, sizeof(val));
+                xargv = val;
+            }
+            else /* mode == MODE_X86_64 */
+            {
+                uint64_t val;
+                memcpy(&val, buffer + i, sizeof(val));
+                xargv = (uintptr_t)val;
+            }
+            if(xargv == 0)
+            {
+                done = 1;
+                break;
+            }
+            array[nb_args++] = (char*)xargv;
         }
+        ptr += got;
     }
-    /* Allocs pointer array */
-    array = malloc((nb_args + 1) * sizeof(char*));
+    array[nb_args] = NULL;
     /* Dups array elements */
     {
-        size_t i = 0;
-        /* xargv = argv[0] */
-        const char *xargv = tracee_getptr(mode, tid, argv);
-        while(xargv != NULL)
-        {
-            array[i] = tracee_strdup(tid, xargv);
-            ++i;
-            /* xargv = argv[i] */
-            xargv = tracee_getptr(mode, tid, argv + i);
-        }
-        array[i] = NULL;
+        size_t i;
+        for(i = 0; i < nb_args; ++i)
+            array[i] = tracee_strdup(tid, array[i]);
     }
     return array;
 }
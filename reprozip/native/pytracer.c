@@ -58,7 +58,8 @@ static char *get_string(PyObject *obj)
 }
 
 
-static PyObject *pytracer_execute(PyObject *self, PyObject *args)
+static PyObject *pytracer_execute(PyObject *self, PyObject *args,
+                                  PyObject *kwargs)
 {
     PyObject *ret = NULL;
     int exit_status;
@@ -67,6 +68,9 @@ static PyObject *pytracer_execute(PyObject *self, PyObject *args)
     char **argv = NULL;
     size_t argv_len;
     PyObject *py_binary, *py_argv, *py_databasepath;
+    int seccomp = 0, dedup = 0;
+    static char *kwlist[] = {"binary", "argv", "databasepath", "seccomp",
+                             "dedup", NULL};
 
     if(log_setup() != 0)
     {
@@ -75,10 +79,11 @@ static PyObject *pytracer_execute(PyObject *self, PyObject *args)
     }
 
     /* Reads arguments */
-    if(!PyArg_ParseTuple(args, "OO!O",
-                         &py_binary,
-                         &PyList_Type, &py_argv,
-                         &py_databasepath))
+    if(!PyArg_ParseTupleAndKeywords(args, kwargs, "OO!O|ii", kwlist,
+                                    &py_binary,
+                                    &PyList_Type, &py_argv,
+                                    &py_databasepath,
+                                    &seccomp, &dedup))
         return NULL;
 
     binary = get_string(py_binary);
@@ -117,7 +122,9 @@ static PyObject *pytracer_execute(PyObject *self, PyObject *args)
         argv[argv_len] = NULL;
     }
 
-    if(fork_and_trace(binary, argv_len, argv, databasepath, &exit_status) == 0)
+    if(fork_and_trace(binary, argv_len, argv, databasepath, &exit_status,
+                      (seccomp?TRACE_OPT_SECCOMP:0)
+                      | (dedup?TRACE_OPT_DEDUP:0)) == 0)
     {
         ret = PyLong_FromLong(exit_status);
     }
@@ -145,11 +152,18 @@ done:
 
 
 static PyMethodDef methods[] = {
-    {"execute", pytracer_execute, METH_VARARGS,
-     "execute(binary, argv, databasepath)\n"
+    {"execute", (PyCFunction)pytracer_execute, METH_VARARGS | METH_KEYWORDS,
+     "execute(binary, argv, databasepath, seccomp=False, dedup=False)\n"
      "\n"
      "Runs the specified binary with the argument list argv under trace and "
-     "writes\nthe captured events to SQLite3 database databasepath."},
+     "writes\nthe captured events to SQLite3 database databasepath.\n"
+     "\n"
+     "If seccomp is True, a seccomp-BPF filter is installed so that the "
+     "tracer only\nstops on the syscalls it handles.\n"
+     "\n"
+     "If dedup is True, only the first access to each path with a given mode "
+     "is\nrecorded; the number of other accesses goes in the counters "
+     "table."},
     { NULL, NULL, 0, NULL }
 };
 
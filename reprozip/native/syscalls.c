@@ -5,9 +5,14 @@
 
 #include <arpa/inet.h>
 #include <fcntl.h>
+#include <linux/audit.h>
+#include <linux/filter.h>
+#include <linux/seccomp.h>
 #include <netdb.h>
 #include <netinet/in.h>
 #include <sched.h>
+#include <stddef.h>
+#include <sys/prctl.h>
 #include <sys/ptrace.h>
 #include <sys/socket.h>
 #include <sys/stat.h>
@@ -33,6 +38,12 @@
 #ifndef SYS_ACCEPT
 #define SYS_ACCEPT 5
 #endif
+#ifndef PR_SET_NO_NEW_PRIVS
+#define PR_SET_NO_NEW_PRIVS 38
+#endif
+#ifndef SECCOMP_RET_TRACE
+#define SECCOMP_RET_TRACE 0x7ff00000U
+#endif
 
 
 #define SYSCALL_I386        0
@@ -716,8 +727,8 @@ int syscall_fork_event(struct Process *process, unsigned int event)
             return -1;
             /* LCOV_EXCL_END */
         }
-        new_process->status = PROCSTAT_ATTACHED;
-        ptrace(PTRACE_SYSCALL, new_process->tid, NULL, NULL);
+        trace_set_status(new_process, PROCSTAT_ATTACHED);
+        trace_resume(new_process, 0);
         if(logging_level <= 20)
         {
             unsigned int nproc, unknown;
@@ -729,11 +740,9 @@ int syscall_fork_event(struct Process *process, unsigned int event)
     else
     {
         /* Process hasn't been seen before (event happened first) */
-        new_process = trace_get_empty_process();
-        new_process->status = PROCSTAT_ALLOCATED;
+        new_process = trace_new_process(new_tid, PROCSTAT_ALLOCATED);
         new_process->flags = 0;
         /* New process gets a SIGSTOP, but we resume on attach */
-        new_process->tid = new_tid;
         new_process->in_syscall = 0;
     }
 
@@ -1197,13 +1206,129 @@ void syscall_build_table(void)
 }
 
 
+/* ********************
+ * seccomp-BPF filter
+ *
+ * The filter makes the kernel stop the tracee (PTRACE_EVENT_SECCOMP) only on
+ * the syscalls that appear in the tables; everything else runs without
+ * notifying the tracer.
+ */
+
+struct filter_buffer {
+    struct sock_filter *insns;
+    size_t length;
+    size_t size;
+};
+
+static void filter_emit(struct filter_buffer *buf, unsigned short code,
+                        unsigned char jt, unsigned char jf, unsigned int k)
+{
+    if(buf->length == buf->size)
+    {
+        buf->size *= 2;
+        buf->insns = realloc(buf->insns,
+                             buf->size * sizeof(struct sock_filter));
+    }
+    buf->insns[buf->length].code = code;
+    buf->insns[buf->length].jt = jt;
+    buf->insns[buf->length].jf = jf;
+    buf->insns[buf->length].k = k;
+    ++buf->length;
+}
+
+static void filter_emit_table(struct filter_buffer *buf,
+                              const struct syscall_table *tbl,
+                              unsigned int syscall_bit)
+{
+    size_t i;
+    for(i = 0; i < tbl->length; ++i)
+    {
+        if(tbl->entries[i].proc_entry == NULL
+         && tbl->entries[i].proc_exit == NULL)
+            continue;
+        /* if(nr == i) return TRACE; */
+        filter_emit(buf, BPF_JMP | BPF_JEQ | BPF_K, 0, 1,
+                    (unsigned int)i | syscall_bit);
+        filter_emit(buf, BPF_RET | BPF_K, 0, 0, SECCOMP_RET_TRACE);
+    }
+}
+
+/* Emits the check for one architecture. The tables are only used if the
+ * syscall comes from that architecture, else we jump over them. */
+static void filter_emit_arch(struct filter_buffer *buf, unsigned int arch,
+                             const struct syscall_table *tbl1,
+                             const struct syscall_table *tbl2,
+                             unsigned int tbl2_bit)
+{
+    size_t jump;
+    filter_emit(buf, BPF_LD | BPF_W | BPF_ABS, 0, 0,
+                offsetof(struct seccomp_data, arch));
+    filter_emit(buf, BPF_JMP | BPF_JEQ | BPF_K, 1, 0, arch);
+    jump = buf->length;
+    filter_emit(buf, BPF_JMP | BPF_JA, 0, 0, 0); /* offset set below */
+    filter_emit(buf, BPF_LD | BPF_W | BPF_ABS, 0, 0,
+                offsetof(struct seccomp_data, nr));
+    filter_emit_table(buf, tbl1, 0);
+    if(tbl2 != NULL)
+        filter_emit_table(buf, tbl2, tbl2_bit);
+    filter_emit(buf, BPF_RET | BPF_K, 0, 0, SECCOMP_RET_ALLOW);
+    buf->insns[jump].k = buf->length - jump - 1;
+}
+
+int syscall_install_filter(void)
+{
+    struct filter_buffer buf;
+    struct sock_fprog prog;
+
+    buf.size = 256;
+    buf.length = 0;
+    buf.insns = malloc(buf.size * sizeof(struct sock_filter));
+
+#if defined(I386)
+    filter_emit_arch(&buf, AUDIT_ARCH_I386,
+                     &syscall_tables[SYSCALL_I386], NULL, 0);
+#elif defined(X86_64)
+    filter_emit_arch(&buf, AUDIT_ARCH_X86_64,
+                     &syscall_tables[SYSCALL_X86_64],
+                     &syscall_tables[SYSCALL_X86_64_x32], __X32_SYSCALL_BIT);
+    filter_emit_arch(&buf, AUDIT_ARCH_I386,
+                     &syscall_tables[SYSCALL_I386], NULL, 0);
+#endif
+    /* Unknown architecture: stop on everything */
+    filter_emit(&buf, BPF_RET | BPF_K, 0, 0, SECCOMP_RET_TRACE);
+
+    prog.len = buf.length;
+    prog.filter = buf.insns;
+
+    /* Required to install a filter without CAP_SYS_ADMIN. This doesn't change
+     * anything for set-uid binaries, which don't get privileges under an
+     * unprivileged tracer anyway. When running as root, set-uid binaries do
+     * get their privileges under ptrace, and no_new_privs would prevent that,
+     * so it isn't set (root can install the filter without it) */
+    if(geteuid() != 0 && prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0)
+    {
+        log_critical(0, "couldn't set no_new_privs: %s", strerror(errno));
+        free(buf.insns);
+        return -1;
+    }
+    if(prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, &prog) != 0)
+    {
+        log_critical(0, "couldn't install seccomp filter: %s",
+                     strerror(errno));
+        free(buf.insns);
+        return -1;
+    }
+    free(buf.insns);
+    return 0;
+}
+
+
 /* ********************
  * Handle a syscall via the table
  */
 
 int syscall_handle(struct Process *process)
 {
-    pid_t tid = process->tid;
     const int syscall = process->current_syscall & ~__X32_SYSCALL_BIT;
     size_t syscall_type;
     const char *inout = process->in_syscall?"out":"in";
@@ -1277,7 +1402,7 @@ int syscall_handle(struct Process *process)
     }
     else
         process->in_syscall = 1;
-    ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+    trace_resume(process, 0);
 
     return 0;
 }
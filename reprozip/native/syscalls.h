@@ -5,6 +5,8 @@
 
 void syscall_build_table(void);
 
+int syscall_install_filter(void);
+
 int syscall_handle(struct Process *process);
 
 int syscall_execve_event(struct Process *process);
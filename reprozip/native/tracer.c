@@ -10,6 +10,7 @@
 #include <sys/types.h>
 #include <sys/uio.h>
 #include <sys/user.h>
+#include <sys/utsname.h>
 #include <sys/wait.h>
 #include <unistd.h>
 
@@ -25,6 +26,12 @@
 #ifndef NT_PRSTATUS
 #define NT_PRSTATUS 1
 #endif
+#ifndef PTRACE_O_TRACESECCOMP
+#define PTRACE_O_TRACESECCOMP 0x80
+#endif
+#ifndef PTRACE_EVENT_SECCOMP
+#define PTRACE_EVENT_SECCOMP 7
+#endif
 
 
 struct i386_regs {
@@ -106,55 +113,144 @@ void free_execve_info(struct ExecveInfo *execi)
 struct Process **processes = NULL;
 size_t processes_size;
 
-struct Process *trace_find_process(pid_t tid)
+static unsigned int trace_options = 0;
+
+/* Index of the processes in use, by tid. This is an open-addressing hash
+ * table with linear probing, its size is a power of 2 and at least twice the
+ * size of the process table */
+static struct Process **process_index = NULL;
+static size_t process_index_size = 0;
+
+/* Linked list of the FREE entries in the process table */
+static struct Process *free_processes = NULL;
+
+/* Number of processes in use, and how many of those are UNKNOWN */
+static unsigned int nb_processes = 0;
+static unsigned int nb_unknown = 0;
+
+static size_t process_hash(pid_t tid)
 {
-    size_t i;
-    for(i = 0; i < processes_size; ++i)
+    return ((uint32_t)tid * 2654435761U) & (process_index_size - 1);
+}
+
+static void process_index_insert(struct Process *process)
+{
+    size_t i = process_hash(process->tid);
+    while(process_index[i] != NULL)
+        i = (i + 1) & (process_index_size - 1);
+    process_index[i] = process;
+}
+
+static void process_index_remove(struct Process *process)
+{
+    size_t mask = process_index_size - 1;
+    size_t i = process_hash(process->tid);
+    size_t j;
+    while(process_index[i] != process)
+    {
+        if(process_index[i] == NULL)
+        {
+            /* LCOV_EXCL_START : internal error */
+            log_critical(process->tid, "process missing from index");
+            return;
+            /* LCOV_EXCL_END */
+        }
+        i = (i + 1) & mask;
+    }
+    /* Shift back the following entries that can't be found anymore with the
+     * hole we just made, so that we don't need tombstones */
+    process_index[i] = NULL;
+    j = i;
+    for(;;)
     {
-        if(processes[i]->status != PROCSTAT_FREE && processes[i]->tid == tid)
-            return processes[i];
+        size_t k;
+        j = (j + 1) & mask;
+        if(process_index[j] == NULL)
+            break;
+        k = process_hash(process_index[j]->tid);
+        /* Entry stays if its home slot k is cyclically in (i, j] */
+        if( (i <= j) ? (i < k && k <= j) : (i < k || k <= j) )
+            continue;
+        process_index[i] = process_index[j];
+        process_index[j] = NULL;
+        i = j;
     }
-    return NULL;
 }
 
-struct Process *trace_get_empty_process(void)
+/* Adds entries to the process table, and resizes the index to match */
+static void trace_grow_processes(size_t new_size)
 {
     size_t i;
-    for(i = 0; i < processes_size; ++i)
+    size_t prev_size = processes_size;
+    struct Process *pool = malloc((new_size - prev_size) * sizeof(*pool));
+    processes = realloc(processes, new_size * sizeof(*processes));
+    processes_size = new_size;
+    for(i = prev_size; i < processes_size; ++i)
     {
-        if(processes[i]->status == PROCSTAT_FREE)
-            return processes[i];
+        processes[i] = pool++;
+        processes[i]->status = PROCSTAT_FREE;
+        processes[i]->threadgroup = NULL;
+        processes[i]->execve_info = NULL;
     }
+    /* Push new entries to the free list, in order */
+    for(i = processes_size; i > prev_size; --i)
+    {
+        processes[i - 1]->next_free = free_processes;
+        free_processes = processes[i - 1];
+    }
+
+    free(process_index);
+    process_index_size = 2 * processes_size;
+    process_index = calloc(process_index_size, sizeof(*process_index));
+    for(i = 0; i < prev_size; ++i)
+        if(processes[i]->status != PROCSTAT_FREE)
+            process_index_insert(processes[i]);
+}
 
-    /* Count unknown processes */
-    if(logging_level <= 10)
+struct Process *trace_find_process(pid_t tid)
+{
+    size_t i = process_hash(tid);
+    while(process_index[i] != NULL)
     {
-        size_t unknown = 0;
-        for(i = 0; i < processes_size; ++i)
-            if(processes[i]->status == PROCSTAT_UNKNOWN)
-                ++unknown;
-        log_debug(0, "there are %u/%u UNKNOWN processes",
-                  (unsigned int)unknown, (unsigned int)processes_size);
+        if(process_index[i]->tid == tid)
+            return process_index[i];
+        i = (i + 1) & (process_index_size - 1);
     }
+    return NULL;
+}
 
-    /* Allocate more! */
-    log_debug(0, "process table full (%d), reallocating",
-              (int)processes_size);
+struct Process *trace_new_process(pid_t tid, int status)
+{
+    struct Process *process;
+    if(free_processes == NULL)
     {
-        struct Process *pool;
-        size_t prev_size = processes_size;
-        processes_size *= 2;
-        pool = malloc((processes_size - prev_size) * sizeof(*pool));
-        processes = realloc(processes, processes_size * sizeof(*processes));
-        for(; i < processes_size; ++i)
-        {
-            processes[i] = pool++;
-            processes[i]->status = PROCSTAT_FREE;
-            processes[i]->threadgroup = NULL;
-            processes[i]->execve_info = NULL;
-        }
-        return processes[prev_size];
+        log_debug(0, "there are %u/%u UNKNOWN processes",
+                  nb_unknown, (unsigned int)processes_size);
+        /* Allocate more! */
+        log_debug(0, "process table full (%d), reallocating",
+                  (int)processes_size);
+        trace_grow_processes(processes_size * 2);
     }
+    process = free_processes;
+    free_processes = process->next_free;
+    process->next_free = NULL;
+
+    process->tid = tid;
+    process->status = status;
+    process_index_insert(process);
+    ++nb_processes;
+    if(status == PROCSTAT_UNKNOWN)
+        ++nb_unknown;
+    return process;
+}
+
+void trace_set_status(struct Process *process, int status)
+{
+    if(process->status == PROCSTAT_UNKNOWN)
+        --nb_unknown;
+    if(status == PROCSTAT_UNKNOWN)
+        ++nb_unknown;
+    process->status = status;
 }
 
 struct ThreadGroup *trace_new_threadgroup(pid_t tgid, char *wd)
@@ -169,7 +265,15 @@ struct ThreadGroup *trace_new_threadgroup(pid_t tgid, char *wd)
 
 void trace_free_process(struct Process *process)
 {
+    if(process->status == PROCSTAT_FREE)
+        return;
+    process_index_remove(process);
+    --nb_processes;
+    if(process->status == PROCSTAT_UNKNOWN)
+        --nb_unknown;
     process->status = PROCSTAT_FREE;
+    process->next_free = free_processes;
+    free_processes = process;
     if(process->threadgroup != NULL)
     {
         process->threadgroup->refs--;
@@ -197,31 +301,22 @@ void trace_free_process(struct Process *process)
 
 void trace_count_processes(unsigned int *p_nproc, unsigned int *p_unknown)
 {
-    unsigned int nproc = 0, unknown = 0;
-    size_t i;
-    for(i = 0; i < processes_size; ++i)
-    {
-        switch(processes[i]->status)
-        {
-        case PROCSTAT_FREE:
-            break;
-        case PROCSTAT_UNKNOWN:
-            /* Exists but no corresponding syscall has returned yet */
-            ++unknown;
-            ++nproc;
-            break;
-        case PROCSTAT_ALLOCATED:
-            /* Not yet attached but it will show up eventually */
-        case PROCSTAT_ATTACHED:
-            /* Running */
-            ++nproc;
-            break;
-        }
-    }
+    /* UNKNOWN processes exist but no corresponding syscall has returned yet;
+     * ALLOCATED ones are not yet attached but will show up eventually */
     if(p_nproc != NULL)
-        *p_nproc = nproc;
+        *p_nproc = nb_processes;
     if(p_unknown != NULL)
-        *p_unknown = unknown;
+        *p_unknown = nb_unknown;
+}
+
+void trace_resume(struct Process *process, int signum)
+{
+    /* With the seccomp filter, we only need to see the syscall exit of the
+     * syscalls we stopped on; other syscalls can run freely */
+    if(trace_options & TRACE_OPT_SECCOMP && !process->in_syscall)
+        ptrace(PTRACE_CONT, process->tid, NULL, (void*)(intptr_t)signum);
+    else
+        ptrace(PTRACE_SYSCALL, process->tid, NULL, (void*)(intptr_t)signum);
 }
 
 int trace_add_files_from_proc(unsigned int process, pid_t tid,
@@ -326,7 +421,20 @@ static void trace_set_options(pid_t tid)
            PTRACE_O_TRACECLONE |
            PTRACE_O_TRACEFORK |
            PTRACE_O_TRACEVFORK |
-           PTRACE_O_TRACEEXEC);
+           PTRACE_O_TRACEEXEC |
+           ((trace_options & TRACE_OPT_SECCOMP)?PTRACE_O_TRACESECCOMP:0));
+}
+
+static int kernel_supports_seccomp_tracing(void)
+{
+    struct utsname name;
+    int major, minor;
+    if(uname(&name) != 0
+     || sscanf(name.release, "%d.%d", &major, &minor) != 2)
+        return 0;
+    /* Before Linux 4.8, the seccomp stop happened before the syscall-entry
+     * stop, so PTRACE_SYSCALL from it didn't bring us to the syscall exit */
+    return major > 4 || (major == 4 && minor >= 8);
 }
 
 static int trace(pid_t first_proc, int *first_exit_code)
@@ -390,10 +498,8 @@ static int trace(pid_t first_proc, int *first_exit_code)
         if(process == NULL)
         {
             log_debug(tid, "process appeared");
-            process = trace_get_empty_process();
-            process->status = PROCSTAT_UNKNOWN;
+            process = trace_new_process(tid, PROCSTAT_UNKNOWN);
             process->flags = 0;
-            process->tid = tid;
             process->threadgroup = NULL;
             process->in_syscall = 0;
             trace_set_options(tid);
@@ -403,11 +509,11 @@ static int trace(pid_t first_proc, int *first_exit_code)
         }
         else if(process->status == PROCSTAT_ALLOCATED)
         {
-            process->status = PROCSTAT_ATTACHED;
+            trace_set_status(process, PROCSTAT_ATTACHED);
 
             log_debug(tid, "process attached");
             trace_set_options(tid);
-            ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+            trace_resume(process, 0);
             if(logging_level <= 20)
             {
                 unsigned int nproc, unknown;
@@ -418,7 +524,8 @@ static int trace(pid_t first_proc, int *first_exit_code)
             continue;
         }
 
-        if(WIFSTOPPED(status) && WSTOPSIG(status) & 0x80)
+        if( (WIFSTOPPED(status) && WSTOPSIG(status) & 0x80)
+         || (status >> 8 == (SIGTRAP | (PTRACE_EVENT_SECCOMP << 8))) )
         {
             size_t len = 0;
 #ifdef I386
@@ -426,6 +533,14 @@ static int trace(pid_t first_proc, int *first_exit_code)
 #else /* def X86_64 */
             struct x86_64_regs regs;
 #endif
+            if(status >> 8 == (SIGTRAP | (PTRACE_EVENT_SECCOMP << 8))
+             && process->in_syscall)
+            {
+                /* Already saw the syscall-entry stop for this one (process
+                 * was resumed with PTRACE_SYSCALL) */
+                trace_resume(process, 0);
+                continue;
+            }
             /* Try to use GETREGSET first, since iov_len allows us to know if
              * 32bit or 64bit mode was used */
 #ifdef PTRACE_GETREGSET
@@ -534,7 +649,7 @@ static int trace(pid_t first_proc, int *first_exit_code)
                     if(syscall_fork_event(process, event) != 0)
                         return -1;
                 }
-                ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+                trace_resume(process, 0);
             }
             else if(signum == SIGTRAP)
             {
@@ -542,7 +657,7 @@ static int trace(pid_t first_proc, int *first_exit_code)
                 log_error(0,
                           "NOT delivering SIGTRAP to %d\n"
                           "    waitstatus=0x%X", tid, status);
-                ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+                trace_resume(process, 0);
                 /* LCOV_EXCL_END */
             }
             /* Other signal, let the process handle it */
@@ -551,14 +666,14 @@ static int trace(pid_t first_proc, int *first_exit_code)
                 siginfo_t si;
                 log_info(tid, "caught signal %d", signum);
                 if(ptrace(PTRACE_GETSIGINFO, tid, 0, (long)&si) >= 0)
-                    ptrace(PTRACE_SYSCALL, tid, NULL, signum);
+                    trace_resume(process, signum);
                 else
                 {
                     /* LCOV_EXCL_START : Not sure what this is for... doesn't
                      * seem to happen in practice */
                     log_error(tid, "    NOT delivering: %s", strerror(errno));
                     if(signum != SIGSTOP)
-                        ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+                        trace_resume(process, 0);
                     /* LCOV_EXCL_END */
                 }
             }
@@ -588,15 +703,7 @@ static void restore_signals(void)
 static void cleanup(void)
 {
     size_t i;
-    {
-        size_t nb = 0;
-        for(i = 0; i < processes_size; ++i)
-            if(processes[i]->status != PROCSTAT_FREE)
-                ++nb;
-        /* size_t size is implementation dependent; %u for size_t can trigger
-         * a warning */
-        log_error(0, "cleaning up, %u processes to kill...", (unsigned int)nb);
-    }
+    log_error(0, "cleaning up, %u processes to kill...", nb_processes);
     for(i = 0; i < processes_size; ++i)
     {
         if(processes[i]->status != PROCSTAT_FREE)
@@ -633,28 +740,27 @@ static void trace_init(void)
 
     if(processes == NULL)
     {
-        size_t i;
-        struct Process *pool;
-        processes_size = 16;
-        processes = malloc(processes_size * sizeof(*processes));
-        pool = malloc(processes_size * sizeof(*pool));
-        for(i = 0; i < processes_size; ++i)
-        {
-            processes[i] = pool++;
-            processes[i]->status = PROCSTAT_FREE;
-            processes[i]->threadgroup = NULL;
-            processes[i]->execve_info = NULL;
-        }
+        processes_size = 0;
+        trace_grow_processes(16);
     }
 
     syscall_build_table();
 }
 
 int fork_and_trace(const char *binary, int argc, char **argv,
-                   const char *database_path, int *exit_status)
+                   const char *database_path, int *exit_status,
+                   unsigned int options)
 {
     pid_t child;
 
+    trace_options = options;
+    if(trace_options & TRACE_OPT_SECCOMP && !kernel_supports_seccomp_tracing())
+    {
+        log_warn(0, "seccomp filtering needs Linux 4.8 or later, tracing "
+                 "every syscall instead");
+        trace_options &= ~TRACE_OPT_SECCOMP;
+    }
+
     trace_init();
 
     child = fork();
@@ -678,6 +784,10 @@ int fork_and_trace(const char *binary, int argc, char **argv,
                 strerror(errno));
             exit(125);
         }
+        /* Only stop on the syscalls we handle. The filter applies to every
+         * descendant, and stays through execve() */
+        if(trace_options & TRACE_OPT_SECCOMP && syscall_install_filter() != 0)
+            exit(125);
         /* Stop this once so tracer can set options */
         kill(getpid(), SIGSTOP);
         /* Execute the target */
@@ -687,7 +797,7 @@ int fork_and_trace(const char *binary, int argc, char **argv,
         exit(127);
     }
 
-    if(db_init(database_path) != 0)
+    if(db_init(database_path, trace_options & TRACE_OPT_DEDUP) != 0)
     {
         kill(child, SIGKILL);
         restore_signals();
@@ -696,11 +806,11 @@ int fork_and_trace(const char *binary, int argc, char **argv,
 
     /* Creates entry for first process */
     {
-        struct Process *process = trace_get_empty_process();
-        process->status = PROCSTAT_ALLOCATED; /* Not yet attached... */
+        /* Not yet attached... */
+        struct Process *process = trace_new_process(child,
+                                                    PROCSTAT_ALLOCATED);
         process->flags = 0;
         /* We sent a SIGSTOP, but we resume on attach */
-        process->tid = child;
         process->threadgroup = trace_new_threadgroup(child, get_wd());
         process->in_syscall = 0;
 
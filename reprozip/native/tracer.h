@@ -4,8 +4,14 @@
 #include "config.h"
 
 
+#define TRACE_OPT_SECCOMP   1   /* Only stop on syscalls from the table,
+                                 * using a seccomp-BPF filter */
+#define TRACE_OPT_DEDUP     2   /* Only record the first access to a path
+                                 * with each mode */
+
 int fork_and_trace(const char *binary, int argc, char **argv,
-                   const char *database_path, int *exit_status);
+                   const char *database_path, int *exit_status,
+                   unsigned int options);
 
 
 /* This is NOT a union because sign-extension rules depend on actual register
@@ -45,6 +51,7 @@ struct Process {
     register_type retvalue;
     register_type params[PROCESS_ARGS];
     struct ExecveInfo *execve_info;
+    struct Process *next_free;  /* next FREE entry in the process table */
 };
 
 #define PROCSTAT_FREE       0   /* unallocated entry in table */
@@ -69,7 +76,10 @@ extern size_t processes_size;
 
 struct Process *trace_find_process(pid_t tid);
 
-struct Process *trace_get_empty_process(void);
+/* Takes a FREE entry from the table and registers it with this tid */
+struct Process *trace_new_process(pid_t tid, int status);
+
+void trace_set_status(struct Process *process, int status);
 
 struct ThreadGroup *trace_new_threadgroup(pid_t tgid, char *wd);
 
@@ -77,6 +87,8 @@ void trace_free_process(struct Process *process);
 
 void trace_count_processes(unsigned int *p_nproc, unsigned int *p_unknown);
 
+void trace_resume(struct Process *process, int signum);
+
 int trace_add_files_from_proc(unsigned int process, pid_t tid,
                               const char *binary);
 
@@ -21,13 +21,20 @@ package that reprozip and reprounzip would both depend on.
 from __future__ import division, print_function, unicode_literals
 
 import atexit
+import bisect
+import collections
 import contextlib
 import copy
 from datetime import datetime
 from distutils.version import LooseVersion
 import functools
+import gzip
+import importlib
+import json
 import logging
 import logging.handlers
+import marshal
+from multiprocessing.pool import ThreadPool
 import os
 from rpaths import PosixPath, Path
 import sys
@@ -37,7 +44,7 @@ import yaml
 
 from .utils import iteritems, itervalues, unicode_, stderr, UniqueNames, \
     escape, CommonEqualityMixin, optional_return_type, isodatetime, hsize, \
-    join_root, copyfile
+    join_root, copyfile, SeekableStream, PY3
 
 
 logger = logging.getLogger(__name__.split('.', 1)[0])
@@ -53,11 +60,13 @@ FILE_LINK = 0x10
 class File(CommonEqualityMixin):
     """A file, used at some point during the experiment.
     """
-    comment = None
+    # There can be millions of these
+    __slots__ = ('path', 'size', 'comment')
 
     def __init__(self, path, size=None):
         self.path = path
         self.size = size
+        self.comment = None
 
     def __eq__(self, other):
         return (isinstance(other, File) and
@@ -70,6 +79,8 @@ class File(CommonEqualityMixin):
 class Package(CommonEqualityMixin):
     """A distribution package, containing a set of files.
     """
+    __slots__ = ('name', 'version', 'files', 'packfiles', 'size')
+
     def __init__(self, name, version, files=None, packfiles=True, size=None):
         self.name = name
         self.version = version
@@ -77,6 +88,11 @@ class Package(CommonEqualityMixin):
         self.packfiles = packfiles
         self.size = size
 
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__) and
+                all(getattr(self, attr) == getattr(other, attr)
+                    for attr in Package.__slots__))
+
     def add_file(self, file_):
         self.files.append(file_)
 
@@ -91,6 +107,10 @@ class Package(CommonEqualityMixin):
 # 2: pack is usually not compressed, metadata under METADATA/, data in another
 #   DATA.tar.gz (files inside it still have the DATA/ prefix for ease-of-use
 #   in unpackers)
+# 3: like 2, but the data tarball can use another compression, which is
+#   recorded in METADATA/compression. The tarball is named after it, e.g.
+#   DATA.tar.zst (see DATA_COMPRESSIONS). Packs using gzip are still written
+#   as version 2
 #
 # Pack metadata history:
 # 0.2: used by reprozip 0.2
@@ -112,6 +132,153 @@ class Package(CommonEqualityMixin):
 #     moves input_files and output_files from run to global scope
 #     adds processes.is_thread column to trace database
 # 0.8: adds 'id' field to run
+# 0.9: trace database: adds paths table, opened_files.name and
+#     executed_files.name/workingdir become path/workingdir ids into it;
+#     adds blobs table, executed_files.argv/envp become ids into it
+#     adds counters table, adds file metadata to paths table
+#     adds METADATA/data-index.jsonl.gz, an index of the data tarball
+#     adds METADATA/data-blocks.json, the offsets of the gzip members making up
+#     the data tarball
+
+
+# Compression methods for the data tarball, with the extension of the tarball
+DATA_COMPRESSIONS = {
+    'gzip': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+    'none': '',
+}
+
+
+# Fields of the tarfile.TarInfo objects stored in the data index
+DATA_INDEX_FIELDS = ('name', 'type', 'mode', 'uid', 'gid', 'uname', 'gname',
+                     'size', 'mtime', 'linkname', 'devmajor', 'devminor',
+                     'offset', 'offset_data')
+
+# The SHA-256 of regular files is also in the index, and is put in this entry
+# of TarInfo.pax_headers when reading it
+DATA_DIGEST_HEADER = 'REPROZIP.sha256'
+
+
+def compression_module(compression, name):
+    """Imports the module needed to use a compression method.
+
+    Raises ValueError if it is not installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise ValueError("Can't use %s compression, the %s module is not "
+                         "installed" % (compression, name))
+
+
+class BlockGzipReader(SeekableStream):
+    """Reads gzip data made of independent members, seeking directly to them.
+
+    `blocks` lists the (uncompressed offset, compressed offset) of each gzip
+    member. Seeking to another member starts decompressing at that member,
+    instead of reading everything before it.
+    """
+    def __init__(self, fileobj, blocks):
+        self._fileobj = fileobj
+        self._starts = [start for start, offset in blocks]
+        self._offsets = [offset for start, offset in blocks]
+        SeekableStream.__init__(self, lambda: self._open_block(0))
+
+    def _open_block(self, block):
+        self._fileobj.seek(self._offsets[block])
+        return gzip.GzipFile(fileobj=self._fileobj, mode='rb')
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+            whence = os.SEEK_SET
+        if whence == os.SEEK_SET:
+            block = bisect.bisect_right(self._starts, offset) - 1
+            if (offset < self._position or
+                    self._starts[block] > self._position):
+                self._stream.close()
+                self._stream = self._open_block(block)
+                self._position = self._starts[block]
+        return SeekableStream.seek(self, offset, whence)
+
+
+def decompress_data(fileobj, compression, blocks=None):
+    """Wraps a file object from the pack to decompress the data tarball.
+
+    If the tarball is gzip-compressed in independent blocks, `blocks` is the
+    list of their offsets (from METADATA/data-blocks.json), allowing to seek
+    without decompressing all the preceding data.
+    """
+    if compression == 'gzip':
+        if blocks:
+            return BlockGzipReader(fileobj, blocks)
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif compression == 'xz':
+        lzma = compression_module(compression, 'lzma')
+        return lzma.LZMAFile(fileobj, 'rb')
+    elif compression == 'zstd':
+        zstandard = compression_module(compression, 'zstandard')
+
+        def open_stream():
+            fileobj.seek(0)
+            return zstandard.ZstdDecompressor().stream_reader(
+                fileobj, read_across_frames=True, closefd=False)
+        return SeekableStream(open_stream)
+    elif compression == 'lz4':
+        lz4_frame = compression_module(compression, 'lz4.frame')
+        return lz4_frame.LZ4FrameFile(fileobj, 'rb')
+    elif compression == 'none':
+        return fileobj
+    else:
+        raise ValueError("Unknown compression %r" % compression)
+
+
+def write_data_index(fp, members, header=True):
+    """Writes an index of the members of a tarball to a binary file.
+
+    This is a line with the list of fields, then a line per member with their
+    values, as JSON. It allows unpackers to list the data tarball, and to seek
+    to a member, without reading all of it.
+
+    If `header` is False, the list of fields is not written, so members can be
+    added to an index as they come.
+
+    The modification times are written as they are in the members, which
+    should be what is in their header (a float only in PAX format).
+    """
+    if header:
+        fields = DATA_INDEX_FIELDS + ('sha256',)
+        fp.write(json.dumps(fields).encode('ascii') + b'\n')
+    for member in members:
+        values = [getattr(member, field) for field in DATA_INDEX_FIELDS]
+        # Same values as in the tar header
+        values[1] = values[1].decode('ascii')
+        values[2] &= 0o7777
+        values.append(member.pax_headers.get(DATA_DIGEST_HEADER))
+        fp.write(json.dumps(values).encode('ascii') + b'\n')
+
+
+def read_data_index(fp):
+    """Reads the index written by `write_data_index()`.
+
+    Returns a list of tarfile.TarInfo objects.
+    """
+    lines = iter(fp)
+    fields = json.loads(next(lines).decode('ascii'))
+    members = []
+    for line in lines:
+        member = tarfile.TarInfo()
+        for field, value in zip(fields, json.loads(line.decode('ascii'))):
+            if field == 'sha256':
+                if value is not None:
+                    member.pax_headers[DATA_DIGEST_HEADER] = value
+            else:
+                setattr(member, field, value)
+        member.type = member.type.encode('ascii')
+        members.append(member)
+    return members
 
 
 class RPZPack(object):
@@ -129,24 +296,72 @@ class RPZPack(object):
                 version = int(version[17:].rstrip())
             except ValueError:
                 version = None
-            if version in (1, 2):
+            if version in (1, 2, 3):
                 self.version = version
                 self.data_prefix = PosixPath(b'DATA')
             else:
                 raise ValueError(
                     "Unknown format version %r (maybe you should upgrade "
-                    "reprounzip? I only know versions 1 and 2" % version)
+                    "reprounzip? I only know versions 1 to 3" % version)
         else:
             raise ValueError("File doesn't appear to be a RPZ pack")
 
+        self.data_blocks = None
         if self.version == 1:
+            self.compression = 'gzip'
             self.data = self.tar
         elif version == 2:
-            self.data = tarfile.open(
-                fileobj=self.tar.extractfile('DATA.tar.gz'),
-                mode='r:*')
+            self.compression = 'gzip'
+            self.data_member = 'DATA.tar.gz'
+        elif version == 3:
+            f = self.tar.extractfile('METADATA/compression')
+            compression = f.read().decode('ascii').strip()
+            f.close()
+            if compression not in DATA_COMPRESSIONS:
+                raise ValueError(
+                    "Unknown compression %r (maybe you should upgrade "
+                    "reprounzip?)" % compression)
+            self.compression = compression
+            self.data_member = 'DATA.tar' + DATA_COMPRESSIONS[compression]
         else:
             assert False
+        if self.version != 1:
+            if self.compression == 'gzip':
+                try:
+                    f = self.tar.extractfile('METADATA/data-blocks.json')
+                except KeyError:
+                    pass
+                else:
+                    self.data_blocks = json.loads(f.read().decode('ascii'))
+                    f.close()
+            self.data = self._open_data(self.tar)
+        self._data_members = None
+        self._data_by_name = None
+
+    def _get_data_members(self):
+        """Gets the tarfile.TarInfo objects for the data tarball.
+
+        They are read from the index if the pack has one, which avoids
+        decompressing the whole tarball.
+        """
+        if self._data_members is None:
+            try:
+                index = self.tar.extractfile('METADATA/data-index.jsonl.gz')
+            except KeyError:
+                self._data_members = self.data.getmembers()
+            else:
+                with gzip.GzipFile(fileobj=index, mode='rb') as fp:
+                    self._data_members = read_data_index(fp)
+                index.close()
+        return self._data_members
+
+    def _open_data(self, tar):
+        """Opens the data tarball from the pack opened as `tar`.
+        """
+        return tarfile.open(
+            fileobj=decompress_data(tar.extractfile(self.data_member),
+                                    self.compression, self.data_blocks),
+            mode='r:')
 
     def remove_data_prefix(self, path):
         if not isinstance(path, PosixPath):
@@ -177,11 +392,13 @@ class RPZPack(object):
     def with_config(self):
         """Context manager that extracts the config to  a temporary file.
         """
-        fd, tmp = Path.tempfile(prefix='reprounzip_')
-        os.close(fd)
+        # In its own directory, so the parsed configuration cached next to it
+        # gets removed as well
+        tmpdir = Path.tempdir(prefix='reprounzip_')
+        tmp = tmpdir / 'config.yml'
         self.extract_config(tmp)
         yield tmp
-        tmp.remove()
+        tmpdir.rmtree()
 
     def extract_trace(self, target):
         """Extracts the trace database to the specified path.
@@ -191,7 +408,7 @@ class RPZPack(object):
         target = Path(target)
         if self.version == 1:
             member = self.tar.getmember('METADATA/trace.sqlite3')
-        elif self.version == 2:
+        elif self.version in (2, 3):
             try:
                 member = self.tar.getmember('METADATA/trace.sqlite3.gz')
             except KeyError:
@@ -219,7 +436,7 @@ class RPZPack(object):
         """Returns tarfile.TarInfo objects for all the data paths.
         """
         return [copy.copy(m)
-                for m in self.data.getmembers()
+                for m in self._get_data_members()
                 if m.name.startswith('DATA/')]
 
     def data_filenames(self):
@@ -229,9 +446,20 @@ class RPZPack(object):
         removed.
         """
         return set(PosixPath(m.name[4:])
-                   for m in self.data.getmembers()
+                   for m in self._get_data_members()
                    if m.name.startswith('DATA/'))
 
+    def data_hardlinks(self):
+        """Returns a dictionary mapping hardlinks to the path they point to.
+
+        Those paths begin with a slash / and the 'DATA' prefix has been
+        removed.
+        """
+        return dict((PosixPath(m.name[4:]), PosixPath(m.linkname[4:]))
+                    for m in self._get_data_members()
+                    if m.islnk() and m.name.startswith('DATA/') and
+                    m.linkname.startswith('DATA/'))
+
     def get_data(self, path):
         """Returns a tarfile.TarInfo object for the data path.
 
@@ -239,31 +467,212 @@ class RPZPack(object):
         """
         path = PosixPath(path)
         path = join_root(PosixPath(b'DATA'), path)
-        return copy.copy(self.data.getmember(path))
+        if self._data_by_name is None:
+            self._data_by_name = dict((m.name, m)
+                                      for m in self._get_data_members())
+        return copy.copy(self._data_by_name[str(path)])
 
-    def extract_data(self, root, members):
+    def extract_data(self, root, members, jobs=1, store=None):
         """Extracts the given members from the data tarball.
 
-        The members must come from get_data().
+        The members must come from get_data() or list_data(). If `jobs` is more
+        than 1, the regular files are written on that many threads. If the
+        data can be read from different positions at once (it is uncompressed
+        or compressed in blocks), each thread also decompresses its own part
+        of it.
+
+        If `store` is given, it is an
+        :class:`~reprounzip.unpackers.common.store.ObjectStore` from which the
+        files are linked, and to which the files it doesn't have yet are
+        added. It can't be used on Python 2.
+        """
+        if store is not None and not PY3:
+            raise ValueError("The store of extracted files requires Python 3")
+        if (jobs <= 1 and store is None) or not PY3:
+            self.data.extractall(str(root), members)
+            return
+
+        root = str(root)
+        tar = self.data
+        directories = []
+        others = []
+        files = []
+        links = []
+        parents = set()
+
+        # Creates the directories, symbolic links and special files first, in
+        # order, since the files might be under them
+        for member in members:
+            if member.isdir():
+                directories.append(member)
+                path = os.path.join(root, member.name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                parents.add(path)
+                continue
+            parent = os.path.dirname(os.path.join(root, member.name))
+            if parent not in parents:
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                parents.add(parent)
+            if member.isreg() and not member.sparse:
+                files.append(member)
+            elif member.islnk():
+                links.append(member)
+            else:
+                tar.extract(member, root, set_attrs=False)
+                others.append(member)
+
+        # Writes the files
+        files.sort(key=lambda m: m.offset_data)
+        pool = ThreadPool(jobs)
+        try:
+            if self.version != 1 and (self.data_blocks or
+                                      self.compression == 'none'):
+                # Each thread reads and writes a contiguous range of files
+                total = sum(m.size for m in files)
+                ranges = [[] for _ in range(jobs)]
+                position = 0
+                for member in files:
+                    ranges[min(jobs - 1, position * jobs // (total or 1))
+                           ].append(member)
+                    position += member.size
+                pool.map(lambda r: self._extract_files(root, r, store=store),
+                         ranges)
+            else:
+                # Decompresses on this thread, writes from the pool
+                self._extract_files(root, files, pool, store)
+        finally:
+            pool.terminate()
+
+        # Creates hardlinks once their targets exist
+        for member in links:
+            tar.extract(member, root, set_attrs=False)
+
+        # Sets attributes, directories last since writing to them changes
+        # their modification time
+        linked = store.linked if store is not None else ()
+        for member in others + files + links:
+            path = os.path.join(root, member.name)
+            if path not in linked:
+                self._set_attrs(member, path)
+        directories.sort(key=lambda m: m.name, reverse=True)
+        for member in directories:
+            self._set_attrs(member, os.path.join(root, member.name))
+
+    def _set_attrs(self, member, path):
+        """Sets the owner, mode and modification time of an extracted file.
         """
-        self.data.extractall(str(root), members)
+        tar = self.data
+        try:
+            tar.chown(member, path, False)
+            if not member.issym():
+                tar.utime(member, path)
+                tar.chmod(member, path)
+        except tarfile.ExtractError as e:
+            logger.debug("Couldn't set attributes of %s: %s",
+                         member.name, e)
+
+    # Files bigger than this are written directly by the reading thread
+    EXTRACT_DIRECT_SIZE = 16 << 20
+    # Maximum size of the files waiting to be written
+    EXTRACT_BUFFER_SIZE = 128 << 20
+
+    def _extract_files(self, root, files, pool=None, store=None):
+        """Writes regular files from the data tarball.
+
+        If `pool` is None, the data tarball is opened again so this can run on
+        another thread. Otherwise, the files are read from `self.data` and
+        written by the threads of `pool`. Files found in `store` are not read
+        at all, and the others are added to it.
+        """
+        if not files:
+            return
+        if pool is None:
+            tar = tarfile.open(str(self.pack), 'r:')
+            data = self._open_data(tar)
+        else:
+            tar = None
+            data = self.data
+
+        def write(path, contents):
+            with open(path, 'wb') as fp:
+                fp.write(contents)
+
+        pending = collections.deque()
+        buffered = 0
+        try:
+            for member in files:
+                path = os.path.join(root, member.name)
+                if store is not None:
+                    if store.materialize(member, path):
+                        continue
+                    if (store.add(member, data.extractfile(member),
+                                  self._set_attrs) and
+                            store.materialize(member, path)):
+                        continue
+                source = data.extractfile(member)
+                if pool is None or member.size > self.EXTRACT_DIRECT_SIZE:
+                    with open(path, 'wb') as fp:
+                        copyfile(source, fp, 1 << 20)
+                    continue
+                contents = source.read()
+                pending.append((len(contents),
+                                pool.apply_async(write, (path, contents))))
+                buffered += len(contents)
+                while buffered > self.EXTRACT_BUFFER_SIZE:
+                    size, result = pending.popleft()
+                    result.get()
+                    buffered -= size
+            while pending:
+                pending.popleft()[1].get()
+        finally:
+            if tar is not None:
+                data.close()
+                tar.close()
 
     def copy_data_tar(self, target):
         """Copies the file in which the data lies to the specified destination.
+
+        Since tar might not support it, data using a compression other than
+        gzip is decompressed. Returns the compression of the copy, 'gzip' or
+        'none'.
         """
+        compression = self.compression
         if self.version == 1:
             self.pack.copyfile(target)
-        elif self.version == 2:
+        else:
             with target.open('wb') as fp:
-                data = self.tar.extractfile('DATA.tar.gz')
+                data = self.tar.extractfile(self.data_member)
+                if compression not in ('gzip', 'none'):
+                    data = decompress_data(data, compression)
+                    compression = 'none'
                 copyfile(data, fp)
                 data.close()
+        return compression
+
+    def copy_data_index(self, target):
+        """Copies the index of the data tarball to the specified directory.
+
+        This goes with `copy_data_tar()`, as 'data-index.jsonl.gz' and
+        'data-blocks.json', allowing to read a member from the copy without
+        decompressing all of it. Files the pack doesn't have are not written.
+        """
+        for name in ('data-index.jsonl.gz', 'data-blocks.json'):
+            try:
+                member = self.tar.extractfile('METADATA/' + name)
+            except KeyError:
+                continue
+            with (target / name).open('wb') as fp:
+                copyfile(member, fp)
+            member.close()
 
     def close(self):
         if self.data is not self.tar:
             self.data.close()
         self.tar.close()
         self.data = self.tar = None
+        self._data_members = self._data_by_name = None
 
 
 class InvalidConfig(ValueError):
@@ -294,6 +703,8 @@ Config = optional_return_type(['runs', 'packages', 'other_files'],
 
 @functools.total_ordering
 class InputOutputFile(object):
+    __slots__ = ('path', 'read_runs', 'write_runs')
+
     def __init__(self, path, read_runs, write_runs):
         self.path = path
         self.read_runs = read_runs
@@ -368,27 +779,60 @@ def load_iofiles(config, runs):
     return files
 
 
-def load_config(filename, canonical, File=File, Package=Package):
-    """Loads a YAML configuration file.
+# The C implementation of the YAML parser is much faster, if available
+try:
+    YamlSafeLoader = yaml.CSafeLoader
+except AttributeError:  # pragma: no cover
+    YamlSafeLoader = yaml.SafeLoader
 
-    `File` and `Package` parameters can be used to override the classes that
-    will be used to hold files and distribution packages; useful during the
-    packing step.
 
-    `canonical` indicates whether a canonical configuration file is expected
-    (in which case the ``additional_patterns`` section is not accepted). Note
-    that this changes the number of returned values of this function.
+def load_config_document(filename):
+    """Parses a YAML configuration file, without interpreting it.
+
+    The parsed document is cached in a hidden file next to the configuration,
+    along with its modification time and size, and reused as long as those
+    don't change.
     """
+    cache = filename.parent / ('.%s.cache' % filename.unicodename)
+    stat = filename.stat()
+    key = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+           sys.hexversion)
+    try:
+        with cache.open('rb') as fp:
+            cached_key, config = marshal.load(fp)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    else:
+        if cached_key == key:
+            return config
+
     with filename.open(encoding='utf-8') as fp:
-        config = yaml.safe_load(fp)
+        config = yaml.load(fp, Loader=YamlSafeLoader)
 
+    # Writes to a temporary file then renames, so that readers never see a
+    # partial cache
+    temp = cache.parent / ('%s.%d' % (cache.unicodename, os.getpid()))
+    try:
+        with temp.open('wb') as fp:
+            marshal.dump((key, config), fp)
+        temp.rename(cache)
+    except (IOError, OSError, ValueError):
+        logger.debug("Couldn't write configuration cache %s", cache)
+        if temp.exists():
+            temp.remove()
+    return config
+
+
+def _read_config(config, canonical, packages, other_files):
+    """Interprets the sections of a configuration file, except for the files.
+    """
     ver = LooseVersion(config['version'])
 
     keys_ = set(config)
     if 'version' not in keys_:
         raise InvalidConfig("Missing version")
-    # Accepts versions from 0.2 to 0.8 inclusive
-    elif not LooseVersion('0.2') <= ver < LooseVersion('0.9'):
+    # Accepts versions from 0.2 to 0.9 inclusive
+    elif not LooseVersion('0.2') <= ver < LooseVersion('0.10'):
         pkgname = (__package__ or __name__).split('.', 1)[0]
         raise InvalidConfig("Loading configuration file in unknown format %s; "
                             "this probably means that you should upgrade "
@@ -404,8 +848,6 @@ def load_config(filename, canonical, File=File, Package=Package):
                        ', '.join(unknown_keys))
 
     runs = config.get('runs') or []
-    packages = read_packages(config.get('packages'), File, Package)
-    other_files = read_files(config.get('other_files'), File)
 
     inputs_outputs = load_iofiles(config, runs)
 
@@ -423,10 +865,6 @@ def load_config(filename, canonical, File=File, Package=Package):
         if run.get('id') is None:
             run['id'] = "run%d" % i
 
-    record_usage_package(runs, packages, other_files,
-                         inputs_outputs,
-                         pack_id=config.get('pack_id'))
-
     kwargs = {'format_version': ver,
               'inputs_outputs': inputs_outputs}
 
@@ -441,6 +879,175 @@ def load_config(filename, canonical, File=File, Package=Package):
                   **kwargs)
 
 
+def load_config(filename, canonical, File=File, Package=Package):
+    """Loads a YAML configuration file.
+
+    `File` and `Package` parameters can be used to override the classes that
+    will be used to hold files and distribution packages; useful during the
+    packing step.
+
+    `canonical` indicates whether a canonical configuration file is expected
+    (in which case the ``additional_patterns`` section is not accepted). Note
+    that this changes the number of returned values of this function.
+    """
+    document = load_config_document(filename)
+
+    packages = read_packages(document.get('packages'), File, Package)
+    other_files = read_files(document.get('other_files'), File)
+
+    config = _read_config(document, canonical, packages, other_files)
+
+    record_usage_package(config.runs, packages, other_files,
+                         config.inputs_outputs,
+                         pack_id=document.get('pack_id'))
+
+    return config
+
+
+def _compose_node(loader, anchors):
+    """Builds the YAML node starting at the next event of the parser.
+
+    This is what PyYAML's composer does, but it is not exposed by the C
+    parser.
+    """
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        return anchors[event.anchor]
+    tag = event.tag
+    if isinstance(event, yaml.ScalarEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value,
+                               event.start_mark, event.end_mark,
+                               style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None,
+                                 flow_style=event.flow_style)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None,
+                                flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_node(loader, anchors)
+            node.value.append((key, _compose_node(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+
+def _skip_node(loader):
+    """Skips the YAML node starting at the next event of the parser.
+    """
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.SequenceStartEvent,
+                              yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent,
+                                yaml.MappingEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def iter_config(filename, File=File, Package=Package, files=True):
+    """Reads a YAML configuration file incrementally.
+
+    This yields ``(section, value)`` pairs, in the order of the file. The
+    ``packages`` and ``other_files`` sections are yielded one entry at a time,
+    as ``Package`` and ``File`` objects, so that a configuration listing many
+    files can be processed without having all of it in memory. If `files` is
+    False, these two sections are skipped instead, and yielded once with a
+    value of None.
+
+    Unlike :func:`load_config`, this doesn't interpret or validate the other
+    sections.
+    """
+    with filename.open(encoding='utf-8') as fp:
+        loader = YamlSafeLoader(fp)
+        anchors = {}
+        try:
+            loader.get_event()  # StreamStartEvent
+            if loader.check_event(yaml.StreamEndEvent):
+                return
+            loader.get_event()  # DocumentStartEvent
+            if not loader.check_event(yaml.MappingStartEvent):
+                raise InvalidConfig("Configuration is not a mapping")
+            loader.get_event()
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = loader.construct_document(_compose_node(loader,
+                                                              anchors))
+                if key not in ('packages', 'other_files'):
+                    yield key, loader.construct_document(
+                        _compose_node(loader, anchors))
+                elif not files or not loader.check_event(
+                        yaml.SequenceStartEvent):
+                    # Skipped, or empty
+                    _skip_node(loader)
+                    if not files:
+                        yield key, None
+                else:
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        value = loader.construct_document(
+                            _compose_node(loader, anchors))
+                        if key == 'packages':
+                            value['files'] = read_files(value['files'], File)
+                            yield key, Package(**value)
+                        else:
+                            yield key, File(PosixPath(value))
+                    loader.get_event()
+        finally:
+            loader.dispose()
+
+
+class ConfigSection(object):
+    """The packages or the other files of a configuration file, read lazily.
+
+    The file is read again every time this is iterated on; see
+    :func:`open_config`.
+    """
+    def __init__(self, filename, section, File=File, Package=Package):
+        self.filename = filename
+        self.section = section
+        self.File = File
+        self.Package = Package
+
+    def __iter__(self):
+        for key, value in iter_config(self.filename, self.File, self.Package):
+            if key == self.section:
+                yield value
+
+
+def open_config(filename, canonical, File=File, Package=Package):
+    """Loads a YAML configuration file, except for its list of files.
+
+    This returns the same thing as :func:`load_config`, except that the
+    ``packages`` and ``other_files`` are :class:`ConfigSection` objects, that
+    read them from the file when iterated on. This keeps the memory use flat
+    for configurations listing a lot of files.
+    """
+    document = dict(iter_config(filename, files=False))
+    config = _read_config(document, canonical,
+                          ConfigSection(filename, 'packages', File, Package),
+                          ConfigSection(filename, 'other_files', File,
+                                        Package))
+
+    record_usage_package(config.runs, config.packages, config.other_files,
+                         config.inputs_outputs,
+                         pack_id=document.get('pack_id'))
+
+    return config
+
+
 def write_file(fp, fi, indent=0):
     fp.write("%s  - \"%s\"%s\n" % (
              "    " * indent,
@@ -477,10 +1084,46 @@ def save_config(filename, runs, packages, other_files, reprozip_version,
     `canonical` indicates whether this is a canonical configuration file
     (no ``additional_patterns`` section).
     """
-    dump = lambda x: yaml.safe_dump(x, encoding='utf-8', allow_unicode=True)
     with filename.open('w', encoding='utf-8', newline='\n') as fp:
+        write_config(fp, runs, packages, other_files, reprozip_version,
+                     inputs_outputs, canonical, pack_id)
+
+
+def write_config(fp, runs, packages, other_files, reprozip_version,
+                 inputs_outputs=None,
+                 canonical=False, pack_id=None):
+    """Writes the configuration to a text file object.
+
+    See :func:`save_config`.
+    """
+    writer = ConfigWriter(fp, runs, reprozip_version, inputs_outputs,
+                          canonical, pack_id)
+    for pkg in sorted(packages, key=lambda p: p.name):
+        writer.write_package(pkg)
+    for f in sorted(other_files, key=lambda fi: fi.path):
+        writer.write_file(f)
+    writer.close()
+
+
+class ConfigWriter(object):
+    """Writes a configuration to a text file object incrementally.
+
+    The packages then the other files are written one at a time, in the order
+    they are given, so they don't have to be all in memory at once. The
+    sections are only complete once :meth:`close` is called.
+
+    See :func:`write_config`.
+    """
+    def __init__(self, fp, runs, reprozip_version, inputs_outputs=None,
+                 canonical=False, pack_id=None):
+        self.fp = fp
+        self.canonical = canonical
+        self.section = 'packages'
+
+        dump = lambda x: yaml.safe_dump(x, encoding='utf-8',
+                                        allow_unicode=True)
         # Writes preamble
-        fp.write("""\
+        self.fp.write("""\
 # ReproZip configuration file
 # This file was generated by reprozip {version} at {date}
 
@@ -491,23 +1134,23 @@ version: "{format!s}"
 """.format(pack_id=(('\npack_id: "%s"' % pack_id) if pack_id is not None
                     else ''),
            version=escape(reprozip_version),
-           format='0.8',
+           format='0.9',
            date=isodatetime(),
            what=("# It was generated by the packer and you shouldn't need to "
                  "edit it" if canonical
                  else "# You might want to edit this file before running the "
                  "packer\n# See 'reprozip pack -h' for help")))
 
-        fp.write("runs:\n")
+        self.fp.write("runs:\n")
         for i, run in enumerate(runs):
             # Remove reprozip < 0.7 compatibility fields
             run = dict((k, v) for k, v in iteritems(run)
                        if k not in ('input_files', 'output_files'))
-            fp.write("# Run %d\n" % i)
-            fp.write(dump([run]).decode('utf-8'))
-            fp.write("\n")
+            self.fp.write("# Run %d\n" % i)
+            self.fp.write(dump([run]).decode('utf-8'))
+            self.fp.write("\n")
 
-        fp.write("""\
+        self.fp.write("""\
 # Input and output files
 
 # Inputs are files that are only read by a run; reprounzip can replace these
@@ -517,7 +1160,7 @@ version: "{format!s}"
 # The name field is the identifier the user will use to access these files.
 inputs_outputs:""")
         for n, f in iteritems(inputs_outputs):
-            fp.write("""\
+            self.fp.write("""\
 
 - name: {name}
   path: {path}
@@ -526,7 +1169,7 @@ inputs_outputs:""")
                                     readers=repr(f.read_runs),
                                     writers=repr(f.write_runs)))
 
-        fp.write("""\
+        self.fp.write("""\
 
 
 # Files to pack
@@ -539,21 +1182,39 @@ inputs_outputs:""")
 packages:
 """)
 
-        # Writes files
-        for pkg in sorted(packages, key=lambda p: p.name):
-            write_package(fp, pkg)
+    def write_package(self, pkg):
+        """Writes a distribution package and its files.
+        """
+        assert self.section == 'packages'
+        write_package(self.fp, pkg)
 
-        fp.write("""\
+    def _other_files_section(self):
+        self.section = 'other_files'
+        self.fp.write("""\
 
 # These files do not appear to come with an installed package -- you probably
 # want them packed
 other_files:
 """)
-        for f in sorted(other_files, key=lambda fi: fi.path):
-            write_file(fp, f)
 
-        if not canonical:
-            fp.write("""\
+    def write_file(self, fi):
+        """Writes a file that doesn't belong to a package.
+        """
+        if self.section == 'packages':
+            self._other_files_section()
+        write_file(self.fp, fi)
+
+    def close(self):
+        """Writes the end of the configuration.
+        """
+        if self.section is None:
+            return
+        if self.section == 'packages':
+            self._other_files_section()
+        self.section = None
+
+        if not self.canonical:
+            self.fp.write("""\
 
 # If you want to include additional files in the pack, you can list additional
 # patterns of files that will be included
@@ -566,6 +1227,60 @@ additional_patterns:
 """)
 
 
+def create_trace_views(conn, database='main', prefix=''):
+    """Creates temporary views hiding changes to the trace database format.
+
+    The views ``<prefix>opened_paths`` and ``<prefix>executed_paths`` have the
+    same columns as the ``opened_files`` and ``executed_files`` tables of
+    older traces, with the file names, argv and environment as text, whether
+    the trace stores them inline or in the ``paths`` and ``blobs`` tables.
+
+    `database` is the schema name of the trace, if it was attached to `conn`.
+    """
+    tables = set(r[0] for r in conn.execute(
+        '''
+        SELECT name FROM {db}.sqlite_master WHERE type='table';
+        '''.format(db=database)))
+    if 'paths' in tables:
+        if 'blobs' in tables:
+            blobs = 'a.data AS argv, v.data AS envp'
+            blob_joins = '''
+                INNER JOIN {db}.blobs a ON a.id = e.argv
+                INNER JOIN {db}.blobs v ON v.id = e.envp
+                '''
+        else:
+            blobs = 'e.argv, e.envp'
+            blob_joins = ''
+        opened = '''
+            SELECT o.id, o.run_id, p.name, o.timestamp, o.mode,
+                   o.is_directory, o.process
+            FROM {db}.opened_files o
+            INNER JOIN {db}.paths p ON p.id = o.path
+            '''
+        executed = '''
+            SELECT e.id, p.name, e.run_id, e.timestamp, e.process,
+                   %s, w.name AS workingdir
+            FROM {db}.executed_files e
+            INNER JOIN {db}.paths p ON p.id = e.path
+            INNER JOIN {db}.paths w ON w.id = e.workingdir
+            %s
+            ''' % (blobs, blob_joins)
+    else:
+        opened = '''
+            SELECT id, run_id, name, timestamp, mode, is_directory, process
+            FROM {db}.opened_files
+            '''
+        executed = '''
+            SELECT id, name, run_id, timestamp, process, argv, envp,
+                   workingdir
+            FROM {db}.executed_files
+            '''
+    for view, sql in (('opened_paths', opened), ('executed_paths', executed)):
+        conn.execute('DROP VIEW IF EXISTS temp.%s%s;' % (prefix, view))
+        conn.execute('CREATE TEMP VIEW %s%s AS %s;' % (
+            prefix, view, sql.format(db=database)))
+
+
 class LoggingDateFormatter(logging.Formatter):
     """Formatter that puts milliseconds in the timestamp.
     """
@@ -678,17 +1393,38 @@ def record_usage_package(runs, packages, other_files,
                          pack_id=None):
     """Records the info on some pack file into the current usage report.
     """
+    if _usage_report is None:
+        return
+    # Only iterates once on packages, it might be read from the file
+    nb_packages = nb_package_files = packed_packages = 0
+    for pkg in packages:
+        nb_packages += 1
+        nb_package_files += len(pkg.files)
+        if pkg.packfiles:
+            packed_packages += 1
+    record_usage_package_counts(runs, nb_packages, nb_package_files,
+                                packed_packages,
+                                sum(1 for f in other_files),
+                                inputs_outputs, pack_id)
+
+
+def record_usage_package_counts(runs, nb_packages, nb_package_files,
+                                packed_packages, nb_other_files,
+                                inputs_outputs, pack_id=None):
+    """Records the info on some pack file, from the number of files.
+
+    This is :func:`record_usage_package` for when the packages and files were
+    already counted.
+    """
     if _usage_report is None:
         return
     for run in runs:
         record_usage(argv0=run['argv'][0])
     record_usage(pack_id=pack_id or '',
-                 nb_packages=len(packages),
-                 nb_package_files=sum(len(pkg.files)
-                                      for pkg in packages),
-                 packed_packages=sum(1 for pkg in packages
-                                     if pkg.packfiles),
-                 nb_other_files=len(other_files),
+                 nb_packages=nb_packages,
+                 nb_package_files=nb_package_files,
+                 packed_packages=packed_packages,
+                 nb_other_files=nb_other_files,
                  nb_input_outputs_files=len(inputs_outputs),
                  nb_input_files=sum(1 for f in itervalues(inputs_outputs)
                                     if f.read_runs),
@@ -19,6 +19,7 @@ if __name__ == '__main__':  # noqa
 import argparse
 import locale
 import logging
+import multiprocessing
 import os
 from rpaths import Path
 import sqlite3
@@ -27,9 +28,9 @@ import traceback
 
 from reprozip import __version__ as reprozip_version
 from reprozip import _pytracer
-from reprozip.common import setup_logging, \
+from reprozip.common import DATA_COMPRESSIONS, setup_logging, \
     setup_usage_report, enable_usage_report, \
-    submit_usage_report, record_usage
+    submit_usage_report, record_usage, create_trace_views
 import reprozip.pack
 import reprozip.tracer.trace
 import reprozip.traceutils
@@ -69,6 +70,7 @@ def print_db(database):
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
     conn.text_factory = lambda x: unicode_(x, 'utf-8', 'replace')
+    create_trace_views(conn)
 
     cur = conn.cursor()
     rows = cur.execute(
@@ -100,7 +102,7 @@ def print_db(database):
     rows = cur.execute(
         '''
         SELECT id, name, timestamp, process, argv
-        FROM executed_files;
+        FROM executed_paths;
         ''')
     print("\nExecuted files:")
     header = ("+--------+------------------+---------+------------------------"
@@ -128,7 +130,7 @@ def print_db(database):
     rows = cur.execute(
         '''
         SELECT id, name, timestamp, mode, process
-        FROM opened_files;
+        FROM opened_paths;
         ''')
     print("\nFiles:")
     header = ("+--------+------------------+---------+------+-----------------"
@@ -147,6 +149,24 @@ def print_db(database):
         print(header)
     cur.close()
 
+    tables = set(r[0] for r in conn.execute(
+        '''
+        SELECT name FROM sqlite_master WHERE type='table';
+        '''))
+    if 'counters' in tables:
+        cur = conn.cursor()
+        rows = cur.execute(
+            '''
+            SELECT run_id, name, value
+            FROM counters;
+            ''')
+        rows = list(rows)
+        if rows:
+            print("\nCounters:")
+            for r_run, r_name, r_value in rows:
+                print("  run %d: %s = %d" % (r_run, r_name, r_value))
+        cur.close()
+
     conn.close()
 
 
@@ -167,7 +187,8 @@ def testrun(args):
             argv = args.cmdline
         logger.debug("Starting tracer, binary=%r, argv=%r",
                      args.cmdline[0], argv)
-        c = _pytracer.execute(args.cmdline[0], argv, database.path)
+        c = _pytracer.execute(args.cmdline[0], argv, database.path,
+                              seccomp=args.seccomp, dedup=args.dedup)
         print("\n\n-----------------------------------------------------------"
               "--------------------")
         print_db(database)
@@ -205,7 +226,9 @@ def trace(args):
                                          argv,
                                          Path(args.dir),
                                          append,
-                                         args.verbosity)
+                                         args.verbosity,
+                                         seccomp=args.seccomp,
+                                         dedup=args.dedup)
     reprozip.tracer.trace.write_configuration(Path(args.dir),
                                               args.identify_packages,
                                               args.find_inputs_outputs,
@@ -234,7 +257,16 @@ def pack(args):
     if not target.unicodename.lower().endswith('.rpz'):
         target = Path(target.path + b'.rpz')
         logger.warning("Changing output filename to %s", target.unicodename)
-    reprozip.pack.pack(target, Path(args.dir), args.identify_packages)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    elif jobs < 1:
+        logger.critical("--jobs should be at least 1")
+        sys.exit(2)
+    reprozip.pack.pack(target, Path(args.dir), args.identify_packages,
+                       jobs=jobs, compression=args.compression,
+                       compression_level=args.compression_level,
+                       deduplicate=args.deduplicate)
 
 
 def combine(args):
@@ -332,6 +364,14 @@ def main():
         '-a',
         dest='arg0',
         help="argument 0 to program, if different from program path")
+    parser_trace.add_argument(
+        '--seccomp', action='store_true',
+        help="use a seccomp-BPF filter to only stop the program on relevant "
+             "syscalls (faster, needs Linux 4.8)")
+    parser_trace.add_argument(
+        '--dedup', action='store_true',
+        help="only record the first access to each file with each mode "
+             "(smaller trace, but the graph misses repeated accesses)")
     parser_trace.add_argument(
         '-c', '--continue', action='store_true', dest='append',
         help="add to the previous trace, don't replace it")
@@ -351,6 +391,14 @@ def main():
         '-a',
         dest='arg0',
         help="argument 0 to program, if different from program path")
+    parser_testrun.add_argument(
+        '--seccomp', action='store_true',
+        help="use a seccomp-BPF filter to only stop the program on relevant "
+             "syscalls (faster, needs Linux 4.8)")
+    parser_testrun.add_argument(
+        '--dedup', action='store_true',
+        help="only record the first access to each file with each mode "
+             "(smaller trace, but the graph misses repeated accesses)")
     parser_testrun.add_argument('cmdline', nargs=argparse.REMAINDER)
     parser_testrun.set_defaults(func=testrun)
 
@@ -366,6 +414,23 @@ def main():
         'pack',
         help="Packs the experiment according to the current configuration")
     add_options(parser_pack)
+    parser_pack.add_argument(
+        '-j', '--jobs', type=int,
+        help="number of threads used to compress the data (default: number "
+             "of CPUs)")
+    parser_pack.add_argument(
+        '--compression', default='gzip',
+        choices=sorted(DATA_COMPRESSIONS),
+        help="how to compress the data (default: gzip); older versions of "
+             "reprounzip can only read gzip")
+    parser_pack.add_argument(
+        '--compression-level', type=int,
+        help="compression level, whose meaning depends on --compression")
+    parser_pack.add_argument(
+        '--dont-deduplicate', action='store_false', default=True,
+        dest='deduplicate',
+        help="don't store identical files only once (they are otherwise "
+             "stored as hardlinks)")
     parser_pack.add_argument('target', nargs=argparse.OPTIONAL,
                              default='experiment.rpz',
                              help="Destination file")
@@ -11,21 +11,32 @@ and config YAML.
 
 from __future__ import division, print_function, unicode_literals
 
+import collections
+import gzip
+import hashlib
+import io
 import itertools
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 from rpaths import Path
+import stat
 import string
 import sys
 import tarfile
+import tempfile
+import time
 import uuid
+import zlib
 
 from reprozip import __version__ as reprozip_version
-from reprozip.common import File, load_config, save_config, \
-    record_usage_package
+from reprozip.common import DATA_COMPRESSIONS, DATA_DIGEST_HEADER, File, \
+    ConfigWriter, open_config, record_usage_package_counts, \
+    compression_module, write_data_index
 from reprozip.tracer.linux_pkgs import identify_packages
 from reprozip.traceutils import combine_files
-from reprozip.utils import iteritems
+from reprozip.utils import iteritems, itervalues, copyfile
 
 
 logger = logging.getLogger('reprozip')
@@ -77,6 +88,26 @@ def canonicalize_config(packages, other_files, additional_patterns,
     return packages, other_files
 
 
+def is_canonical_order(packages, other_files):
+    """Checks whether the packages and files are in the canonical order.
+
+    That is, packages sorted by name, and other files sorted by path and
+    listed only once. The files are only iterated on, so they don't have to
+    be in memory.
+    """
+    last = None
+    for pkg in packages:
+        if last is not None and pkg.name < last:
+            return False
+        last = pkg.name
+    last = None
+    for f in other_files:
+        if last is not None and f.path <= last:
+            return False
+        last = f.path
+    return True
+
+
 def data_path(filename, prefix=Path('DATA')):
     """Computes the filename to store in the archive.
 
@@ -93,12 +124,294 @@ def data_path(filename, prefix=Path('DATA')):
     return prefix / filename.split_root()[1]
 
 
+def hash_file(filename):
+    """Computes the SHA-256 digest of a file's contents.
+    """
+    h = hashlib.sha256()
+    with open(filename.path, 'rb') as fp:
+        chunk = fp.read(1 << 20)
+        while chunk:
+            h.update(chunk)
+            chunk = fp.read(1 << 20)
+    return h.digest()
+
+
+def header_mtime(mtime, format=tarfile.DEFAULT_FORMAT):
+    """Gets a modification time as it is stored in a tar header.
+
+    Only PAX headers keep the fractional part.
+    """
+    if format == tarfile.PAX_FORMAT:
+        return mtime
+    return int(mtime)
+
+
+def hash_duplicate_candidates(filenames, jobs=1):
+    """Hashes the regular files that might be identical to another one.
+
+    Only the files that have the same size, mode, owner and modification time
+    (as stored in the tar header) as another file are read, on `jobs`
+    threads: files that differ in these can't be stored as hardlinks to each
+    other. Returns a dictionary mapping these filenames to the digest of their
+    contents.
+    """
+    groups = {}
+    for filename in filenames:
+        try:
+            st = os.lstat(filename.path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            key = (st.st_size, st.st_mode, st.st_uid, st.st_gid,
+                   header_mtime(st.st_mtime))
+            groups.setdefault(key, set()).add(filename)
+    candidates = [filename
+                  for group in groups.values() if len(group) > 1
+                  for filename in group]
+    if not candidates:
+        return {}
+    logger.info("Hashing %d files to find duplicates...", len(candidates))
+    pool = ThreadPool(jobs)
+    try:
+        digests = pool.map(hash_file, candidates)
+    finally:
+        pool.terminate()
+    return dict(zip(candidates, digests))
+
+
+class HashingReader(object):
+    """File object computing the SHA-256 of the data read from another.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class TarMemberWriter(object):
+    """File object writing a new member directly into a tar file.
+
+    This allows adding a member without knowing its size in advance, and
+    without writing it to a temporary file first. A header is written with a
+    size of 0, the data is written after it, and the header is rewritten with
+    the right size when this is closed. The tar file must not be compressed,
+    and its file must be seekable.
+    """
+    def __init__(self, tar, name):
+        self.tar = tar
+        self.tarinfo = tarfile.TarInfo(name)
+        self.tarinfo.mtime = time.time()
+        self.tarinfo.mode = 0o644
+        self.tarinfo.offset = tar.offset
+        # GNU format can represent any size in the same header length
+        self.header_size = len(self._header())
+        self.tar.fileobj.write(self._header())
+        self.tarinfo.offset_data = tar.offset + self.header_size
+        self.size = 0
+
+    def _header(self):
+        return self.tarinfo.tobuf(tarfile.GNU_FORMAT, self.tar.encoding,
+                                  self.tar.errors)
+
+    def write(self, data):
+        self.tar.fileobj.write(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.tar.fileobj.flush()
+
+    def close(self):
+        if self.tarinfo is None:
+            return
+        fileobj = self.tar.fileobj
+
+        # Pads the data to a full block
+        remainder = self.size % tarfile.BLOCKSIZE
+        if remainder:
+            fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        end = fileobj.tell()
+
+        # Rewrites the header with the right size
+        self.tarinfo.size = self.size
+        header = self._header()
+        assert len(header) == self.header_size
+        fileobj.seek(self.tarinfo.offset)
+        fileobj.write(header)
+        fileobj.seek(end)
+
+        self.tar.offset = end
+        self.tar.members.append(self.tarinfo)
+        self.tarinfo = None
+
+
+def add_metadata(tar, name, data):
+    """Adds a member with the given bytes to a tar file.
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.mtime = time.time()
+    tarinfo.mode = 0o644
+    tarinfo.size = len(data)
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+class ParallelGzipWriter(object):
+    """File object compressing data with gzip on multiple threads.
+
+    The data is split in blocks that are compressed separately by a pool of
+    threads (zlib releases the GIL), and written in order to `fileobj` as
+    consecutive gzip members. The result is a valid gzip file, that can be
+    read by the gzip module or the gzip command.
+
+    The (uncompressed offset, compressed offset) of each member are recorded
+    in `blocks`, so that a reader can start decompressing at any of them.
+    """
+    def __init__(self, fileobj, jobs, level=9, block_size=1 << 20):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.jobs = jobs
+        self.pool = ThreadPool(jobs)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.position = 0
+        self.compressed_position = 0
+        self.blocks = []
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def _submit(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append((self.position - len(data),
+                             self.pool.apply_async(self._compress, (data,))))
+        # Don't queue up too many blocks
+        while len(self.pending) > 2 * self.jobs:
+            self._write_block()
+
+    def _write_block(self):
+        start, result = self.pending.popleft()
+        data = result.get()
+        self.blocks.append((start, self.compressed_position))
+        self.fileobj.write(data)
+        self.compressed_position += len(data)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.position += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.fileobj is None:
+            return
+        try:
+            if self.buffered:
+                self._submit()
+            while self.pending:
+                self._write_block()
+        finally:
+            self.pool.terminate()
+            self.fileobj = None
+
+
+# Modules needed for each compression, other than the standard ones
+COMPRESSION_MODULES = {
+    'xz': 'lzma',
+    'zstd': 'zstandard',
+    'lz4': 'lz4.frame',
+}
+
+
+def check_compression(compression):
+    """Checks that a compression can be used, before writing anything.
+
+    Raises ValueError if it is unknown or its module is not installed.
+    """
+    if compression not in DATA_COMPRESSIONS:
+        raise ValueError("Unknown compression %r" % compression)
+    if compression in COMPRESSION_MODULES:
+        compression_module(compression, COMPRESSION_MODULES[compression])
+
+
+def compressed_writer(fileobj, compression, level=None, jobs=1):
+    """Wraps a file object to compress the data written to it.
+
+    `compression` is one of the keys of `DATA_COMPRESSIONS`. If `level` is
+    None, the default level for that compression is used. `jobs` is the number
+    of threads to use, if the compression supports it.
+
+    Closing the returned object doesn't close `fileobj`.
+    """
+    if compression in COMPRESSION_MODULES:
+        module = compression_module(compression,
+                                    COMPRESSION_MODULES[compression])
+    if compression == 'gzip':
+        return ParallelGzipWriter(fileobj, jobs,
+                                  level=9 if level is None else level)
+    elif compression == 'xz':
+        return module.LZMAFile(fileobj, 'wb', preset=level)
+    elif compression == 'zstd':
+        compressor = module.ZstdCompressor(
+            level=3 if level is None else level,
+            threads=jobs if jobs > 1 else 0)
+        return compressor.stream_writer(fileobj, closefd=False)
+    elif compression == 'lz4':
+        return module.LZ4FrameFile(fileobj, 'wb',
+                                   compression_level=level or 0)
+    else:
+        raise ValueError("Unknown compression %r" % compression)
+
+
 class PackBuilder(object):
     """Higher layer on tarfile that adds intermediate directories.
+
+    The compressed tarball is written to `fileobj`, which is not closed by
+    `close()`. If `jobs` is more than 1, the data is compressed on that many
+    threads if the compression supports it. With gzip, the data is compressed
+    in independent blocks, whose offsets are in `blocks` once closed.
+
+    `digests` maps filenames to the digest of their contents (see
+    :func:`hash_duplicate_candidates`); a file with the same digest, mode,
+    owner and modification time as a file already added is stored as a
+    hardlink to it instead of being copied again.
+
+    If `index` is given, the index of the tarball is written to that binary
+    file object as members are added (see
+    :func:`~reprozip.common.write_data_index`), and they are not kept in
+    `tar.members`.
     """
-    def __init__(self, filename):
-        self.tar = tarfile.open(str(filename), 'w:gz')
+    def __init__(self, fileobj, jobs=1, compression='gzip', level=None,
+                 digests=None, index=None):
+        if compression == 'none':
+            self.compressor = None
+            self.tar = tarfile.open(fileobj=fileobj, mode='w:')
+        else:
+            self.compressor = compressed_writer(fileobj, compression, level,
+                                                jobs)
+            self.tar = tarfile.open(fileobj=self.compressor, mode='w:')
         self.seen = set()
+        self.blocks = None
+        self.digests = digests or {}
+        self.first_copies = {}
+        self.index = index
+        if index is not None:
+            write_data_index(index, [])
 
     def add_data(self, filename):
         if filename in self.seen:
@@ -109,21 +422,78 @@ class PackBuilder(object):
             if path in self.seen:
                 continue
             logger.debug("%s -> %s", path, data_path(path))
-            self.tar.add(str(path), str(data_path(path)), recursive=False)
+            self._add(path, str(data_path(path)))
             self.seen.add(path)
+            if self.index is not None:
+                write_data_index(self.index, self.tar.members, header=False)
+                del self.tar.members[:]
+
+    def _add(self, path, arcname):
+        tarinfo = self.tar.gettarinfo(str(path), arcname)
+        if tarinfo is None:
+            logger.debug("Not adding unsupported file %s", path)
+        elif tarinfo.isreg():
+            key = self.digests.get(path)
+            if key is not None:
+                # A hardlink gets the attributes of the first copy when
+                # extracted, so they have to match too
+                key = (key, tarinfo.mode, tarinfo.uid, tarinfo.gid,
+                       header_mtime(tarinfo.mtime, self.tar.format))
+            if key is not None and key in self.first_copies:
+                # Same content as a file we already added: store a hardlink
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self.first_copies[key]
+                tarinfo.size = 0
+                self._addfile(tarinfo)
+            else:
+                if key is not None:
+                    self.first_copies[key] = arcname
+                with path.open('rb') as fp:
+                    reader = HashingReader(fp)
+                    self._addfile(tarinfo, reader)
+                # Records the digest, for the index
+                self.tar.members[-1].pax_headers[DATA_DIGEST_HEADER] = \
+                    reader.hash.hexdigest()
+        else:
+            self._addfile(tarinfo)
+
+    def _addfile(self, tarinfo, fileobj=None):
+        offset = self.tar.offset
+        self.tar.addfile(tarinfo, fileobj)
+        # Records where the member was written, for the index
+        member = self.tar.members[-1]
+        member.offset = offset
+        member.offset_data = self.tar.offset
+        member.mtime = header_mtime(member.mtime, self.tar.format)
+        if fileobj is not None:
+            blocks, remainder = divmod(member.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                blocks += 1
+            member.offset_data -= blocks * tarfile.BLOCKSIZE
 
     def close(self):
         self.tar.close()
+        if self.compressor is not None:
+            self.compressor.close()
+            if isinstance(self.compressor, ParallelGzipWriter):
+                self.blocks = self.compressor.blocks
         self.seen = None
+        self.first_copies = None
 
 
-def pack(target, directory, sort_packages):
+def pack(target, directory, sort_packages, jobs=1, compression='gzip',
+         compression_level=None, deduplicate=True):
     """Main function for the pack subcommand.
     """
     if target.exists():
         # Don't overwrite packs...
         logger.critical("Target file exists!")
         sys.exit(1)
+    try:
+        check_compression(compression)
+    except ValueError as e:
+        logger.critical("%s", e)
+        sys.exit(1)
 
     # Reads configuration
     configfile = directory / 'config.yml'
@@ -133,7 +503,9 @@ def pack(target, directory, sort_packages):
                         "If not, you might want to use --dir to specify an "
                         "alternate location.")
         sys.exit(1)
-    runs, packages, other_files = config = load_config(
+    # The files are read from the configuration as they are needed, there
+    # might be a lot of them
+    runs, packages, other_files = config = open_config(
         configfile,
         canonical=False)
     additional_patterns = config.additional_patterns
@@ -151,19 +523,64 @@ def pack(target, directory, sort_packages):
             sys.exit(1)
 
     # Canonicalize config (re-sort, expand 'additional_files' patterns)
-    packages, other_files = canonicalize_config(
-        packages, other_files, additional_patterns, sort_packages)
+    if additional_patterns or not is_canonical_order(packages, other_files):
+        # Merging in the expanded patterns and sorting need all the files in
+        # memory; the configuration written by 'reprozip trace' is already
+        # sorted, so this is only needed if it was edited
+        packages, other_files = canonicalize_config(
+            list(packages), list(other_files), additional_patterns,
+            sort_packages)
+        packages = sorted(packages, key=lambda p: p.name)
+        other_files = sorted(set(other_files), key=lambda f: f.path)
+
+    # Finds identical files, to store them only once. Output files are left
+    # out, since writing to them would change the other copies
+    digests = None
+    if deduplicate:
+        output_paths = set(f.path for f in itervalues(inputs_outputs)
+                           if f.write_runs)
+
+        def packed_paths():
+            for pkg in packages:
+                if pkg.packfiles:
+                    for f in pkg.files:
+                        yield f.path
+            for f in other_files:
+                yield f.path
+
+        digests = hash_duplicate_candidates(
+            (path for path in packed_paths() if path not in output_paths),
+            jobs)
 
-    logger.info("Creating pack %s...", target)
-    tar = tarfile.open(str(target), 'w:')
+    # Generates a unique identifier for the pack (for usage reports purposes)
+    pack_id = str(uuid.uuid4())
 
-    fd, tmp = Path.tempfile()
-    os.close(fd)
+    # The canonical configuration is written as the files are added, to a
+    # temporary file since the data tarball comes first in the pack
+    config_fd, config_tmp = Path.tempfile('.yml', 'reprozip_config_')
+    config_fp = io.open(config_fd, 'w', encoding='utf-8', newline='\n')
+    index_tmp = tempfile.TemporaryFile()
+    tar = None
     try:
-        datatar = PackBuilder(tmp)
-        # Add the files from the packages
+        config_writer = ConfigWriter(config_fp, runs, reprozip_version,
+                                     inputs_outputs, canonical=True,
+                                     pack_id=pack_id)
+        index_gz = gzip.GzipFile(fileobj=index_tmp, mode='wb')
+
+        logger.info("Creating pack %s...", target)
+        tar = tarfile.open(str(target), 'w:')
+
+        # Writes the data tarball directly into the pack
+        data = TarMemberWriter(tar,
+                               'DATA.tar' + DATA_COMPRESSIONS[compression])
+        datatar = PackBuilder(data, jobs, compression, compression_level,
+                              digests, index_gz)
+        # Add the files from the packages, counting them for the usage report
+        nb_packages = nb_package_files = packed_packages = nb_other_files = 0
         for pkg in packages:
+            nb_packages += 1
             if pkg.packfiles:
+                packed_packages += 1
                 logger.info("Adding files from package %s...", pkg.name)
                 files = []
                 for f in pkg.files:
@@ -176,66 +593,78 @@ def pack(target, directory, sort_packages):
                 pkg.files = files
             else:
                 logger.info("NOT adding files from package %s", pkg.name)
+            nb_package_files += len(pkg.files)
+            config_writer.write_package(pkg)
 
         # Add the rest of the files
         logger.info("Adding other files...")
-        files = set()
         for f in other_files:
             if not Path(f.path).exists():
                 logger.warning("Missing file %s", f.path)
             else:
                 datatar.add_data(f.path)
-                files.add(f)
-        other_files = files
+                config_writer.write_file(f)
+                nb_other_files += 1
+        config_writer.close()
+        config_fp.close()
         datatar.close()
-
-        tar.add(str(tmp), 'DATA.tar.gz')
-    finally:
-        tmp.remove()
-
-    logger.info("Adding metadata...")
-    # Stores pack version
-    fd, manifest = Path.tempfile(prefix='reprozip_', suffix='.txt')
-    os.close(fd)
-    try:
-        with manifest.open('wb') as fp:
-            fp.write(b'REPROZIP VERSION 2\n')
-        tar.add(str(manifest), 'METADATA/version')
-    finally:
-        manifest.remove()
-
-    # Stores the original trace
-    trace = directory / 'trace.sqlite3'
-    if not trace.is_file():
-        logger.critical("trace.sqlite3 is gone! Aborting")
-        sys.exit(1)
-    tar.add(str(trace), 'METADATA/trace.sqlite3')
-
-    # Checks that input files are packed
-    for name, f in iteritems(inputs_outputs):
-        if f.read_runs and not Path(f.path).exists():
-            logger.warning("File is designated as input (name %s) but is not "
-                           "to be packed: %s", name, f.path)
-
-    # Generates a unique identifier for the pack (for usage reports purposes)
-    pack_id = str(uuid.uuid4())
-
-    # Stores canonical config
-    fd, can_configfile = Path.tempfile(suffix='.yml', prefix='rpz_config_')
-    os.close(fd)
-    try:
-        save_config(can_configfile, runs, packages, other_files,
-                    reprozip_version,
-                    inputs_outputs, canonical=True,
-                    pack_id=pack_id)
-
-        tar.add(str(can_configfile), 'METADATA/config.yml')
+        data.close()
+
+        # Stores an index of the data tarball, so that unpackers can list it
+        # without decompressing it
+        index_gz.close()
+        index_tmp.seek(0)
+        index = TarMemberWriter(tar, 'METADATA/data-index.jsonl.gz')
+        copyfile(index_tmp, index, 1 << 20)
+        index.close()
+        if datatar.blocks:
+            # Stores the offsets of the compressed blocks, so that unpackers
+            # can get a member without decompressing what comes before it
+            add_metadata(tar, 'METADATA/data-blocks.json',
+                         json.dumps(datatar.blocks).encode('ascii'))
+
+        logger.info("Adding metadata...")
+        # Stores pack version
+        if compression == 'gzip':
+            add_metadata(tar, 'METADATA/version', b'REPROZIP VERSION 2\n')
+        else:
+            add_metadata(tar, 'METADATA/version', b'REPROZIP VERSION 3\n')
+            # Stores compression of the data tarball
+            add_metadata(tar, 'METADATA/compression',
+                         compression.encode('ascii') + b'\n')
+
+        # Stores the original trace
+        trace = directory / 'trace.sqlite3'
+        if not trace.is_file():
+            logger.critical("trace.sqlite3 is gone! Aborting")
+            sys.exit(1)
+        tar.add(str(trace), 'METADATA/trace.sqlite3')
+
+        # Checks that input files are packed
+        for name, f in iteritems(inputs_outputs):
+            if f.read_runs and not Path(f.path).exists():
+                logger.warning("File is designated as input (name %s) but "
+                               "is not to be packed: %s", name, f.path)
+
+        # Stores canonical config
+        with config_tmp.open('rb') as fp:
+            config = TarMemberWriter(tar, 'METADATA/config.yml')
+            copyfile(fp, config, 1 << 20)
+            config.close()
+
+        tar.close()
+    except BaseException:
+        # Don't leave an incomplete pack behind
+        if tar is not None:
+            tar.fileobj.close()
+            target.remove()
+        raise
     finally:
-        can_configfile.remove()
-
-    tar.close()
+        config_fp.close()
+        index_tmp.close()
+        config_tmp.remove()
 
     # Record some info to the usage report
-    record_usage_package(runs, packages, other_files,
-                         inputs_outputs,
-                         pack_id)
+    record_usage_package_counts(runs, nb_packages, nb_package_files,
+                                packed_packages, nb_other_files,
+                                inputs_outputs, pack_id)
@@ -10,6 +10,7 @@ depending on what Linux distribution we are running on.
 
 Currently supported package managers:
 - dpkg (Debian, Ubuntu)
+- rpm (Fedora, CentOS)
 """
 
 from __future__ import division, print_function, unicode_literals
@@ -17,11 +18,13 @@ from __future__ import division, print_function, unicode_literals
 import logging
 import platform
 from rpaths import Path
+import sqlite3
 import subprocess
 import time
 
 from reprozip.common import Package
-from reprozip.utils import iteritems, listvalues
+from reprozip.utils import PY3, unicode_, iteritems, itervalues, \
+    listvalues, cache_directory, dpkg_query, rpm_query, PathResolver
 
 
 logger = logging.getLogger('reprozip')
@@ -34,14 +37,18 @@ system_dirs = ('/bin', '/etc', '/lib', '/sbin', '/usr', '/var')
 class PkgManager(object):
     """Base class for package identifiers.
 
-    Subclasses should provide either `search_for_files` or `search_for_file`
-    which actually identifies the package for a file.
+    Subclasses should provide either `search_for_files` or
+    `_get_packages_for_file` which actually identifies the package for a file.
+    Subclasses that can list all the files of all the packages can instead use
+    a :class:`PackageIndex`, see `_search_index`.
     """
     def __init__(self):
         # Files that were not part of a package
         self.unknown_files = set()
         # All the packages identified, with their `files` attribute set
         self.packages = {}
+        # Caches which directories are system directories
+        self._resolver = PathResolver()
 
     def filter_files(self, files):
         seen_files = set()
@@ -88,73 +95,54 @@ class PkgManager(object):
 
     def _filter(self, f):
         # Special files
-        if any(f.path.lies_under(c) for c in magic_dirs):
+        if self._resolver.lies_under(f.path, magic_dirs):
             return True
 
         # If it's not in a system directory, no need to look for it
-        if (f.path.lies_under('/usr/local') or
-                not any(f.path.lies_under(c) for c in system_dirs)):
+        if (self._resolver.lies_under(f.path, ('/usr/local',)) or
+                not self._resolver.lies_under(f.path, system_dirs)):
             self.unknown_files.add(f)
             return True
 
         return False
 
-    def _get_packages_for_file(self, filename):
-        raise NotImplementedError
-
-    def _create_package(self, pkgname):
-        raise NotImplementedError
+    def _search_index(self, files, index_name):
+        """Identifies packages from a :class:`PackageIndex`.
 
-
-class DpkgManager(PkgManager):
-    """Package identifier for deb-based systems (Debian, Ubuntu).
-    """
-    def search_for_files(self, files):
+        This is used instead of `search_for_files` by subclasses that provide
+        `_update_index` and `_create_packages`.
+        """
         # Make a set of all the requested files
         requested = dict((f.path, f) for f in self.filter_files(files))
         found = {}  # {path: pkgname}
 
-        # Process /var/lib/dpkg/info/*.list
-        for listfile in Path('/var/lib/dpkg/info').listdir():
-            pkgname = listfile.unicodename[:-5]
-            # Removes :arch
-            pkgname = pkgname.split(':', 1)[0]
+        index = PackageIndex(cache_directory() / index_name)
+        try:
+            self._update_index(index)
 
-            if not listfile.unicodename.endswith('.list'):
-                continue
-            with listfile.open('rb') as fp:
-                # Read paths from the file
-                line = fp.readline()
-                while line:
-                    if line[-1:] == b'\n':
-                        line = line[:-1]
-                    path = Path(line)
-                    # If it's one of the requested paths
-                    if path in requested:
-                        # If we had assigned it to a package already, undo
-                        if path in found:
-                            found[path] = None
-                        # Else assign to the package
-                        else:
-                            found[path] = pkgname
-                    line = fp.readline()
+            for path in requested:
+                pkgnames = index.packages_for_file(path)
+                # Files listed by multiple packages are not assigned
+                if len(pkgnames) == 1:
+                    found[path] = pkgnames[0]
+        finally:
+            index.close()
+
+        # Get all the new packages at once
+        self.packages.update(self._create_packages(
+            set(itervalues(found)).difference(self.packages)))
 
         # Remaining files are not from packages
         self.unknown_files.update(
             f for f in files
-            if f.path in requested and found.get(f.path) is None)
+            if f.path in requested and found.get(f.path) not in self.packages)
 
         nb_pkg_files = 0
 
         for path, pkgname in iteritems(found):
-            if pkgname is None:
+            if pkgname not in self.packages:
                 continue
-            if pkgname in self.packages:
-                package = self.packages[pkgname]
-            else:
-                package = self._create_package(pkgname)
-                self.packages[pkgname] = package
-            package.add_file(requested.pop(path))
+            self.packages[pkgname].add_file(requested.pop(path))
             nb_pkg_files += 1
 
         logger.info("%d packages with %d files, and %d other files",
@@ -162,45 +150,252 @@ class DpkgManager(PkgManager):
                     nb_pkg_files,
                     len(self.unknown_files))
 
+    def _get_packages_for_file(self, filename):
+        raise NotImplementedError
+
+    def _create_package(self, pkgname):
+        raise NotImplementedError
+
+    def _update_index(self, index):
+        raise NotImplementedError
+
+    def _create_packages(self, pkgnames):
+        raise NotImplementedError
+
+
+class PackageIndex(object):
+    """Persistent index of the packages owning each file.
+
+    The index is kept in an SQLite database, and filled from "sources", files
+    of the package manager listing the files that packages contain (such as
+    dpkg's ``.list`` files). A source is only read again if its size or
+    modification time changed, so that building the index is only slow the
+    first time.
+
+    If the database can't be opened or updated (for example because another
+    process keeps it locked), an in-memory index is used instead.
+    """
+    VERSION = 1
+
+    # Seconds to wait for another process updating the same index
+    TIMEOUT = 60.0
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.conn = self._open(filename)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Couldn't open package index %s, it won't be "
+                           "saved: %s", filename, e)
+            self.filename = None
+            self.conn = self._open(None)
+
+    def _open(self, filename):
+        if filename is None:
+            conn = sqlite3.connect(':memory:')
+        else:
+            filename.parent.mkdir(parents=True)
+            if PY3:
+                # On PY3, connect() only accepts unicode
+                conn = sqlite3.connect(str(filename), timeout=self.TIMEOUT)
+            else:
+                conn = sqlite3.connect(filename.path, timeout=self.TIMEOUT)
+        version, = conn.execute('PRAGMA user_version;').fetchone()
+        if version != self.VERSION:
+            conn.executescript(
+                '''
+                DROP TABLE IF EXISTS sources;
+                DROP TABLE IF EXISTS files;
+                CREATE TABLE sources(
+                    name TEXT NOT NULL PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL
+                    );
+                CREATE TABLE files(
+                    path BLOB NOT NULL,
+                    source TEXT NOT NULL,
+                    package TEXT NOT NULL
+                    );
+                CREATE INDEX files_path_idx ON files(path);
+                CREATE INDEX files_source_idx ON files(source);
+                PRAGMA user_version = %d;
+                ''' % self.VERSION)
+        return conn
+
+    def update(self, sources, read_source):
+        """Brings the index up to date.
+
+        :param sources: The current sources, as a dict mapping source names to
+            the :class:`Path` to check for changes.
+        :param read_source: Function called with a source name and path for
+            each source that changed, returning an iterable of ``(path,
+            package)`` pairs where path is a bytes string.
+        """
+        try:
+            self._update(sources, read_source)
+        except sqlite3.Error as e:
+            if self.filename is None:
+                raise
+            logger.warning("Couldn't update package index %s, it won't be "
+                           "saved: %s", self.filename, e)
+            self.conn.close()
+            self.filename = None
+            self.conn = self._open(None)
+            self._update(sources, read_source)
+
+    def _update(self, sources, read_source):
+        known = dict((name, (mtime, size))
+                     for name, mtime, size in self.conn.execute(
+                         '''
+                         SELECT name, mtime, size FROM sources;
+                         '''))
+        removed = set(known).difference(sources)
+        nb_updated = 0
+        with self.conn:
+            for name in removed:
+                self.conn.execute(
+                    '''
+                    DELETE FROM files WHERE source = ?;
+                    ''',
+                    (name,))
+                self.conn.execute(
+                    '''
+                    DELETE FROM sources WHERE name = ?;
+                    ''',
+                    (name,))
+            for name, path in iteritems(sources):
+                stat = path.stat()
+                if known.get(name) == (stat.st_mtime, stat.st_size):
+                    continue
+                self.conn.execute(
+                    '''
+                    DELETE FROM files WHERE source = ?;
+                    ''',
+                    (name,))
+                self.conn.executemany(
+                    '''
+                    INSERT INTO files(path, source, package)
+                    VALUES(?, ?, ?);
+                    ''',
+                    ((sqlite3.Binary(filename), name, pkgname)
+                     for filename, pkgname in read_source(name, path)))
+                self.conn.execute(
+                    '''
+                    INSERT OR REPLACE INTO sources(name, mtime, size)
+                    VALUES(?, ?, ?);
+                    ''',
+                    (name, stat.st_mtime, stat.st_size))
+                nb_updated += 1
+        logger.debug("Package index: %d sources updated, %d removed",
+                     nb_updated, len(removed))
+
+    def packages_for_file(self, filename):
+        """Returns the packages listing a file, once per source listing it.
+        """
+        return [r[0] for r in self.conn.execute(
+            '''
+            SELECT package FROM files WHERE path = ?;
+            ''',
+            (sqlite3.Binary(filename.path),))]
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+
+class DpkgManager(PkgManager):
+    """Package identifier for deb-based systems (Debian, Ubuntu).
+    """
+    info_dir = Path('/var/lib/dpkg/info')
+
+    def search_for_files(self, files):
+        self._search_index(files, 'dpkg-files.sqlite3')
+
+    def _update_index(self, index):
+        # Read new or changed /var/lib/dpkg/info/*.list
+        index.update(dict((unicode_(listfile), listfile)
+                          for listfile in self.info_dir.listdir('*.list')),
+                     self._read_list_file)
+
+    @staticmethod
+    def _read_list_file(name, listfile):
+        pkgname = listfile.unicodename[:-5]
+        # Removes :arch
+        pkgname = pkgname.split(':', 1)[0]
+
+        with listfile.open('rb') as fp:
+            for line in fp:
+                if line[-1:] == b'\n':
+                    line = line[:-1]
+                yield Path(line).path, pkgname
+
     def _get_packages_for_file(self, filename):
         # This method is no longer used for dpkg: instead of querying each file
-        # using `dpkg -S`, we read all the list files once ourselves since it
-        # is faster
+        # using `dpkg -S`, we index all the list files ourselves since it is
+        # faster
         assert False
 
     def _create_package(self, pkgname):
-        p = subprocess.Popen(['dpkg-query',
-                              '--showformat=${Package}\t'
-                              '${Version}\t'
-                              '${Installed-Size}\n',
-                              '-W',
-                              pkgname],
-                             stdout=subprocess.PIPE)
-        try:
-            size = version = None
-            for line in p.stdout:
-                fields = line.split()
-                # Removes :arch
-                name = fields[0].decode('ascii').split(':', 1)[0]
-                if name == pkgname:
-                    version = fields[1].decode('ascii')
-                    size = int(fields[2].decode('ascii')) * 1024    # kbytes
-                    break
-            for line in p.stdout:  # finish draining stdout
-                pass
-        finally:
-            p.wait()
-        if p.returncode == 0:
+        return self._create_packages([pkgname]).get(pkgname)
+
+    def _create_packages(self, pkgnames):
+        packages = {}
+        infos = dpkg_query(pkgnames, ['Version', 'Installed-Size'])
+        for pkgname, (version, size) in iteritems(infos):
+            if size:
+                size = int(size) * 1024    # kbytes
+            else:
+                size = None
             pkg = Package(pkgname, version, size=size)
             logger.debug("Found package %s", pkg)
-            return pkg
-        else:
-            return None
+            packages[pkgname] = pkg
+        return packages
 
 
 class RpmManager(PkgManager):
     """Package identifier for rpm-based systems (Fedora, CentOS).
     """
+    # Files of the RPM database, one of which changes when packages change
+    database_files = ('rpmdb.sqlite', 'Packages.db', 'Packages')
+
+    def search_for_files(self, files):
+        self.database = self._find_database()
+        if self.database is not None:
+            self._search_index(files, 'rpm-files.sqlite3')
+        else:
+            logger.info("Couldn't find the RPM database, querying rpm for "
+                        "each file")
+            PkgManager.search_for_files(self, files)
+
+    def _find_database(self):
+        try:
+            dbpath = subprocess.check_output(['rpm', '--eval', '%{_dbpath}'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        dbpath = Path(dbpath.strip())
+        for name in self.database_files:
+            if (dbpath / name).is_file():
+                return dbpath / name
+        return None
+
+    def _update_index(self, index):
+        # Lists all the installed files again if the database changed
+        index.update({'rpmdb': self.database}, self._read_database)
+
+    @staticmethod
+    def _read_database(name, database):
+        p = subprocess.Popen(['rpm', '-qa',
+                              '--qf', '[%{FILENAMES}\t%{NAME}\\n]'],
+                             stdout=subprocess.PIPE)
+        try:
+            for line in p.stdout:
+                filename, sep, pkgname = line.rstrip(b'\n').rpartition(b'\t')
+                if sep and filename[:1] == b'/':
+                    yield (Path(filename).path,
+                           pkgname.decode('iso-8859-1'))
+        finally:
+            p.wait()
+
     def _get_packages_for_file(self, filename):
         p = subprocess.Popen(['rpm', '-qf', filename.path,
                               '--qf', '%{NAME}'],
@@ -214,19 +409,16 @@ class RpmManager(PkgManager):
                 if line]
 
     def _create_package(self, pkgname):
-        p = subprocess.Popen(['rpm', '-q', pkgname,
-                              '--qf', '%{VERSION}-%{RELEASE} %{SIZE}'],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        out, err = p.communicate()
-        if p.returncode == 0:
-            version, size = out.strip().decode('iso-8859-1').rsplit(' ', 1)
-            size = int(size)
-            pkg = Package(pkgname, version, size=size)
+        return self._create_packages([pkgname]).get(pkgname)
+
+    def _create_packages(self, pkgnames):
+        packages = {}
+        infos = rpm_query(pkgnames, ['%{VERSION}-%{RELEASE}', '%{SIZE}'])
+        for pkgname, (version, size) in iteritems(infos):
+            pkg = Package(pkgname, version, size=int(size))
             logger.debug("Found package %s", pkg)
-            return pkg
-        else:
-            return None
+            packages[pkgname] = pkg
+        return packages
 
 
 def identify_packages(files):
@@ -12,29 +12,96 @@ generation logic for the config YAML file.
 from __future__ import division, print_function, unicode_literals
 
 import warnings
-from collections import defaultdict
+from collections import namedtuple
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
 from itertools import count
 import logging
+from operator import itemgetter
 import os
 from pkg_resources import iter_entry_points
 import platform
 from rpaths import Path
 import sqlite3
+import stat
 import sys
 
 from reprozip import __version__ as reprozip_version
 from reprozip import _pytracer
 from reprozip.common import File, InputOutputFile, load_config, save_config, \
-    FILE_READ, FILE_WRITE, FILE_LINK
+    FILE_READ, FILE_WRITE, FILE_LINK, create_trace_views
 from reprozip.tracer.linux_pkgs import magic_dirs, system_dirs, \
     identify_packages
 from reprozip.utils import PY3, izip, iteritems, itervalues, \
-    unicode_, flatten, UniqueNames, hsize, normalize_path, find_all_links
+    unicode_, flatten, UniqueNames, hsize, normalize_path, find_all_links, \
+    PathResolver
 
 
 logger = logging.getLogger('reprozip')
 
 
+PathStat = namedtuple('PathStat', ['dev', 'ino', 'size', 'mode', 'mtime'])
+
+# Kinds of events replayed by get_files(), in the order they happen at the
+# same timestamp
+_EVENT_EXEC = 0
+_EVENT_ACCESS = 1
+_EVENT_READ = 2
+_EVENT_WRITE = 3
+
+
+class RunStates(MutableMapping):
+    """How a file was used by each run, as a mapping from run number to state.
+
+    The states are stored in the `TracedFile` itself, as an integer with 2
+    bits per run. Like the ``defaultdict`` this replaces, runs that didn't use
+    the file map to None, but they are not keys of the mapping.
+    """
+    __slots__ = ('file',)
+
+    def __init__(self, file_):
+        self.file = file_
+
+    def __getitem__(self, run):
+        state = (self.file._runs >> (2 * run)) & 3
+        return state - 1 if state else None
+
+    def get(self, run, default=None):
+        state = self[run]
+        return default if state is None else state
+
+    def __contains__(self, run):
+        return self[run] is not None
+
+    def __setitem__(self, run, state):
+        bits = self.file._runs & ~(3 << (2 * run))
+        if state is not None:
+            bits |= (state + 1) << (2 * run)
+        self.file._runs = bits
+
+    def __delitem__(self, run):
+        if self[run] is None:
+            raise KeyError(run)
+        self[run] = None
+
+    def __iter__(self):
+        bits = self.file._runs
+        run = 0
+        while bits:
+            if bits & 3:
+                yield run
+            bits >>= 2
+            run += 1
+
+    def __len__(self):
+        return sum(1 for run in self)
+
+    def __repr__(self):
+        return 'RunStates(%r)' % dict(self.items())
+
+
 class TracedFile(File):
     """Override of `~reprozip.common.File` that reads stats from filesystem.
 
@@ -57,22 +124,77 @@ class TracedFile(File):
     ONLY_READ = 1
     WRITTEN = 2
 
-    what = None
+    # There is one of these for every path the experiment accessed
+    __slots__ = ('what', 'mode', '_runs')
+
+    def __init__(self, path, path_stat=None):
+        """Creates a file from its path.
 
-    def __init__(self, path):
-        path = Path(path)
-        size = None
-        if path.exists():
+        `path_stat` is the `PathStat` recorded by the tracer, from lstat() on
+        the path. If it is None, or the path is a link, the filesystem is
+        queried instead.
+        """
+        if not isinstance(path, Path):
+            path = Path(path)
+        File.__init__(self, path)
+        self.what = None
+        self._runs = 0
+        self._set_stat(path_stat)
+
+    @property
+    def runs(self):
+        """The state of the file for each run, see `RunStates`.
+        """
+        return RunStates(self)
+
+    @runs.setter
+    def runs(self, runs):
+        runs = list(iteritems(runs))
+        self._runs = 0
+        states = RunStates(self)
+        for run, state in runs:
+            states[run] = state
+
+    def _set_stat(self, path_stat):
+        self.size = self.comment = self.mode = None
+        path = self.path
+        if (path_stat is not None and path_stat.mode is not None and
+                not stat.S_ISLNK(path_stat.mode)):
+            self.mode = path_stat.mode
+            if stat.S_ISDIR(path_stat.mode):
+                self.comment = "Directory"
+            else:
+                self.size = path_stat.size
+                self.comment = hsize(self.size)
+        elif path.exists():
             if path.is_link():
                 self.comment = "Link to %s" % path.read_link(absolute=True)
             elif path.is_dir():
                 self.comment = "Directory"
             else:
-                size = path.size()
-                self.comment = hsize(size)
-        self.what = None
-        self.runs = defaultdict(lambda: None)
-        File.__init__(self, path, size)
+                self.size = path.size()
+                self.comment = hsize(self.size)
+
+    def restat(self):
+        """Reads the metadata from the filesystem again.
+
+        This is needed for files that were written after the tracer recorded
+        their metadata.
+        """
+        try:
+            st = self.path.lstat()
+        except OSError:
+            self._set_stat(None)
+        else:
+            self._set_stat(PathStat(st.st_dev, st.st_ino, st.st_size,
+                                    st.st_mode, None))
+
+    def is_file(self):
+        """Returns True if this is a regular file.
+        """
+        if self.mode is not None:
+            return stat.S_ISREG(self.mode)
+        return self.path.is_file()
 
     def read(self, run):
         if self.what is None:
@@ -108,91 +230,162 @@ def get_files(conn):
     """Find all the files used by the experiment by reading the trace.
     """
     files = {}
-    access_files = [set()]
+    # Remembers the links in the directories we've seen
+    resolver = PathResolver()
+
+    create_trace_views(conn)
 
-    # Finds run timestamps, so we can sort input/output files by run
+    # Finds the runs, so we can sort input/output files by run
     proc_cursor = conn.cursor()
     executions = proc_cursor.execute(
         '''
-        SELECT timestamp
+        SELECT run_id
         FROM processes
         WHERE parent ISNULL
         ORDER BY id;
         ''')
-    run_timestamps = [r_timestamp for r_timestamp, in executions][1:]
+    runs = dict((r_run_id, run)
+                for run, (r_run_id,) in enumerate(executions))
     proc_cursor.close()
+    access_files = [set() for _ in range(max(len(runs), 1))]
+
+    # Reads the file metadata recorded by the tracer, if any
+    path_stats = {}
+    columns = set(r[1] for r in conn.execute(
+        '''
+        PRAGMA table_info(paths);
+        '''))
+    if 'mtime' in columns:
+        rows = conn.execute(
+            '''
+            SELECT name, dev, ino, size, mode, mtime
+            FROM paths
+            WHERE mode NOT NULL;
+            ''')
+        for r_name, r_dev, r_ino, r_size, r_mode, r_mtime in rows:
+            path_stats[normalize_path(r_name)] = PathStat(
+                r_dev, r_ino, r_size, r_mode, r_mtime)
 
     # Adds dynamic linkers
     for libdir in (Path('/lib'), Path('/lib64')):
         if libdir.exists():
             for linker in libdir.listdir('*ld-linux*'):
-                for filename in find_all_links(linker, True):
+                for filename in find_all_links(linker, True,
+                                               resolver=resolver):
                     if filename not in files:
                         f = TracedFile(filename)
                         f.read(None)
                         files[f.path] = f
 
-    # Loops on executed files, and opened files, at the same time
-    cur = conn.cursor()
-    rows = cur.execute(
-        '''
-        SELECT 'exec' AS event_type, name, NULL AS mode, timestamp
+    # Only the first execution, access, read and write of a path in a run
+    # change the result, so SQLite reduces the events to those. Opened links
+    # are kept apart since they are not dereferenced
+    events = '''
+        SELECT run_id, {path} AS path, 0 AS link,
+               min(timestamp) AS first, min(timestamp) AS first_exec,
+               NULL AS first_read, NULL AS first_write
         FROM executed_files
+        GROUP BY run_id, {path}
         UNION ALL
-        SELECT 'open' AS event_type, name, mode, timestamp
+        SELECT run_id, {path} AS path, mode & {link} AS link,
+               min(timestamp) AS first, NULL AS first_exec,
+               CASE WHEN mode & {read} THEN min(timestamp) END AS first_read,
+               CASE WHEN mode & {write} THEN min(timestamp) END AS first_write
         FROM opened_files
-        ORDER BY timestamp;
-        ''')
-    executed = set()
-    run = 0
-    for event_type, r_name, r_mode, r_timestamp in rows:
-        if event_type == 'exec':
-            r_mode = FILE_READ
-        r_name = Path(normalize_path(r_name))
-
-        # Stays on the current run
-        while run_timestamps and r_timestamp > run_timestamps[0]:
-            del run_timestamps[0]
-            access_files.append(set())
-            run += 1
+        GROUP BY run_id, {path}, mode
+        '''.format(path='path' if columns else 'name', link=FILE_LINK,
+                   read=FILE_READ, write=FILE_WRITE)
+    if columns:
+        # Paths are stored separately, the indexes on (run_id, path) cover
+        # the subqueries
+        sql = '''
+            SELECT p.name, e.run_id, e.link, min(e.first), min(e.first_exec),
+                   min(e.first_read), min(e.first_write)
+            FROM (%s) e
+            INNER JOIN paths p ON p.id = e.path
+            GROUP BY e.run_id, e.path, e.link;
+            ''' % events
+    else:
+        sql = '''
+            SELECT e.path, e.run_id, e.link, min(e.first), min(e.first_exec),
+                   min(e.first_read), min(e.first_write)
+            FROM (%s) e
+            GROUP BY e.run_id, e.path, e.link;
+            ''' % events
+
+    # Replays those events in order; at the same timestamp, an execution
+    # comes first, and a read comes before a write (the same open() call)
+    cur = conn.cursor()
+    rows = cur.execute(sql)
+    events = []
+    # A path appears in many events, use a single object for it
+    path_objects = {}
+    for (r_name, r_run_id, r_link,
+         r_first, r_exec, r_read, r_write) in rows:
+        r_name = normalize_path(r_name)
+        try:
+            r_name = path_objects[r_name]
+        except KeyError:
+            r_name = path_objects[r_name] = Path(r_name)
+        run = runs[r_run_id]
+        for r_timestamp, event_type in ((r_exec, _EVENT_EXEC),
+                                        (r_first, _EVENT_ACCESS),
+                                        (r_read, _EVENT_READ),
+                                        (r_write, _EVENT_WRITE)):
+            if r_timestamp is not None:
+                events.append((r_timestamp, event_type, run, r_name, r_link))
+    cur.close()
+    path_objects = None
+    events.sort(key=itemgetter(0, 1))
 
+    executed = set()
+    for r_timestamp, event_type, run, r_name, r_link in events:
         # Adds symbolic links as read files
-        for filename in find_all_links(r_name.parent if r_mode & FILE_LINK
-                                       else r_name, False):
+        for filename in find_all_links(r_name.parent if r_link else r_name,
+                                       False, resolver=resolver):
             if filename not in files:
                 f = TracedFile(filename)
                 f.read(run)
                 files[f.path] = f
+        # The recorded metadata is the target's, unless the path is a link
+        r_stat = path_stats.get(r_name)
         # Go to final target
-        if not r_mode & FILE_LINK:
-            r_name = r_name.resolve()
-        if event_type == 'exec':
+        if not r_link:
+            r_name = resolver.resolve(r_name)
+            if r_stat is not None and stat.S_ISLNK(r_stat.mode):
+                # The target might have been used directly too
+                r_stat = path_stats.get(r_name)
+        if event_type == _EVENT_EXEC:
             executed.add(r_name)
         if r_name not in files:
-            f = TracedFile(r_name)
+            f = TracedFile(r_name, r_stat)
             files[f.path] = f
         else:
             f = files[r_name]
-        if r_mode & FILE_READ:
+        if event_type in (_EVENT_EXEC, _EVENT_READ):
             f.read(run)
-        if r_mode & FILE_WRITE:
+        elif event_type == _EVENT_WRITE:
             f.write(run)
             # Mark the parent directory as read
             if r_name.parent not in files:
-                fp = TracedFile(r_name.parent)
+                fp = TracedFile(r_name.parent, path_stats.get(r_name.parent))
                 fp.read(run)
                 files[fp.path] = fp
 
         # Identifies input files
-        if r_name.is_file() and r_name not in executed:
-            access_files[-1].add(f)
-    cur.close()
+        if f.is_file() and r_name not in executed:
+            access_files[run].add(f)
+
+    # Written files changed after the tracer recorded their metadata
+    for fi in itervalues(files):
+        if fi.mode is not None and fi.what != TracedFile.ONLY_READ:
+            fi.restat()
 
     # Further filters input files
     inputs = [[fi.path
                for fi in lst
                # Input files are regular files,
-               if fi.path.is_file() and
+               if fi.is_file() and
                # ONLY_READ,
                fi.runs[r] == TracedFile.ONLY_READ and
                # not executable,
@@ -200,20 +393,18 @@ def get_files(conn):
                # not fi.path.stat().st_mode & 0b111 and
                fi.path not in executed and
                # not in a system directory
-               not any(fi.path.lies_under(m)
-                       for m in magic_dirs + system_dirs)]
+               not resolver.lies_under(fi.path, magic_dirs + system_dirs)]
               for r, lst in enumerate(access_files)]
 
     # Identify output files
     outputs = [[fi.path
                 for fi in lst
                 # Output files are regular files,
-                if fi.path.is_file() and
+                if fi.is_file() and
                 # WRITTEN
                 fi.runs[r] == TracedFile.WRITTEN and
                 # not in a system directory
-                not any(fi.path.lies_under(m)
-                        for m in magic_dirs + system_dirs)]
+                not resolver.lies_under(fi.path, magic_dirs + system_dirs)]
                for r, lst in enumerate(access_files)]
 
     # Run the list of files through the filter plugins
@@ -228,7 +419,7 @@ def get_files(conn):
         fi
         for fi in itervalues(files)
         if fi.what == TracedFile.READ_THEN_WRITTEN and
-        not any(fi.path.lies_under(m) for m in magic_dirs)]
+        not resolver.lies_under(fi.path, magic_dirs)]
     if read_then_written_files:
         logger.warning(
             "Some files were read and then written. We will only pack the "
@@ -241,8 +432,8 @@ def get_files(conn):
     files = set(
         fi
         for fi in itervalues(files)
-        if fi.what != TracedFile.WRITTEN and not any(fi.path.lies_under(m)
-                                                     for m in magic_dirs))
+        if fi.what != TracedFile.WRITTEN and
+        not resolver.lies_under(fi.path, magic_dirs))
     return files, inputs, outputs
 
 
@@ -296,8 +487,44 @@ def tty_prompt(prompt, chars):
             ostream.flush()
 
 
-def trace(binary, argv, directory, append, verbosity='unset'):
+def trace_is_current(database):
+    """Checks whether a trace database uses the current format.
+
+    The tracer can only append to traces that have the paths, blobs and
+    counters tables, and the file metadata in the paths table.
+    """
+    if PY3:
+        # On PY3, connect() only accepts unicode
+        conn = sqlite3.connect(str(database))
+    else:
+        conn = sqlite3.connect(database.path)
+    try:
+        rows = conn.execute(
+            '''
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name IN ('paths', 'blobs', 'counters');
+            ''')
+        if len(list(rows)) != 3:
+            return False
+        columns = set(r[1] for r in conn.execute(
+            '''
+            PRAGMA table_info(paths);
+            '''))
+        return 'mtime' in columns
+    finally:
+        conn.close()
+
+
+def trace(binary, argv, directory, append, verbosity='unset',
+          seccomp=False, dedup=False):
     """Main function for the trace subcommand.
+
+    If `seccomp` is True, the tracer installs a seccomp-BPF filter so it only
+    stops the program on the syscalls it records.
+
+    If `dedup` is True, the tracer only records the first access to each path
+    with a given mode. This is enough to build the configuration, but
+    ``reprounzip graph`` will miss the processes that accessed a file again.
     """
     if verbosity != 'unset':
         warnings.warn("The 'verbosity' parameter for trace() is deprecated. "
@@ -349,9 +576,16 @@ def trace(binary, argv, directory, append, verbosity='unset'):
 
     # Runs the trace
     database = directory / 'trace.sqlite3'
+    if database.exists() and not trace_is_current(database):
+        # Trace was made by an older version, convert it before adding to it
+        from reprozip.traceutils import combine_traces
+
+        logger.info("Upgrading existing trace to the current format")
+        combine_traces([database], directory)
     logger.info("Running program")
     # Might raise _pytracer.Error
-    c = _pytracer.execute(binary, argv, database.path)
+    c = _pytracer.execute(binary, argv, database.path, seccomp=seccomp,
+                          dedup=dedup)
     if c != 0:
         if c & 0x0100:
             logger.warning("Program appears to have been terminated by "
@@ -375,6 +609,7 @@ def write_configuration(directory, sort_packages, find_inputs_outputs,
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
 
     # Reads info from database
     files, inputs, outputs = get_files(conn)
@@ -398,7 +633,7 @@ def write_configuration(directory, sort_packages, find_inputs_outputs,
             '''
             SELECT e.name, e.argv, e.envp, e.workingdir, p.exitcode
             FROM processes p
-            JOIN executed_files e ON e.id=(
+            JOIN executed_paths e ON e.id=(
                 SELECT id FROM executed_files e2
                 WHERE e2.process=p.id
                 ORDER BY e2.id
@@ -417,7 +652,7 @@ def write_configuration(directory, sort_packages, find_inputs_outputs,
             '''
             SELECT e.name, e.argv, e.envp, e.workingdir, p.exitcode
             FROM processes p
-            JOIN executed_files e ON e.id=(
+            JOIN executed_paths e ON e.id=(
                 SELECT id FROM executed_files e2
                 WHERE e2.process=p.id
                 ORDER BY e2.id
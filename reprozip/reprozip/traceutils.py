@@ -15,6 +15,7 @@ import os
 from rpaths import Path
 import sqlite3
 
+from reprozip.common import create_trace_views
 from reprozip.tracer.trace import TracedFile
 from reprozip.utils import PY3, listvalues
 
@@ -40,10 +41,27 @@ def create_schema(conn):
         CREATE INDEX proc_parent_idx ON processes(parent);
         ''',
         '''
+        CREATE TABLE paths(
+            id INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL,
+            dev INTEGER,
+            ino INTEGER,
+            size INTEGER,
+            mode INTEGER,
+            mtime INTEGER
+            );
+        ''',
+        '''
+        CREATE TABLE blobs(
+            id INTEGER NOT NULL PRIMARY KEY,
+            data TEXT NOT NULL
+            );
+        ''',
+        '''
         CREATE TABLE opened_files(
             id INTEGER NOT NULL PRIMARY KEY,
             run_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
+            path INTEGER NOT NULL,
             timestamp INTEGER NOT NULL,
             mode INTEGER NOT NULL,
             is_directory BOOLEAN NOT NULL,
@@ -54,20 +72,35 @@ def create_schema(conn):
         CREATE INDEX open_proc_idx ON opened_files(process);
         ''',
         '''
+        CREATE INDEX open_run_path_idx
+        ON opened_files(run_id, path, mode, timestamp);
+        ''',
+        '''
         CREATE TABLE executed_files(
             id INTEGER NOT NULL PRIMARY KEY,
-            name TEXT NOT NULL,
+            path INTEGER NOT NULL,
             run_id INTEGER NOT NULL,
             timestamp INTEGER NOT NULL,
             process INTEGER NOT NULL,
-            argv TEXT NOT NULL,
-            envp TEXT NOT NULL,
-            workingdir TEXT NOT NULL
+            argv INTEGER NOT NULL,
+            envp INTEGER NOT NULL,
+            workingdir INTEGER NOT NULL
             );
         ''',
         '''
         CREATE INDEX exec_proc_idx ON executed_files(process);
         ''',
+        '''
+        CREATE INDEX exec_run_path_idx
+        ON executed_files(run_id, path, timestamp);
+        ''',
+        '''
+        CREATE TABLE counters(
+            run_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL
+            );
+        ''',
     ]
     for stmt in sql:
         conn.execute(stmt)
@@ -101,7 +134,8 @@ def combine_traces(traces, target):
     """Combines multiple trace databases into one.
 
     The runs from the original traces are appended ('run_id' field gets
-    translated to avoid conflicts).
+    translated to avoid conflicts). The result uses the current trace format,
+    so this can also be used to upgrade a single trace.
 
     :param traces: List of trace database filenames.
     :type traces: [Path]
@@ -142,6 +176,25 @@ def combine_traces(traces, target):
             new INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT
             );
         ''')
+    conn.execute(
+        '''
+        CREATE TABLE maps.map_paths(
+            id INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            dev INTEGER,
+            ino INTEGER,
+            size INTEGER,
+            mode INTEGER,
+            mtime INTEGER
+            );
+        ''')
+    conn.execute(
+        '''
+        CREATE TABLE maps.map_blobs(
+            id INTEGER NOT NULL PRIMARY KEY,
+            data TEXT NOT NULL UNIQUE
+            );
+        ''')
 
     # Do the merge
     for other in traces:
@@ -153,6 +206,7 @@ def combine_traces(traces, target):
             ATTACH DATABASE ? AS trace;
             ''',
             (str(other),))
+        create_trace_views(conn, 'trace', 'trace_')
 
         # Add runs to lookup table
         conn.execute(
@@ -195,17 +249,47 @@ def combine_traces(traces, target):
             ORDER BY t.id;
             ''')
 
+        # Add paths to lookup table, with their metadata if it was recorded
+        path_columns = set(r[1] for r in conn.execute(
+            '''
+            PRAGMA trace.table_info(paths);
+            '''))
+        if 'mtime' in path_columns:
+            conn.execute(
+                '''
+                INSERT OR IGNORE INTO maps.map_paths(name, dev, ino, size,
+                                                     mode, mtime)
+                SELECT name, dev, ino, size, mode, mtime
+                FROM trace.paths;
+                ''')
+        conn.execute(
+            '''
+            INSERT OR IGNORE INTO maps.map_paths(name)
+            SELECT name FROM trace_opened_paths
+            UNION SELECT name FROM trace_executed_paths
+            UNION SELECT workingdir FROM trace_executed_paths;
+            ''')
+
+        # Add argv and environments to lookup table
+        conn.execute(
+            '''
+            INSERT OR IGNORE INTO maps.map_blobs(data)
+            SELECT argv FROM trace_executed_paths
+            UNION SELECT envp FROM trace_executed_paths;
+            ''')
+
         # opened_files
         logger.info("Insert opened_files...")
         conn.execute(
             '''
-            INSERT INTO opened_files(run_id, name, timestamp,
+            INSERT INTO opened_files(run_id, path, timestamp,
                                      mode, is_directory, process)
-            SELECT r.new AS run_id, name, timestamp,
-                   mode, is_directory, p.new AS process
-            FROM trace.opened_files t
+            SELECT r.new AS run_id, n.id AS path, t.timestamp,
+                   t.mode, t.is_directory, p.new AS process
+            FROM trace_opened_paths t
             INNER JOIN maps.map_runs r ON t.run_id = r.old
             INNER JOIN maps.map_processes p ON t.process = p.old
+            INNER JOIN maps.map_paths n ON t.name = n.name
             ORDER BY t.id;
             ''')
 
@@ -213,16 +297,37 @@ def combine_traces(traces, target):
         logger.info("Insert executed_files...")
         conn.execute(
             '''
-            INSERT INTO executed_files(name, run_id, timestamp, process,
+            INSERT INTO executed_files(path, run_id, timestamp, process,
                                        argv, envp, workingdir)
-            SELECT name, r.new AS run_id, timestamp, p.new AS process,
-                   argv, envp, workingdir
-            FROM trace.executed_files t
+            SELECT n.id AS path, r.new AS run_id, t.timestamp,
+                   p.new AS process, a.id AS argv, v.id AS envp,
+                   w.id AS workingdir
+            FROM trace_executed_paths t
             INNER JOIN maps.map_runs r ON t.run_id = r.old
             INNER JOIN maps.map_processes p ON t.process = p.old
+            INNER JOIN maps.map_paths n ON t.name = n.name
+            INNER JOIN maps.map_paths w ON t.workingdir = w.name
+            INNER JOIN maps.map_blobs a ON t.argv = a.data
+            INNER JOIN maps.map_blobs v ON t.envp = v.data
             ORDER BY t.id;
             ''')
 
+        # counters
+        has_counters = list(conn.execute(
+            '''
+            SELECT name FROM trace.sqlite_master
+            WHERE type='table' AND name='counters';
+            '''))
+        if has_counters:
+            logger.info("Insert counters...")
+            conn.execute(
+                '''
+                INSERT INTO counters(run_id, name, value)
+                SELECT r.new AS run_id, name, value
+                FROM trace.counters t
+                INNER JOIN maps.map_runs r ON t.run_id = r.old;
+                ''')
+
         # Flush maps
         conn.execute(
             '''
@@ -239,11 +344,39 @@ def combine_traces(traces, target):
         conn.commit()
 
         # Detach
+        conn.execute(
+            '''
+            DROP VIEW trace_opened_paths;
+            ''')
+        conn.execute(
+            '''
+            DROP VIEW trace_executed_paths;
+            ''')
         conn.execute(
             '''
             DETACH DATABASE trace;
             ''')
 
+    # paths
+    logger.info("Insert paths...")
+    conn.execute(
+        '''
+        INSERT INTO paths(id, name, dev, ino, size, mode, mtime)
+        SELECT id, name, dev, ino, size, mode, mtime
+        FROM maps.map_paths
+        ORDER BY id;
+        ''')
+
+    # blobs
+    logger.info("Insert blobs...")
+    conn.execute(
+        '''
+        INSERT INTO blobs(id, data)
+        SELECT id, data
+        FROM maps.map_blobs
+        ORDER BY id;
+        ''')
+
     # See above.
     conn.commit()
 
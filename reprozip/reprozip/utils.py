@@ -143,6 +143,9 @@ def escape(s):
 class CommonEqualityMixin(object):
     """Common mixin providing comparison by comparing ``__dict__`` attributes.
     """
+    # Doesn't prevent subclasses from using __slots__
+    __slots__ = ()
+
     def __eq__(self, other):
         return (isinstance(other, self.__class__) and
                 self.__dict__ == other.__dict__)
@@ -277,36 +280,122 @@ def normalize_path(path):
     return path
 
 
-def find_all_links_recursive(filename, files):
-    path = Path('/')
-    for c in filename.components[1:]:
+class PathResolver(object):
+    """Resolves symbolic links in paths, remembering the results.
+
+    For each path and each of its parent directories, the canonical path and
+    the links crossed to get to it are only computed once, so resolving many
+    paths in the same directories doesn't read the same links over and over.
+    This assumes that the links don't change while the object is in use.
+    """
+    def __init__(self):
+        self._paths = {}
+        self._components = {}
+        self._dirs_under = {}
+        self._prefix_sets = {}
+
+    def _resolve_component(self, path):
+        try:
+            return self._components[path]
+        except KeyError:
+            pass
+        if path.is_link():
+            # Stops on loops, like realpath()
+            self._components[path] = path, [path]
+            target = os.readlink(path.path)
+            if target.startswith(b'/'):
+                start = Path('/')
+            else:
+                start = path.parent
+            real, links = self._walk(start, target.split(b'/'))
+            result = real, [path] + links
+        else:
+            result = path, []
+        self._components[path] = result
+        return result
+
+    def _walk(self, path, components):
         # At this point, path is a canonical path, and all links in it have
         # been resolved
+        links = []
+        for c in components:
+            if c in (b'', b'.'):
+                continue
+            elif c == b'..':
+                path = path.parent
+            else:
+                path, new_links = self._resolve_component(path / c)
+                links.extend(new_links)
+        return path, links
+
+    def find_links(self, filename):
+        """Returns the canonical path and the links crossed to get to it.
+        """
+        filename = Path(filename)
+        try:
+            return self._paths[filename]
+        except KeyError:
+            pass
+        assert filename.absolute()
+        directory = filename.parent
+        if directory == filename:
+            result = filename, []
+        else:
+            # Resolves the parent directory, which is usually already known,
+            # then the last component
+            real_dir, links = self.find_links(directory)
+            path, new_links = self._walk(real_dir,
+                                         [os.path.basename(filename.path)])
+            result = path, links + new_links
+        self._paths[filename] = result
+        return result
+
+    def resolve(self, filename):
+        """Returns the canonical path, like :meth:`rpaths.Path.resolve`.
+        """
+        return self.find_links(filename)[0]
 
-        # We add the next path component
-        path = path / c
+    def lies_under(self, path, prefixes):
+        """Indicates if `path` is one of `prefixes` or lies under one of them.
 
-        # That component is possibly a link
-        if path.is_link():
-            # Adds the link itself
-            files.add(path)
-
-            target = path.read_link(absolute=True)
-            # Here, target might contain a number of symlinks
-            if target not in files:
-                # Recurse on this new path
-                find_all_links_recursive(target, files)
-            # Restores the invariant; realpath might resolve several links here
-            path = path.resolve()
+        `prefixes` is a tuple. The result is remembered for the parent
+        directory.
+        """
+        path = Path(path)
+        try:
+            prefix_set = self._prefix_sets[prefixes]
+        except KeyError:
+            prefix_set = frozenset(Path(p) for p in prefixes)
+            self._prefix_sets[prefixes] = prefix_set
+        if path in prefix_set:
+            return True
+        directory = path.parent
+        if directory == path:
+            return False
+        key = directory, prefixes
+        try:
+            return self._dirs_under[key]
+        except KeyError:
+            result = any(directory.lies_under(p) for p in prefixes)
+            self._dirs_under[key] = result
+            return result
+
+
+def find_all_links_recursive(filename, files):
+    path, links = PathResolver().find_links(filename)
+    files.update(links)
     return path
 
 
-def find_all_links(filename, include_target=False):
+def find_all_links(filename, include_target=False, resolver=None):
     """Dereferences symlinks from a path.
 
     If include_target is True, this also returns the real path of the final
     target.
 
+    `resolver` is a :class:`PathResolver` to use, to share the links that were
+    already read between calls.
+
     Example:
         /
             a -> b
@@ -319,11 +408,10 @@ def find_all_links(filename, include_target=False):
     >>> find_all_links('/a/g/e', True)
     ['/a', '/b/c', '/b/g', '/b/d/e', '/f']
     """
-    files = set()
-    filename = Path(filename)
-    assert filename.absolute()
-    path = find_all_links_recursive(filename, files)
-    files = list(files)
+    if resolver is None:
+        resolver = PathResolver()
+    path, links = resolver.find_links(filename)
+    files = list(set(links))
     if include_target:
         files.append(path)
     return files
@@ -411,6 +499,64 @@ def rmtree_fixed(path):
 check_output = subprocess.check_output
 
 
+class SeekableStream(object):
+    """Makes a readable stream seekable by re-opening it when needed.
+
+    Seeking forward reads and discards data, seeking backward opens the stream
+    again by calling `open_stream` and reads from the start. This is what the
+    gzip module does to seek in compressed files.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, open_stream):
+        self._open_stream = open_stream
+        self._stream = open_stream()
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while size != 0:
+            chunk = self._stream.read(size if size > 0 else self.CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self._position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            self.read()
+            offset += self._position
+        if offset < self._position:
+            self._stream.close()
+            self._stream = self._open_stream()
+            self._position = 0
+        while self._position < offset:
+            if not self.read(min(offset - self._position, self.CHUNK_SIZE)):
+                break
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
 def copyfile(source, destination, CHUNK_SIZE=4096):
     """Copies from one file object to another.
     """
@@ -422,6 +568,89 @@ def copyfile(source, destination, CHUNK_SIZE=4096):
             break
 
 
+def dpkg_query(packages, fields):
+    """Gets information on installed Debian packages.
+
+    This runs a single ``dpkg-query`` for all the packages, rather than one per
+    package.
+
+    :param packages: Names of the packages to query.
+    :param fields: Names of the dpkg fields to get, e.g. ``['Version']``.
+    :returns: A dict mapping package names to the list of field values, as
+        unicode strings. Packages that are not installed are absent.
+    """
+    packages = list(packages)
+    if not packages:
+        return {}
+
+    p = subprocess.Popen(['dpkg-query',
+                          '--showformat=${Package}\t${Status}\t' +
+                          ''.join('${%s}\t' % f for f in fields) + '\n',
+                          '-W'] + packages,
+                         stdout=subprocess.PIPE)
+    result = {}
+    try:
+        for line in p.stdout:
+            values = line.decode('utf-8', 'replace').split('\t')
+            # Removes :arch
+            name = values[0].split(':', 1)[0]
+            if name not in result and values[1].endswith(' installed'):
+                result[name] = values[2:2 + len(fields)]
+    finally:
+        p.wait()
+
+    return result
+
+
+def rpm_query(packages, formats):
+    """Gets information on installed RPM packages.
+
+    This runs a single ``rpm -q`` for all the packages, rather than one per
+    package.
+
+    :param packages: Names of the packages to query.
+    :param formats: rpm query format of each value to get, e.g.
+        ``['%{VERSION}-%{RELEASE}']``.
+    :returns: A dict mapping package names to the list of values, as
+        unicode strings. Packages that are not installed are absent.
+    """
+    packages = list(packages)
+    if not packages:
+        return {}
+
+    # Lines we want are marked with '+', since rpm also writes errors about
+    # packages that are not installed to stdout
+    p = subprocess.Popen(['rpm', '-q'] + packages +
+                         ['--qf',
+                          '+%{NAME}' + ''.join('\t' + f for f in formats) +
+                          '\\n'],
+                         stdout=subprocess.PIPE)
+    result = {}
+    try:
+        for line in p.stdout:
+            if line[:1] != b'+':
+                continue
+            values = line[1:].rstrip(b'\n').decode('iso-8859-1').split('\t')
+            if values[0] not in result and len(values) == len(formats) + 1:
+                result[values[0]] = values[1:]
+    finally:
+        p.wait()
+
+    return result
+
+
+def cache_directory():
+    """Returns the directory where reprozip caches data.
+
+    This is ``~/.cache/reprozip/``, unless ``XDG_CACHE_HOME`` is set.
+    """
+    if 'XDG_CACHE_HOME' in os.environ:
+        cache = Path(os.environ['XDG_CACHE_HOME'])
+    else:
+        cache = Path('~/.cache').expand_user()
+    return cache / 'reprozip'
+
+
 def download_file(url, dest, cachename=None, ssl_verify=None):
     """Downloads a file using a local cache.
 
@@ -437,11 +666,7 @@ def download_file(url, dest, cachename=None, ssl_verify=None):
 
     headers = {}
 
-    if 'XDG_CACHE_HOME' in os.environ:
-        cache = Path(os.environ['XDG_CACHE_HOME'])
-    else:
-        cache = Path('~/.cache').expand_user()
-    cache = cache / 'reprozip' / cachename
+    cache = cache_directory() / cachename
     if cache.exists():
         mtime = email.utils.formatdate(cache.mtime(), usegmt=True)
         headers['If-Modified-Since'] = mtime
@@ -25,7 +25,7 @@ sources = [os.path.join('native', n) for n in sources]
 
 
 # Setup the libraries
-libraries = ['sqlite3', 'rt']
+libraries = ['sqlite3', 'rt', 'pthread']
 
 
 # Build the C module
@@ -52,6 +52,9 @@ setup(name='reprozip',
               'python = reprozip.filters:python',
               'builtin = reprozip.filters:builtin']},
       install_requires=req,
+      extras_require={
+          'zstd': ['zstandard>=0.15'],
+          'lz4': ['lz4']},
       description="Linux tool enabling reproducible experiments (packer)",
       author="Remi Rampin, Fernando Chirigati, Dennis Shasha, Juliana Freire",
       author_email='reprozip-users@vgc.poly.edu',
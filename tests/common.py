@@ -4,13 +4,52 @@
 
 from __future__ import print_function, unicode_literals
 
+import contextlib
+import io
 from rpaths import Path
 import sqlite3
+import subprocess
 
 from reprounzip.utils import PY3
 
 
-def make_database(insert, path=None):
+@contextlib.contextmanager
+def fake_popen(output):
+    """Replaces `subprocess.Popen` with processes printing canned output.
+
+    `output` is a function getting the command line and returning the bytes
+    written to stdout. The command lines are appended to the yielded list.
+    """
+    calls = []
+
+    class FakeProcess(object):
+        def __init__(self, args, **kwargs):
+            calls.append(args)
+            self.stdout = io.BytesIO(output(args))
+            self.returncode = None
+
+        def wait(self):
+            self.returncode = 0
+            return 0
+
+    old_popen, subprocess.Popen = subprocess.Popen, FakeProcess
+    try:
+        yield calls
+    finally:
+        subprocess.Popen = old_popen
+
+
+def make_database(insert, path=None, version='0.8'):
+    """Creates a trace database with the given events.
+
+    `version` selects the schema: '0.8' stores the names, argv and
+    environment in the event tables, '0.9' stores them in the paths and
+    blobs tables (without file metadata).
+    """
+    if version not in ('0.8', '0.9'):
+        raise ValueError("Unknown trace version %r" % version)
+    interned = version == '0.9'
+
     if path is not None:
         path = Path(path)
         if PY3:
@@ -37,18 +76,43 @@ def make_database(insert, path=None):
         '''
         CREATE INDEX proc_parent_idx ON processes(parent);
         ''')
+    if interned:
+        conn.execute(
+            '''
+            CREATE TABLE paths(
+                id INTEGER NOT NULL PRIMARY KEY,
+                name TEXT NOT NULL,
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mode INTEGER,
+                mtime INTEGER
+                );
+            ''')
+        conn.execute(
+            '''
+            CREATE TABLE blobs(
+                id INTEGER NOT NULL PRIMARY KEY,
+                data TEXT NOT NULL
+                );
+            ''')
+        name_type = 'path INTEGER'
+        text_type = 'INTEGER'
+    else:
+        name_type = 'name TEXT'
+        text_type = 'TEXT'
     conn.execute(
         '''
         CREATE TABLE opened_files(
             id INTEGER NOT NULL PRIMARY KEY,
             run_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
+            {name} NOT NULL,
             timestamp INTEGER NOT NULL,
             mode INTEGER NOT NULL,
             is_directory BOOLEAN NOT NULL,
             process INTEGER NOT NULL
             );
-        ''')
+        '''.format(name=name_type))
     conn.execute(
         '''
         CREATE INDEX open_proc_idx ON opened_files(process);
@@ -57,49 +121,74 @@ def make_database(insert, path=None):
         '''
         CREATE TABLE executed_files(
             id INTEGER NOT NULL PRIMARY KEY,
-            name TEXT NOT NULL,
+            {name} NOT NULL,
             run_id INTEGER NOT NULL,
             timestamp INTEGER NOT NULL,
             process INTEGER NOT NULL,
-            argv TEXT NOT NULL,
-            envp TEXT NOT NULL,
-            workingdir TEXT NOT NULL
+            argv {text} NOT NULL,
+            envp {text} NOT NULL,
+            workingdir {text} NOT NULL
             );
-        ''')
+        '''.format(name=name_type, text=text_type))
     conn.execute(
         '''
         CREATE INDEX exec_proc_idx ON executed_files(process);
         ''')
 
+    ids = {}
+
+    def intern(table, value):
+        # Returns the value itself in the old schema, its id in the new one
+        if not interned:
+            return value
+        key = table, value
+        if key not in ids:
+            column = 'name' if table == 'paths' else 'data'
+            ids[key] = conn.execute(
+                '''
+                INSERT INTO {table}({column}) VALUES(?);
+                '''.format(table=table, column=column),
+                (value,)).lastrowid
+        return ids[key]
+
+    name_column = 'path' if interned else 'name'
+
+    # Each process without a parent starts a new run
+    run_id = -1
     for timestamp, l in enumerate(insert):
         if l[0] == 'proc':
             ident, parent, is_thread = l[1:]
+            if parent is None:
+                run_id += 1
             conn.execute(
                 '''
                 INSERT INTO processes(id, run_id, parent, timestamp,
                                       is_thread, exitcode)
-                VALUES(?, 0, ?, ?, ?, 0);
+                VALUES(?, ?, ?, ?, ?, 0);
                 ''',
-                (ident, parent, timestamp, is_thread))
+                (ident, run_id, parent, timestamp, is_thread))
         elif l[0] == 'open':
             process, name, is_dir, mode = l[1:]
             conn.execute(
                 '''
-                INSERT INTO opened_files(run_id, name, timestamp, mode,
+                INSERT INTO opened_files(run_id, {name}, timestamp, mode,
                                          is_directory, process)
-                VALUES(0, ?, ?, ?, ?, ?);
-                ''',
-                (name, timestamp, mode, is_dir, process))
+                VALUES(?, ?, ?, ?, ?, ?);
+                '''.format(name=name_column),
+                (run_id, intern('paths', name), timestamp, mode, is_dir,
+                 process))
         elif l[0] == 'exec':
             process, name, wdir, argv = l[1:]
             conn.execute(
                 '''
-                INSERT INTO executed_files(run_id, name, timestamp,
+                INSERT INTO executed_files(run_id, {name}, timestamp,
                                            process, argv, envp,
                                            workingdir)
-                VALUES(0, ?, ?, ?, ?, "", ?);
-                ''',
-                (name, timestamp, process, argv, wdir))
+                VALUES(?, ?, ?, ?, ?, ?, ?);
+                '''.format(name=name_column),
+                (run_id, intern('paths', name), timestamp, process,
+                 intern('blobs', argv), intern('blobs', ''),
+                 intern('paths', wdir)))
         else:
             assert False
 
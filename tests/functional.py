@@ -17,7 +17,7 @@ import subprocess
 import sys
 import yaml
 
-from reprounzip.common import FILE_READ, FILE_WRITE
+from reprounzip.common import FILE_READ, FILE_WRITE, create_trace_views
 from reprounzip.unpackers.common import join_root
 from reprounzip.utils import PY3, stderr_bytes, stderr
 
@@ -122,6 +122,58 @@ def check_output(args, stream='out'):
     return output
 
 
+def connect_trace(directory):
+    database = Path(directory).absolute() / 'trace.sqlite3'
+    if PY3:
+        # On PY3, connect() only accepts unicode
+        conn = sqlite3.connect(str(database))
+    else:
+        conn = sqlite3.connect(database.path)
+    conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
+    return conn
+
+
+def traced_rows(directory):
+    """Gets the accesses and executions of a trace, without timestamps.
+    """
+    conn = connect_trace(directory)
+    opened = sorted(
+        tuple(r) for r in conn.execute(
+            '''
+            SELECT name, mode, is_directory FROM opened_paths
+            '''))
+    executed = sorted(
+        tuple(r) for r in conn.execute(
+            '''
+            SELECT name, argv, envp, workingdir FROM executed_paths
+            '''))
+    conn.close()
+    return opened, executed
+
+
+GET_FILES = '''\
+import sqlite3, sys
+from reprozip.tracer.trace import get_files
+conn = sqlite3.connect(sys.argv[1])
+conn.row_factory = sqlite3.Row
+files, inputs, outputs = get_files(conn)
+print(repr(sorted((f.path.path, f.what, sorted(f.runs.items()))
+                  for f in files)))
+print(repr([sorted(p.path for p in lst) for lst in inputs]))
+print(repr([sorted(p.path for p in lst) for lst in outputs]))
+'''
+
+
+def traced_files(python, directory):
+    """Gets the output of reprozip's get_files() on a trace, as text.
+
+    This runs in the reprozip interpreter, that might not be this one.
+    """
+    database = Path(directory).absolute() / 'trace.sqlite3'
+    return check_output([python, '-c', GET_FILES, database.path])
+
+
 def build(target, sources, args=[]):
     check_call(['/usr/bin/env', 'CFLAGS=', 'cc', '-o', target] +
                [(tests / s).path
@@ -182,6 +234,55 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
     check_call(rpuz + ['graph', 'graph.dot'])
     check_call(rpuz + ['graph', 'graph2.dot', 'experiment.rpz'])
 
+    # ########################################
+    # testrun with seccomp filter: same accesses as without it
+    #
+
+    seccomp_cmd = ['bash', '-c',
+                   'cat /etc/passwd >/dev/null;'
+                   'cd /var/lib;'
+                   'cat ../../etc/group >/dev/null;'
+                   '/bin/echo outputhere']
+    output = check_output(rpz + ['testrun', '--seccomp'] + seccomp_cmd)
+    assert b'outputhere' in output.splitlines()
+    check_call(rpz + ['trace', '--overwrite', '-d', 'noseccomp-trace'] +
+               seccomp_cmd)
+    check_call(rpz + ['trace', '--overwrite', '-d', 'seccomp-trace',
+                      '--seccomp'] + seccomp_cmd)
+    assert traced_rows('seccomp-trace') == traced_rows('noseccomp-trace')
+
+    # ########################################
+    # trace with --dedup: repeated accesses are only counted
+    #
+
+    dedup_cmd = ['bash', '-c',
+                 'cat /etc/passwd /etc/passwd >/dev/null;'
+                 'cat /etc/passwd >/dev/null;'
+                 'echo data >dedup_out;'
+                 'cat dedup_out dedup_out >/dev/null']
+    check_call(rpz + ['trace', '--overwrite', '-d', 'nodedup-trace'] +
+               dedup_cmd)
+    check_call(rpz + ['trace', '--overwrite', '-d', 'dedup-trace',
+                      '--dedup'] + dedup_cmd)
+    conn = connect_trace('dedup-trace')
+    rows = list(conn.execute(
+        '''
+        SELECT run_id, name, mode, COUNT(*) FROM opened_paths
+        GROUP BY run_id, name, mode
+        HAVING COUNT(*) > 1
+        '''))
+    assert not rows, rows
+    rows = list(conn.execute(
+        '''
+        SELECT value FROM counters
+        WHERE name = 'suppressed_file_accesses'
+        '''))
+    conn.close()
+    assert len(rows) == 1 and rows[0][0] > 0
+    reprozip_python = os.environ.get('REPROZIP_PYTHON', sys.executable)
+    assert (traced_files(reprozip_python, 'dedup-trace') ==
+            traced_files(reprozip_python, 'nodedup-trace'))
+
     sudo = ['sudo', '-E']  # -E to keep REPROZIP_USAGE_STATS
 
     # ########################################
@@ -613,9 +714,10 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
     rows = conn.execute(
         '''
-        SELECT name FROM opened_files
+        SELECT name FROM opened_paths
         ''')
     files = set(Path(r[0]) for r in rows)
     for n in ('dir1/file', 'dir2/file', 'dir2/brokensymlink', 'dir2/symlink'):
@@ -649,9 +751,10 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
     rows = list(conn.execute(
         '''
-        SELECT mode FROM opened_files
+        SELECT mode FROM opened_paths
         WHERE name = ?
         ''',
         (str(Path('readwrite_test/existing').absolute()),)))
@@ -670,9 +773,10 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
     rows = list(conn.execute(
         '''
-        SELECT mode FROM opened_files
+        SELECT mode FROM opened_paths
         WHERE name = ?
         ''',
         (str(Path('readwrite_test/nonexisting').absolute()),)))
@@ -721,15 +825,16 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    create_trace_views(conn)
     rows = conn.execute(
         '''
-        SELECT name FROM opened_files
+        SELECT name FROM opened_paths
         ''')
     opened = [Path(r[0]) for r in rows
               if r[0].startswith('%s/' % Path.cwd())]
     rows = conn.execute(
         '''
-        SELECT name, argv FROM executed_files
+        SELECT name, argv FROM executed_paths
         ''')
     executed = [(Path(r[0]), r[1]) for r in rows
                 if Path(r[0]).lies_under(Path.cwd())]
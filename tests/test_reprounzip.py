@@ -5,12 +5,16 @@
 from __future__ import print_function, unicode_literals
 
 import os
+from rpaths import Path
 import sys
 import unittest
 import warnings
 
+from reprounzip.common import load_config_document
 from reprounzip.signals import Signal
 import reprounzip.unpackers.common
+from reprounzip.unpackers.default import ld_so_conf_stamp, library_dirs, \
+    shared_object_dirs
 
 
 class TestSignals(unittest.TestCase):
@@ -180,3 +184,67 @@ class TestCommon(unittest.TestCase):
                 })
         finally:
             os.environ = old_environ
+
+    def test_config_cache(self):
+        """Tests caching the parsed configuration file."""
+        tmp = Path.tempdir()
+        try:
+            config = tmp / 'config.yml'
+            with config.open('w') as fp:
+                fp.write('version: "0.9"\nruns: []\n')
+            self.assertEqual(load_config_document(config),
+                             {'version': '0.9', 'runs': []})
+            self.assertTrue((tmp / '.config.yml.cache').is_file())
+            self.assertEqual(load_config_document(config),
+                             {'version': '0.9', 'runs': []})
+
+            # The cache is not used once the file changes
+            with config.open('w') as fp:
+                fp.write('version: "0.9"\nruns: [{id: run0}]\n')
+            self.assertEqual(load_config_document(config),
+                             {'version': '0.9', 'runs': [{'id': 'run0'}]})
+        finally:
+            tmp.rmtree()
+
+    def test_library_dirs(self):
+        """Tests finding and caching the library directories."""
+        tmp = Path.tempdir()
+        try:
+            elf = b'\x7FELF\x02\x01\x01' + b'\x00' * 9 + b'\x03\x00'
+            (tmp / 'usr' / 'lib' / 'sub').mkdir(parents=True)
+            (tmp / 'opt' / 'app' / 'lib').mkdir(parents=True)
+            site = tmp / 'usr' / 'lib' / 'python3' / 'site-packages'
+            (site / 'numpy' / 'core').mkdir(parents=True)
+            (site / 'numpy.libs').mkdir(parents=True)
+            with (tmp / 'usr' / 'lib' / 'libfoo.so.1').open('wb') as fp:
+                fp.write(elf)
+            with (tmp / 'opt' / 'app' / 'lib' / 'libbar.so').open('wb') as fp:
+                fp.write(elf)
+            # Plugins and extension modules are loaded by path
+            with (tmp / 'opt' / 'app' / 'plugin.so').open('wb') as fp:
+                fp.write(elf)
+            with (site / 'numpy' / 'core' /
+                  '_multiarray_umath.cpython-37m-x86_64-linux-gnu.so').open(
+                    'wb') as fp:
+                fp.write(elf)
+            # Libraries bundled with a wheel are found through RUNPATH
+            with (site / 'numpy.libs' / 'libopenblas-r0.so').open('wb') as fp:
+                fp.write(elf)
+            # Not a shared library
+            with (tmp / 'usr' / 'lib' / 'sub' / 'notes.so.txt').open(
+                    'wb') as fp:
+                fp.write(b'hello')
+            (tmp / 'usr' / 'lib' / 'sub' / 'libfoo.so').symlink(
+                '../libfoo.so.1')
+            self.assertEqual(shared_object_dirs(tmp),
+                             ['/opt/app/lib', '/usr/lib'])
+
+            # Uses the cached list if ld.so.conf didn't change
+            info = {'library_dirs': {'ldconfig': ['/lib', '/usr/lib'],
+                                     'ld_so_conf': ld_so_conf_stamp(),
+                                     'shared_objects': ['/opt/app',
+                                                        '/usr/lib']}}
+            self.assertEqual(library_dirs(info, tmp),
+                             ['/lib', '/usr/lib', '/opt/app'])
+        finally:
+            tmp.rmtree()
@@ -4,19 +4,35 @@
 
 from __future__ import print_function, unicode_literals
 
+import gzip
+import io
 import os
 
 import sqlite3
 from rpaths import AbstractPath, Path
+import stat
 import sys
+import tarfile
+import tempfile
 import unittest
 
-from reprozip.common import FILE_READ, FILE_WRITE, FILE_WDIR, InputOutputFile
-from reprozip.tracer.trace import get_files, compile_inputs_outputs
+from reprozip.common import FILE_READ, FILE_WRITE, FILE_WDIR, \
+    DATA_COMPRESSIONS, DATA_INDEX_FIELDS, ConfigWriter, File, \
+    InputOutputFile, Package, RPZPack, create_trace_views, decompress_data, \
+    iter_config, load_config, open_config, read_data_index, save_config, \
+    write_data_index
+from reprozip.pack import PackBuilder, ParallelGzipWriter, \
+    TarMemberWriter, add_metadata, data_path, hash_duplicate_candidates, pack
+from reprozip.tracer.linux_pkgs import DpkgManager, PackageIndex, \
+    RpmManager
+from reprozip.tracer.trace import get_files, compile_inputs_outputs, \
+    PathStat, TracedFile
 from reprozip import traceutils
-from reprozip.utils import PY3, unicode_, UniqueNames, make_dir_writable
+from reprozip.utils import PY3, unicode_, UniqueNames, dpkg_query, \
+    make_dir_writable, rpm_query
+from reprounzip.unpackers.common import ObjectStore
 
-from tests.common import make_database
+from tests.common import fake_popen, make_database
 
 
 class TestReprozip(unittest.TestCase):
@@ -132,8 +148,8 @@ class TestNames(unittest.TestCase):
 
 
 class TestFiles(unittest.TestCase):
-    def do_test(self, insert):
-        conn = make_database(insert)
+    def do_test(self, insert, version='0.8'):
+        conn = make_database(insert, version=version)
 
         try:
             files, inputs, outputs = get_files(conn)
@@ -160,67 +176,137 @@ class TestFiles(unittest.TestCase):
         self.assertEqual(self.make_paths(objs), second)
 
     def test_get_files(self):
-        files, inputs, outputs = self.do_test([
-            ('proc', 0, None, False),
-            ('open', 0, "/some/dir", True, FILE_WDIR),
-            ('exec', 0, "/some/dir/ls", "/some/dir", "ls\0"),
-            ('open', 0, "/some/otherdir/in", False, FILE_READ),
-            ('open', 0, "/some/thing/created", True, FILE_WRITE),
-            ('proc', 1, 0, False),
-            ('open', 1, "/some/thing/created/file", False, FILE_WRITE),
-            ('open', 1, "/some/thing/created/file", False, FILE_READ),
-            ('open', 1, "/some/thing/created", True, FILE_WDIR),
-            ('exec', 0, "/some/thing/created/file", "/some/thing/created",
-             "created\0"),
-        ])
-        expected = set([
-            '/some/dir',
-            '/some/dir/ls',
-            '/some/otherdir/in',
-            '/some/thing',
-        ])
-        self.assertEqualPaths(expected,
-                              set(fi.path for fi in files))
-
-    def test_multiple_runs(self):
-        def fail(s):
-            assert False, "Shouldn't be called?"
-        old = Path.is_file, Path.stat
-        Path.is_file = lambda s: True
-        Path.stat = fail
-        try:
+        for version in ('0.8', '0.9'):
             files, inputs, outputs = self.do_test([
                 ('proc', 0, None, False),
                 ('open', 0, "/some/dir", True, FILE_WDIR),
-                ('exec', 0, "/some/dir/ls", "/some/dir", b'ls\0/some/cli\0'),
-                ('open', 0, "/some/cli", False, FILE_WRITE),
-                ('open', 0, "/some/r", False, FILE_READ),
-                ('open', 0, "/some/rw", False, FILE_READ),
-                ('proc', 1, None, False),
-                ('open', 1, "/some/dir", True, FILE_WDIR),
-                ('exec', 1, "/some/dir/ls", "/some/dir", b'ls\0'),
-                ('open', 1, "/some/cli", False, FILE_READ),
-                ('proc', 2, 1, True),
-                ('open', 2, "/some/r", False, FILE_READ),
-                ('open', 1, "/some/rw", False, FILE_WRITE),
-            ])
+                ('exec', 0, "/some/dir/ls", "/some/dir", "ls\0"),
+                ('open', 0, "/some/otherdir/in", False, FILE_READ),
+                ('open', 0, "/some/thing/created", True, FILE_WRITE),
+                ('proc', 1, 0, False),
+                ('open', 1, "/some/thing/created/file", False, FILE_WRITE),
+                ('open', 1, "/some/thing/created/file", False, FILE_READ),
+                ('open', 1, "/some/thing/created", True, FILE_WDIR),
+                ('exec', 0, "/some/thing/created/file", "/some/thing/created",
+                 "created\0"),
+            ], version)
             expected = set([
-                '/some',
                 '/some/dir',
                 '/some/dir/ls',
-                '/some/r',
-                '/some/rw',
+                '/some/otherdir/in',
+                '/some/thing',
             ])
             self.assertEqualPaths(expected,
                                   set(fi.path for fi in files))
-            self.assertEqualPaths([set(["/some/r", "/some/rw"]),
-                                   set(["/some/cli", "/some/r"])],
-                                  [set(l) for l in inputs])
-            self.assertEqualPaths([set(["/some/cli"]), set(["/some/rw"])],
-                                  [set(l) for l in outputs])
+
+    def test_multiple_runs(self):
+        def fail(s):
+            assert False, "Shouldn't be called?"
+        old = Path.is_file, Path.stat
+        Path.is_file = lambda s: True
+        Path.stat = fail
+        try:
+            for version in ('0.8', '0.9'):
+                files, inputs, outputs = self.do_test([
+                    ('proc', 0, None, False),
+                    ('open', 0, "/some/dir", True, FILE_WDIR),
+                    ('exec', 0, "/some/dir/ls", "/some/dir",
+                     b'ls\0/some/cli\0'),
+                    ('open', 0, "/some/cli", False, FILE_WRITE),
+                    ('open', 0, "/some/r", False, FILE_READ),
+                    ('open', 0, "/some/rw", False, FILE_READ),
+                    ('proc', 1, None, False),
+                    ('open', 1, "/some/dir", True, FILE_WDIR),
+                    ('exec', 1, "/some/dir/ls", "/some/dir", b'ls\0'),
+                    ('open', 1, "/some/cli", False, FILE_READ),
+                    ('proc', 2, 1, True),
+                    ('open', 2, "/some/r", False, FILE_READ),
+                    ('open', 1, "/some/rw", False, FILE_WRITE),
+                ], version)
+                expected = set([
+                    '/some',
+                    '/some/dir',
+                    '/some/dir/ls',
+                    '/some/r',
+                    '/some/rw',
+                ])
+                self.assertEqualPaths(expected,
+                                      set(fi.path for fi in files))
+                self.assertEqualPaths([set(["/some/r", "/some/rw"]),
+                                       set(["/some/cli", "/some/r"])],
+                                      [set(l) for l in inputs])
+                self.assertEqualPaths([set(["/some/cli"]), set(["/some/rw"])],
+                                      [set(l) for l in outputs])
         finally:
             Path.is_file, Path.stat = old
 
+    def test_traced_stat(self):
+        f = TracedFile('/nonexistent/file',
+                       PathStat(1, 2, 2048, stat.S_IFREG | 0o644, 0))
+        self.assertEqual((f.size, f.comment, f.is_file()),
+                         (2048, "2.00 KB", True))
+        f = TracedFile('/nonexistent/dir',
+                       PathStat(1, 3, 4096, stat.S_IFDIR | 0o755, 0))
+        self.assertEqual((f.size, f.comment, f.is_file()),
+                         (None, "Directory", False))
+        f.restat()
+        self.assertEqual((f.size, f.comment, f.is_file()),
+                         (None, None, False))
+
+    def test_run_states(self):
+        """Tests recording how each run used a file."""
+        f = TracedFile('/nonexistent/file',
+                       PathStat(1, 2, 2048, stat.S_IFREG | 0o644, 0))
+        f.read(0)
+        f.write(2)
+        f.read(2)
+        f.read(40)
+        f.write(40)
+        f.read(None)
+        self.assertEqual(f.what, TracedFile.READ_THEN_WRITTEN)
+        self.assertEqual(f.runs[0], TracedFile.ONLY_READ)
+        self.assertIsNone(f.runs[1])
+        self.assertEqual(f.runs[2], TracedFile.WRITTEN)
+        self.assertEqual(f.runs[40], TracedFile.READ_THEN_WRITTEN)
+        self.assertEqual(sorted(f.runs.items()),
+                         [(0, TracedFile.ONLY_READ),
+                          (2, TracedFile.WRITTEN),
+                          (40, TracedFile.READ_THEN_WRITTEN)])
+        self.assertEqual(len(f.runs), 3)
+
+    def test_run_states_mapping(self):
+        """Uses the run states like the dict filter plugins used to get."""
+        f = TracedFile('/nonexistent/file',
+                       PathStat(1, 2, 2048, stat.S_IFREG | 0o644, 0))
+        f.read(0)
+        f.write(3)
+        self.assertEqual(sorted(f.runs.keys()), [0, 3])
+        self.assertEqual(sorted(f.runs.values()),
+                         [TracedFile.ONLY_READ, TracedFile.WRITTEN])
+        self.assertEqual(f.runs.get(3), TracedFile.WRITTEN)
+        self.assertEqual(f.runs.get(1, 'unused'), 'unused')
+        self.assertIn(0, f.runs)
+        self.assertNotIn(1, f.runs)
+        self.assertEqual(dict(f.runs), {0: TracedFile.ONLY_READ,
+                                        3: TracedFile.WRITTEN})
+
+        # Assigning a mapping replaces all the states
+        f.runs = {1: TracedFile.READ_THEN_WRITTEN, 2: None}
+        self.assertEqual(dict(f.runs), {1: TracedFile.READ_THEN_WRITTEN})
+        other = TracedFile('/nonexistent/other')
+        other.runs = f.runs
+        other.runs[4] = TracedFile.ONLY_READ
+        self.assertEqual(dict(other.runs), {1: TracedFile.READ_THEN_WRITTEN,
+                                            4: TracedFile.ONLY_READ})
+        self.assertEqual(dict(f.runs), {1: TracedFile.READ_THEN_WRITTEN})
+        f.runs = f.runs
+        self.assertEqual(dict(f.runs), {1: TracedFile.READ_THEN_WRITTEN})
+
+        del other.runs[1]
+        self.assertEqual(dict(other.runs), {4: TracedFile.ONLY_READ})
+        with self.assertRaises(KeyError):
+            del other.runs[1]
+
 
 class TestCombine(unittest.TestCase):
     def setUp(self):
@@ -313,20 +399,30 @@ INSERT INTO "executed_files" VALUES(1,'/bin/false',0,12345678903002,0,'false',
         else:
             conn = sqlite3.connect(target.path)
         conn.row_factory = None
+        create_trace_views(conn)
         processes = list(conn.execute(
             '''
             SELECT * FROM processes;
             '''))
         opened_files = list(conn.execute(
             '''
-            SELECT * FROM opened_files;
+            SELECT * FROM opened_paths;
             '''))
         executed_files = list(conn.execute(
             '''
-            SELECT * FROM executed_files;
+            SELECT * FROM executed_paths;
+            '''))
+        paths = list(conn.execute(
+            '''
+            SELECT name FROM paths ORDER BY name;
+            '''))
+        blobs = list(conn.execute(
+            '''
+            SELECT data FROM blobs ORDER BY data;
             '''))
 
-        self.assertEqual([processes, opened_files, executed_files], [
+        self.assertEqual([processes, opened_files, executed_files, paths,
+                          blobs], [
             [(1, 1, None, 12345678901001, 0, 0),
              (2, 2, None, 12345678902001, 0, 0),
              (3, 2, 1, 12345678902002, 1, 0),
@@ -347,4 +443,593 @@ INSERT INTO "executed_files" VALUES(1,'/bin/false',0,12345678903002,0,'false',
               'RUN=third', '/home/vagrant'),
              (3, '/bin/false', 4, 12345678903002, 6, 'false',
               'RUN=fourth', '/home')],
+
+            [('/bin/false',), ('/home',), ('/home/vagrant',), ('/lib/ld.so',),
+             ('/usr',), ('/usr/bin',), ('/usr/bin/id',)],
+
+            [('RUN=first',), ('RUN=fourth',), ('RUN=third',), ('false',),
+             ('id',)],
         ])
+
+
+class TestPackageManagers(unittest.TestCase):
+    # What dpkg-query prints for bash, libc6 (installed for two
+    # architectures), oldpkg (removed, configuration files remain) and
+    # missing (not known, only an error on stderr)
+    dpkg_output = (b'bash\tinstall ok installed\t5.0-4\t6424\t\n'
+                   b'libc6:amd64\tinstall ok installed\t2.28-10\t12337\t\n'
+                   b'libc6:i386\tinstall ok installed\t2.28-10\t12000\t\n'
+                   b'oldpkg\tdeinstall ok config-files\t1.2\t\t\n')
+
+    def test_dpkg_query(self):
+        """Parses the output of dpkg-query."""
+        with fake_popen(lambda args: self.dpkg_output) as calls:
+            infos = dpkg_query(['bash', 'libc6', 'oldpkg', 'missing'],
+                               ['Version', 'Installed-Size'])
+            self.assertEqual(dpkg_query([], ['Version']), {})
+        self.assertEqual(infos, {'bash': ['5.0-4', '6424'],
+                                 'libc6': ['2.28-10', '12337']})
+        # A single dpkg-query for all the packages
+        self.assertEqual(calls, [
+            ['dpkg-query',
+             '--showformat=${Package}\t${Status}\t${Version}\t'
+             '${Installed-Size}\t\n',
+             '-W', 'bash', 'libc6', 'oldpkg', 'missing']])
+
+    def test_dpkg_packages(self):
+        """Creates the packages from the output of dpkg-query."""
+        with fake_popen(lambda args: self.dpkg_output):
+            packages = DpkgManager()._create_packages(
+                ['bash', 'libc6', 'oldpkg', 'missing'])
+        self.assertEqual(sorted(packages), ['bash', 'libc6'])
+        self.assertEqual((packages['bash'].name, packages['bash'].version,
+                          packages['bash'].size),
+                         ('bash', '5.0-4', 6424 * 1024))
+        self.assertEqual(packages['libc6'].version, '2.28-10')
+
+    def test_rpm_query(self):
+        """Parses the output of rpm -q."""
+        # rpm writes its errors about missing packages to stdout; glibc is
+        # installed for two architectures
+        output = (b'+bash\t5.0-2.fc32\t6842\n'
+                  b'package missing is not installed\n'
+                  b'+glibc\t2.31-2.fc32\t6660\n'
+                  b'+glibc\t2.31-2.fc32\t6100\n')
+        with fake_popen(lambda args: output) as calls:
+            infos = rpm_query(['bash', 'missing', 'glibc'],
+                              ['%{VERSION}-%{RELEASE}', '%{SIZE}'])
+            packages = RpmManager()._create_packages(
+                ['bash', 'missing', 'glibc'])
+        self.assertEqual(infos, {'bash': ['5.0-2.fc32', '6842'],
+                                 'glibc': ['2.31-2.fc32', '6660']})
+        self.assertEqual(calls[0],
+                         ['rpm', '-q', 'bash', 'missing', 'glibc',
+                          '--qf', '+%{NAME}\t%{VERSION}-%{RELEASE}\t%{SIZE}'
+                          '\\n'])
+        self.assertEqual(sorted(packages), ['bash', 'glibc'])
+        self.assertEqual((packages['bash'].version, packages['bash'].size),
+                         ('5.0-2.fc32', 6842))
+
+    def test_rpm_index(self):
+        """Indexes the files listed by rpm -qa, again if the rpmdb changes."""
+        tmpdir = Path.tempdir()
+        try:
+            database = tmpdir / 'rpmdb.sqlite'
+            with database.open('wb') as fp:
+                fp.write(b'first')
+            outputs = [b'/usr/bin/bash\tbash\n'
+                       b'/usr/share/doc/bash\tbash\n'
+                       b'/usr/share/doc\tfilesystem\n'
+                       b'/usr/share/doc/odd\tname\tbash\n'
+                       b'(contains no files)\n',
+                       b'/usr/bin/zsh\tzsh\n']
+
+            manager = RpmManager()
+            manager.database = database
+            index_file = tmpdir / 'index.sqlite3'
+            with fake_popen(lambda args: outputs[len(calls) - 1]) as calls:
+                index = PackageIndex(index_file)
+                manager._update_index(index)
+                self.assertEqual(
+                    calls,
+                    [['rpm', '-qa', '--qf', '[%{FILENAMES}\t%{NAME}\\n]']])
+                self.assertEqual(
+                    index.packages_for_file(Path('/usr/bin/bash')), ['bash'])
+                self.assertEqual(
+                    index.packages_for_file(Path('/usr/share/doc/odd\tname')),
+                    ['bash'])
+                self.assertEqual(
+                    index.packages_for_file(Path('/usr/share/doc')),
+                    ['filesystem'])
+                index.close()
+
+                # The rpmdb didn't change, the index is used as is
+                index = PackageIndex(index_file)
+                manager._update_index(index)
+                self.assertEqual(len(calls), 1)
+                index.close()
+
+                # Packages were installed or removed
+                with database.open('ab') as fp:
+                    fp.write(b' second')
+                index = PackageIndex(index_file)
+                manager._update_index(index)
+                self.assertEqual(len(calls), 2)
+                self.assertEqual(
+                    index.packages_for_file(Path('/usr/bin/zsh')), ['zsh'])
+                self.assertEqual(
+                    index.packages_for_file(Path('/usr/bin/bash')), [])
+                index.close()
+        finally:
+            tmpdir.rmtree()
+
+
+class TestPack(unittest.TestCase):
+    runs = [{'id': 'run0', 'argv': ['/bin/true'],
+             'architecture': 'x86_64', 'distribution': ['debian', '9']}]
+
+    def setUp(self):
+        self.tmpdir = Path.tempdir()
+
+    def tearDown(self):
+        self.tmpdir.rmtree()
+
+    def make_trace(self, packages, other_files, trace=True):
+        """Creates a trace directory, with a configuration listing the files.
+
+        The trace database is empty, or missing if `trace` is False.
+        """
+        directory = self.tmpdir / 'trace'
+        directory.mkdir()
+        if trace:
+            with (directory / 'trace.sqlite3').open('wb'):
+                pass
+        save_config(directory / 'config.yml', self.runs, packages,
+                    other_files, '1.0', {})
+        return directory
+
+    def test_package_index_update(self):
+        """Tests that the package index only re-reads changed sources."""
+        sources = {}
+        for name, lines in [('one', '/usr/bin/one\n/usr/share/doc\n'),
+                            ('two', '/usr/bin/two\n/usr/share/doc\n')]:
+            sources[name] = self.tmpdir / name
+            with sources[name].open('w') as fp:
+                fp.write(lines)
+
+        read = []
+
+        def read_source(name, path):
+            read.append(name)
+            with path.open('rb') as fp:
+                for line in fp:
+                    yield line.rstrip(b'\n'), name
+
+        index_file = self.tmpdir / 'index.sqlite3'
+        index = PackageIndex(index_file)
+        index.update(sources, read_source)
+        self.assertEqual(sorted(read), ['one', 'two'])
+        self.assertEqual(index.packages_for_file(Path('/usr/bin/one')),
+                         ['one'])
+        self.assertEqual(
+            sorted(index.packages_for_file(Path('/usr/share/doc'))),
+            ['one', 'two'])
+        self.assertEqual(index.packages_for_file(Path('/usr/bin/three')),
+                         [])
+        index.close()
+
+        # Change one source, remove the other
+        with sources['one'].open('w') as fp:
+            fp.write('/usr/bin/three\n')
+        del sources['two']
+        del read[:]
+        index = PackageIndex(index_file)
+        index.update(sources, read_source)
+        self.assertEqual(read, ['one'])
+        self.assertEqual(index.packages_for_file(Path('/usr/bin/three')),
+                         ['one'])
+        self.assertEqual(index.packages_for_file(Path('/usr/bin/one')), [])
+        self.assertEqual(index.packages_for_file(Path('/usr/share/doc')), [])
+
+        # Nothing changed
+        del read[:]
+        index.update(sources, read_source)
+        self.assertEqual(read, [])
+        index.close()
+
+    def test_package_index_locked(self):
+        """Tests that a locked package index is replaced by one in memory."""
+        source = self.tmpdir / 'one'
+        with source.open('w') as fp:
+            fp.write('/usr/bin/one\n')
+
+        def read_source(name, path):
+            with path.open('rb') as fp:
+                for line in fp:
+                    yield line.rstrip(b'\n'), name
+
+        index_file = self.tmpdir / 'index.sqlite3'
+        PackageIndex(index_file).close()
+
+        # Another process is writing to the index
+        other = sqlite3.connect(str(index_file), isolation_level=None)
+        other.execute('BEGIN IMMEDIATE;')
+        old_timeout, PackageIndex.TIMEOUT = PackageIndex.TIMEOUT, 0.1
+        try:
+            index = PackageIndex(index_file)
+            self.assertIsNotNone(index.filename)
+            index.update({'one': source}, read_source)
+            self.assertIsNone(index.filename)
+            self.assertEqual(index.packages_for_file(Path('/usr/bin/one')),
+                             ['one'])
+            index.close()
+        finally:
+            PackageIndex.TIMEOUT = old_timeout
+            other.rollback()
+            other.close()
+
+    def test_parallel_gzip_write(self):
+        """Tests that gzip files written by multiple threads can be read."""
+        data = [('%d\n' % i).encode('ascii') * (i + 1) for i in range(200)]
+        filename = self.tmpdir / 'data.gz'
+        with filename.open('wb') as fp:
+            writer = ParallelGzipWriter(fp, 4, block_size=1000)
+            for chunk in data:
+                writer.write(chunk)
+            self.assertEqual(writer.tell(), sum(len(c) for c in data))
+            writer.close()
+
+        with gzip.open(str(filename), 'rb') as fp:
+            self.assertEqual(fp.read(), b''.join(data))
+
+    def test_parallel_gzip_seek(self):
+        """Tests seeking in the blocks written by multiple threads."""
+        data = b''.join(('%d\n' % i).encode('ascii') * (i + 1)
+                        for i in range(200))
+        filename = self.tmpdir / 'data.gz'
+        with filename.open('wb') as fp:
+            writer = ParallelGzipWriter(fp, 4, block_size=1000)
+            for i in range(0, len(data), 300):
+                writer.write(data[i:i + 300])
+            writer.close()
+        self.assertEqual([start for start, offset in writer.blocks],
+                         list(range(0, len(data), 1200)))
+
+        with filename.open('rb') as fp:
+            reader = decompress_data(fp, 'gzip', writer.blocks)
+            for pos in (30000, 1199, 1200, 25, 36000, 36005, len(data) - 2):
+                reader.seek(pos)
+                self.assertEqual(reader.tell(), pos)
+                self.assertEqual(reader.read(3000), data[pos:pos + 3000])
+
+    def test_tar_member_writer(self):
+        """Tests writing members of unknown size directly into a tar file."""
+        filename = self.tmpdir / 'test.tar'
+        tar = tarfile.open(str(filename), 'w:')
+        member = TarMemberWriter(tar, 'first')
+        member.write(b'a' * 700)
+        # Some compressors flush their output file
+        member.flush()
+        member.write(b'b' * 700)
+        member.close()
+        add_metadata(tar, 'second', b'data')
+        member = TarMemberWriter(tar, 'empty')
+        member.close()
+        tar.close()
+
+        tar = tarfile.open(str(filename), 'r:')
+        self.assertEqual([(m.name, m.size) for m in tar.getmembers()],
+                         [('first', 1400), ('second', 4), ('empty', 0)])
+        self.assertEqual(tar.extractfile('first').read(),
+                         b'a' * 700 + b'b' * 700)
+        self.assertEqual(tar.extractfile('second').read(), b'data')
+        tar.close()
+
+    def test_config_streaming(self):
+        """Reads the files of a configuration incrementally."""
+        config = self.tmpdir / 'config.yml'
+        packages = [Package('pkg%d' % i, '1.0',
+                            [File(Path('/usr/lib/pkg%d/f%d' % (i, j)))
+                             for j in range(5)],
+                            packfiles=i != 1, size=1000)
+                    for i in range(3)]
+        other_files = [File(Path('/etc/f%d' % i)) for i in range(10)]
+        inputs_outputs = {'in': InputOutputFile(Path('/etc/f0'), [0], [])}
+        save_config(config, self.runs, packages, other_files, '1.0',
+                    inputs_outputs, canonical=True)
+
+        loaded = load_config(config, canonical=True)
+        opened = open_config(config, canonical=True)
+        self.assertEqual(opened.runs, loaded.runs)
+        self.assertEqual(opened.inputs_outputs, loaded.inputs_outputs)
+        self.assertEqual(opened.format_version, loaded.format_version)
+        # Files are read every time they are iterated on
+        for i in range(2):
+            self.assertEqual(list(opened.packages), loaded.packages)
+            self.assertEqual(list(opened.other_files), loaded.other_files)
+
+        sections = [key for key, value in iter_config(config)]
+        self.assertEqual(sections,
+                         ['version', 'runs', 'inputs_outputs'] +
+                         ['packages'] * 3 + ['other_files'] * 10)
+        self.assertEqual(dict(iter_config(config, files=False)),
+                         {'version': '0.9', 'runs': self.runs,
+                          'inputs_outputs': [{'name': 'in',
+                                              'path': '/etc/f0',
+                                              'read_by_runs': [0],
+                                              'written_by_runs': []}],
+                          'packages': None, 'other_files': None})
+
+        self.assertFalse(hasattr(loaded.other_files[0], '__dict__'))
+
+    def test_pack_canonical(self):
+        """Packs an edited configuration, sorting it in the pack."""
+        directory = self.make_trace([], [])
+        files = []
+        for name in ('c', 'a', 'b'):
+            path = self.tmpdir / name
+            with path.open('w') as fp:
+                fp.write(name)
+            files.append(File(path))
+        packages = [Package(name, '1.0', [], packfiles=False)
+                    for name in ('pkg2', 'pkg1')]
+        # Not sorted, and a file is listed twice
+        config = directory / 'config.yml'
+        with config.open('w', encoding='utf-8', newline='\n') as fp:
+            writer = ConfigWriter(fp, self.runs, '1.0', {})
+            for pkg in packages:
+                writer.write_package(pkg)
+            for f in files + files[:1]:
+                writer.write_file(f)
+            writer.close()
+
+        target = self.tmpdir / 'test.rpz'
+        pack(target, directory, False)
+        rpz_pack = RPZPack(target)
+        with rpz_pack.with_config() as packed:
+            loaded = load_config(packed, canonical=True)
+        rpz_pack.close()
+        self.assertEqual([pkg.name for pkg in loaded.packages],
+                         ['pkg1', 'pkg2'])
+        self.assertEqual([f.path for f in loaded.other_files],
+                         sorted(f.path for f in files))
+
+    def test_compressions(self):
+        """Writes and reads back a tarball with each compression."""
+        for compression in sorted(DATA_COMPRESSIONS):
+            filename = self.tmpdir / ('data-%s.tar' % compression)
+            with filename.open('wb') as fp:
+                try:
+                    builder = PackBuilder(fp, jobs=2,
+                                          compression=compression)
+                except ValueError:
+                    continue  # Module not installed
+                for name in ('one', 'two'):
+                    path = self.tmpdir / name
+                    with path.open('w') as member:
+                        member.write(name * 1000)
+                    builder.tar.add(str(path), name)
+                builder.close()
+
+            with filename.open('rb') as fp:
+                tar = tarfile.open(
+                    fileobj=decompress_data(fp, compression),
+                    mode='r:')
+                self.assertEqual(tar.getnames(), ['one', 'two'])
+                # Go back to the first member
+                member = tar.extractfile('one')
+                self.assertEqual(member.read(), b'one' * 1000)
+                tar.close()
+
+    def test_pack_failure(self):
+        """Tests that a failed pack doesn't leave files behind."""
+        directory = self.make_trace([], [File(self.tmpdir / 'trace')],
+                                    trace=False)
+        temp = self.tmpdir / 'temp'
+        temp.mkdir()
+        target = self.tmpdir / 'test.rpz'
+
+        old_tempdir, tempfile.tempdir = tempfile.tempdir, str(temp)
+        old_zstandard = sys.modules.get('zstandard')
+        sys.modules['zstandard'] = None  # Import fails
+        try:
+            # Compression module is missing
+            with self.assertRaises(SystemExit):
+                pack(target, directory, False, compression='zstd')
+            self.assertFalse(target.exists())
+            # The trace is missing
+            with self.assertRaises(SystemExit):
+                pack(target, directory, False, compression='none')
+            self.assertFalse(target.exists())
+            self.assertEqual(temp.listdir(), [])
+        finally:
+            tempfile.tempdir = old_tempdir
+            if old_zstandard is None:
+                del sys.modules['zstandard']
+            else:
+                sys.modules['zstandard'] = old_zstandard
+
+    def test_hardlinks(self):
+        """Packs identical files as hardlinks to the first copy."""
+        contents = {'one': 'first', 'two': 'other', 'three': 'first',
+                    'four': 'fourth', 'five': 'first', 'six': 'first'}
+        filenames = []
+        for name in ('one', 'two', 'three', 'four', 'five', 'six'):
+            path = self.tmpdir / name
+            with path.open('w') as fp:
+                fp.write(contents[name])
+            os.utime(path.path, (1500000000, 1500000000))
+            os.chmod(path.path, 0o644)
+            filenames.append(path)
+        # 'six' has the same contents but a different mode
+        os.chmod(filenames[5].path, 0o755)
+        digests = hash_duplicate_candidates(filenames, jobs=2)
+        # 'four' has a unique size and 'six' a unique mode, they don't need to
+        # be read
+        self.assertEqual(set(digests),
+                         set(filenames) - {filenames[3], filenames[5]})
+
+        data = self.tmpdir / 'data.tar'
+        with data.open('wb') as fp:
+            builder = PackBuilder(fp, compression='none', digests=digests)
+            for path in filenames:
+                builder.add_data(path)
+            builder.close()
+
+        tar = tarfile.open(str(data), 'r:')
+        members = dict((m.name.rsplit('/', 1)[-1], m)
+                       for m in tar.getmembers())
+        for name in ('one', 'two', 'four', 'six'):
+            self.assertTrue(members[name].isreg())
+        for name in ('three', 'five'):
+            self.assertTrue(members[name].islnk())
+            self.assertEqual(members[name].linkname, members['one'].name)
+        extracted = self.tmpdir / 'extracted'
+        tar.extractall(str(extracted))
+        tar.close()
+        for name, content in contents.items():
+            with (extracted / 'DATA' / filenames[0].parent.split_root()[1] /
+                  name).open('r') as fp:
+                self.assertEqual(fp.read(), content)
+        six = extracted / 'DATA' / filenames[5].split_root()[1]
+        self.assertEqual(six.stat().st_mode & 0o777, 0o755)
+
+    def test_subsecond_mtime(self):
+        """Links files whose modification times only differ below a second.
+
+        Unless the headers are PAX, only whole seconds are stored, so these
+        files look the same once packed.
+        """
+        filenames = []
+        for i, mtime in enumerate((1500000000.25, 1500000000.75)):
+            path = self.tmpdir / ('file%d' % i)
+            with path.open('w') as fp:
+                fp.write('same contents')
+            os.utime(path.path, (mtime, mtime))
+            filenames.append(path)
+        # A different second
+        path = self.tmpdir / 'file2'
+        with path.open('w') as fp:
+            fp.write('same contents')
+        os.utime(path.path, (1500000001.25, 1500000001.25))
+        filenames.append(path)
+
+        pax = tarfile.DEFAULT_FORMAT == tarfile.PAX_FORMAT
+        digests = hash_duplicate_candidates(filenames)
+        if pax:
+            self.assertEqual(set(digests), set())
+        else:
+            self.assertEqual(set(digests), set(filenames[:2]))
+
+        data = self.tmpdir / 'data.tar'
+        with data.open('wb') as fp:
+            builder = PackBuilder(fp, compression='none', digests=digests)
+            for path in filenames:
+                builder.add_data(path)
+            builder.close()
+
+        with tarfile.open(str(data), 'r:') as tar:
+            members = dict((m.name.rsplit('/', 1)[-1], m)
+                           for m in tar.getmembers())
+        self.assertTrue(members['file0'].isreg())
+        self.assertEqual(members['file1'].islnk(), not pax)
+        self.assertTrue(members['file2'].isreg())
+        if not pax:
+            self.assertEqual(members['file1'].mtime, 1500000000)
+
+    def test_data_index(self):
+        """Checks that the index matches the members of the tarball."""
+        (self.tmpdir / 'dir').mkdir()
+        for name, size in (('one', 1000), ('two', 0), ('dir/three', 512)):
+            with (self.tmpdir / name).open('wb') as fp:
+                fp.write(b'x' * size)
+        # The fractional part is only kept by PAX headers
+        os.utime((self.tmpdir / 'one').path, (1500000000.25, 1500000000.25))
+        (self.tmpdir / 'link').symlink('one')
+
+        data = self.tmpdir / 'data.tar.gz'
+        with data.open('wb') as fp:
+            builder = PackBuilder(fp)
+            for name in ('one', 'two', 'dir/three', 'link'):
+                builder.add_data(self.tmpdir / name)
+            builder.close()
+        index = io.BytesIO()
+        write_data_index(index, builder.tar.members)
+        index.seek(0)
+        members = read_data_index(index)
+
+        tar = tarfile.open(str(data), 'r:gz')
+        self.assertEqual(len(members), len(tar.getmembers()))
+        for member, expected in zip(members, tar.getmembers()):
+            for field in DATA_INDEX_FIELDS:
+                self.assertEqual(getattr(member, field),
+                                 getattr(expected, field))
+        # Members from the index can be extracted
+        tar.extractall(str(self.tmpdir / 'extracted'), members)
+        tar.close()
+        extracted = (self.tmpdir / 'extracted' / 'DATA' /
+                     self.tmpdir.split_root()[1])
+        with (extracted / 'dir/three').open('rb') as fp:
+            self.assertEqual(fp.read(), b'x' * 512)
+        self.assertEqual((extracted / 'link').read_link(), Path('one'))
+
+    def test_extract(self):
+        """Extracts a pack with multiple threads, and through a store."""
+        files = self.tmpdir / 'files'
+        (files / 'dir' / 'sub').mkdir(parents=True)
+        for i in range(40):
+            with (files / 'dir' / ('%d' % i)).open('wb') as fp:
+                fp.write(('%d\n' % i).encode('ascii') * (i * 1000))
+        # Identical files, packed as hardlinks
+        for name in ('dup0', 'dup1', 'dup2'):
+            path = files / 'dir' / name
+            with path.open('wb') as fp:
+                fp.write(b'duplicate\n' * 100)
+            path.chmod(0o644)
+            os.utime(path.path, (1500000000, 1500000000))
+        (files / 'dir' / 'sub' / 'link').symlink('../7')
+        (files / 'dir' / '7').chmod(0o600)
+        (files / 'dir' / 'sub').chmod(0o700)
+        directory = self.make_trace(
+            [], [File(path) for path in (files / 'dir').recursedir()])
+
+        for compression in ('gzip', 'none'):
+            target = self.tmpdir / ('test-%s.rpz' % compression)
+            pack(target, directory, False, compression=compression)
+
+            rpz_pack = RPZPack(target)
+            links = dict((m.name.rsplit('/', 1)[-1], m.linkname)
+                         for m in rpz_pack.list_data() if m.islnk())
+            self.assertEqual(sorted(links), ['dup1', 'dup2'])
+            self.assertEqual(set(links.values()),
+                             set([str(data_path(files / 'dir' / 'dup0'))]))
+
+            options = [(1, None), (3, None)]
+            if PY3:
+                store = ObjectStore(self.tmpdir / ('store-%s' % compression))
+                options.extend([(1, store), (3, store)])
+            for n, (jobs, store) in enumerate(options):
+                root = self.tmpdir / ('%s-%d' % (compression, n))
+                rpz_pack.extract_data(root, rpz_pack.list_data(), jobs,
+                                      store=store)
+                extracted = root / 'DATA' / files.split_root()[1] / 'dir'
+                for i in range(40):
+                    with (extracted / ('%d' % i)).open('rb') as fp:
+                        self.assertEqual(
+                            fp.read(),
+                            ('%d\n' % i).encode('ascii') * (i * 1000))
+                for name in ('dup0', 'dup1', 'dup2'):
+                    with (extracted / name).open('rb') as fp:
+                        self.assertEqual(fp.read(), b'duplicate\n' * 100)
+                    self.assertEqual(
+                        (extracted / name).stat().st_mtime, 1500000000)
+                self.assertEqual((extracted / 'sub' / 'link').read_link(),
+                                 Path('../7'))
+                self.assertEqual((extracted / '7').stat().st_mode & 0o777,
+                                 0o600)
+                self.assertEqual((extracted / 'sub').stat().st_mode & 0o777,
+                                 0o700)
+                if store is not None:
+                    # The files come from the store
+                    self.assertIn(str(extracted / 'dup0'), store.linked)
+            rpz_pack.close()
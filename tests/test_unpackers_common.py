@@ -4,13 +4,22 @@
 
 from __future__ import print_function, unicode_literals
 
+import hashlib
+import io
+import os
+from rpaths import Path
 import sys
+import tarfile
 import unittest
 
-from reprounzip.unpackers.common import UsageError, \
-    unique_names, make_unique_name, get_runs
+from reprounzip.common import DATA_DIGEST_HEADER, Package
+from reprounzip.unpackers.common import PKG_NOT_INSTALLED, UsageError, \
+    unique_names, make_unique_name, get_runs, ObjectStore
+from reprounzip.unpackers.common.packages import AptInstaller
 from reprounzip.utils import irange
 
+from tests.common import fake_popen
+
 
 class TestCommon(unittest.TestCase):
     def test_unique_names(self):
@@ -74,3 +83,74 @@ class TestMisc(unittest.TestCase):
             self.do_ok('2-3,two-heh', [2, 3, 1])
         finally:
             print(">>>>> get_runs tests", file=sys.stderr)
+
+
+class TestPackages(unittest.TestCase):
+    def test_apt_packages_info(self):
+        """Gets the installed version of packages from dpkg-query."""
+        output = (b'bash\tinstall ok installed\t5.0-4\t\n'
+                  b'oldpkg\tdeinstall ok config-files\t1.2\t\n')
+        packages = [Package(name, '1.0')
+                    for name in ('bash', 'oldpkg', 'missing')]
+        with fake_popen(lambda args: output) as calls:
+            infos = AptInstaller.get_packages_info(packages)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(infos, {'bash': (packages[0], '5.0-4'),
+                                 'oldpkg': (packages[1], PKG_NOT_INSTALLED),
+                                 'missing': (packages[2], PKG_NOT_INSTALLED)})
+
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path.tempdir()
+
+    def tearDown(self):
+        self.tmpdir.rmtree()
+
+    def make_member(self, name, contents):
+        member = tarfile.TarInfo(name)
+        member.size = len(contents)
+        member.mode = 0o640
+        member.mtime = 1500000000
+        member.pax_headers[DATA_DIGEST_HEADER] = \
+            hashlib.sha256(contents).hexdigest()
+        return member
+
+    def test_store(self):
+        """Adds a file to the store and links it in two places."""
+        store = ObjectStore(self.tmpdir / 'objects', writable=['out'])
+        contents = b'some contents\n'
+
+        def set_attrs(member, path):
+            os.chmod(path, member.mode)
+
+        member = self.make_member('in', contents)
+        path = str(self.tmpdir / 'in')
+        self.assertFalse(store.materialize(member, path))
+        self.assertTrue(store.add(member, io.BytesIO(contents), set_attrs))
+        self.assertTrue(store.materialize(member, path))
+        self.assertTrue(store.materialize(member, str(self.tmpdir / 'in2')))
+        obj = store.object_path(member)
+        self.assertEqual(os.stat(path).st_ino, os.stat(obj).st_ino)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(store.linked, set([path,
+                                            str(self.tmpdir / 'in2')]))
+
+        # Output files are copies
+        member = self.make_member('out', contents)
+        path = str(self.tmpdir / 'out')
+        self.assertTrue(store.materialize(member, path))
+        self.assertNotEqual(os.stat(path).st_ino, os.stat(obj).st_ino)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), contents)
+
+    def test_wrong_digest(self):
+        """Doesn't store a file that doesn't match its digest."""
+        store = ObjectStore(self.tmpdir / 'objects')
+        member = self.make_member('file', b'expected')
+        self.assertFalse(store.add(member, io.BytesIO(b'different'),
+                                   lambda m, p: None))
+        self.assertFalse(store.materialize(member,
+                                           str(self.tmpdir / 'file')))
+        del member.pax_headers[DATA_DIGEST_HEADER]
+        self.assertIsNone(store.object_path(member))
@@ -2,9 +2,11 @@
 # This file is part of ReproZip which is released under the Revised BSD License
 # See file LICENSE for full license details.
 
+from rpaths import Path
 import unittest
 
-from reprounzip.utils import optional_return_type
+from reprounzip.utils import optional_return_type, PathResolver, \
+    find_all_links
 
 
 class TestOptionalReturnType(unittest.TestCase):
@@ -42,3 +44,43 @@ class TestOptionalReturnType(unittest.TestCase):
         self.assertRaises(TypeError, lambda: T(1))
         self.assertRaises(TypeError, lambda: T(b=1, c=2))
         self.assertRaises(TypeError, lambda: T(c=1))
+
+
+class TestPathResolver(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='reprozip_tests_').resolve()
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def test_links(self):
+        # Example from the find_all_links() docstring, under self.tmp
+        tmp = self.tmp
+        (tmp / 'a').symlink('b')
+        (tmp / 'b').mkdir()
+        (tmp / 'b/g').symlink('c')
+        (tmp / 'b/c').symlink('../a/d')
+        (tmp / 'b/d').mkdir()
+        (tmp / 'b/d/e').symlink(tmp / 'f')
+        (tmp / 'f').open('w').close()
+        (tmp / 'loop').symlink('loop')
+
+        resolver = PathResolver()
+        for i in range(2):
+            self.assertEqual(
+                set(find_all_links(tmp / 'a/g/e', True, resolver=resolver)),
+                set([tmp / 'a', tmp / 'b/c', tmp / 'b/g', tmp / 'b/d/e',
+                     tmp / 'f']))
+        for path in ['a/g/e', 'a/g', 'b/c/e', 'b/d/nonexistent', 'f',
+                     'loop']:
+            self.assertEqual(resolver.resolve(tmp / path),
+                             (tmp / path).resolve())
+
+    def test_lies_under(self):
+        resolver = PathResolver()
+        prefixes = (Path('/usr'), Path('/etc'))
+        self.assertTrue(resolver.lies_under(Path('/usr'), prefixes))
+        self.assertTrue(resolver.lies_under(Path('/usr/lib/x'), prefixes))
+        self.assertTrue(resolver.lies_under(Path('/usr/lib/y'), prefixes))
+        self.assertFalse(resolver.lies_under(Path('/usrx/lib'), prefixes))
+        self.assertFalse(resolver.lies_under(Path('/'), prefixes))